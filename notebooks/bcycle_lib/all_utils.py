@@ -1,16 +1,19 @@
 # Common library routines for the BCycle analysis
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-# sklearn section
-from sklearn.preprocessing import LabelBinarizer, MinMaxScaler, scale
 
+from .cache import cached_frames, read_csv_source
+from .lazy import lazy_function
+from .profiling import profiled
+from .schema import apply_schema
+from . import weather
 
 
 INPUT_DIR = '../input'
 
+# Bump this when a loader's output changes, so old cache entries are rebuilt
+LOADER_VERSION = '2'
+
 # All-data utilities
 
 def col_convert(df, col, new_type, verbose=False):
@@ -36,41 +39,116 @@ def col_convert(df, col, new_type, verbose=False):
     df[col] = df[col].astype(new_type) # Convert the type and return dataframe
     return df[col]
     
+# Smallest column types of the trips and stations tables. Integers are widened by
+# `apply_schema` if new data doesn't fit, instead of failing a range check
+TRIPS_SCHEMA = {'bike_id' : 'uint16',
+                'checkout_id' : 'uint8',
+                'checkin_id' : 'uint8',
+                'duration' : 'uint16',
+                'membership' : 'category'}
+STATIONS_SCHEMA = {'station_id' : 'uint8', 'lat' : 'float32', 'lon' : 'float32'}
+
+def convert_schema(df, schema, verbose=False):
+    '''Converts the columns to the schema types, printing any which had to be widened'''
+    df, used_schema = apply_schema(df, schema)
+    if verbose:
+        for col in schema:
+            if used_schema.get(col, schema[col]) != schema[col]:
+                print('Widened {} from {} to {}'.format(col, schema[col], used_schema[col]))
+    return df
+
+# Number of trips parsed at a time by the chunked loader
+CHUNK_ROWS = 100000
+
+@profiled
+def clean_trips_types(trips_df, verbose=False):
+    '''Converts the trips table column types to proper values, indexed by datetime'''
+    trips_df['datetime'] = pd.to_datetime(trips_df['datetime'])
+    trips_df = convert_schema(trips_df, TRIPS_SCHEMA, verbose)
+    trips_df = trips_df.set_index('datetime', drop=True)
+    return trips_df
+
+@profiled
+def clean_station_types(stations_df, verbose=False):
+    '''Converts the stations table column types to proper values'''
+    return convert_schema(stations_df, STATIONS_SCHEMA, verbose)
+
+@profiled
 def clean_bcycle_types(stations_df, trips_df, verbose=False):
     '''Converts the column types to proper values'''
     # Convert column types to appropriate values
     if verbose:
         print('Converting Station table types')
         
-    stations_df['station_id'] = col_convert(stations_df, 'station_id', np.uint8, verbose)
-    stations_df['lat'] = col_convert(stations_df, 'lat', np.float32, verbose)
-    stations_df['lon'] = col_convert(stations_df, 'lon', np.float32, verbose)
+    stations_df = clean_station_types(stations_df, verbose)
 
     if verbose:
         print('Converting Bike table types')
         
-    trips_df['datetime'] = pd.to_datetime(trips_df['datetime'])
-    trips_df['membership'] = trips_df['membership'].astype('category')
-    trips_df['bike_id'] = col_convert(trips_df, 'bike_id', np.uint16, verbose)
-    trips_df['checkout_id'] = col_convert(trips_df, 'checkout_id', np.uint8, verbose)
-    trips_df['checkin_id'] = col_convert(trips_df, 'checkin_id', np.uint8, verbose)
-    trips_df['duration'] = col_convert(trips_df, 'duration', np.uint16, verbose)
-    trips_df = trips_df.set_index('datetime', drop=True)
+    trips_df = clean_trips_types(trips_df, verbose)
     return stations_df, trips_df
 
-def load_bcycle_data(directory, station_filename, trips_filename, verbose=False):  
+def iter_trips_chunks(file, chunksize=CHUNK_ROWS, verbose=False):
+    '''Reads the trips CSV file in chunks, converting each one to the final column types
+    INPUT: file - trips table CSV file (or its .zip)
+           chunksize - number of rows in each chunk
+           verbose - print out type conversion information
+    RETURNS: Generator of trips dataframes indexed by datetime
+    '''
+    # Integers are parsed as int64 so `apply_schema` can range-check them before narrowing.
+    # read_csv wraps out of range values if they're parsed as the final type directly
+    parse_types = {col : np.int64 for col, dtype in TRIPS_SCHEMA.items() if dtype != 'category'}
+    parse_types['membership'] = 'category'
+    for chunk in read_csv_source(file, dtype=parse_types, chunksize=chunksize):
+        yield clean_trips_types(chunk, verbose)
+
+@profiled
+def load_trips_chunked(file, chunksize=CHUNK_ROWS, verbose=False):
+    '''Loads the full trips table from typed chunks, without a copy of the whole table
+    in the wider parsed types
+    INPUT: file - trips table CSV file (or its .zip)
+           chunksize - number of rows parsed at a time
+           verbose - print out type conversion information
+    RETURNS: Trips dataframe indexed by datetime
+    '''
+    chunks = list(iter_trips_chunks(file, chunksize, verbose))
+
+    # A chunk's integer columns may have been widened, concat uses the widest type of each.
+    # Each chunk only has the memberships it saw, give them all the same categories
+    # so the concatenated column stays categorical
+    categories = list()
+    for chunk in chunks:
+        categories += [cat for cat in chunk['membership'].cat.categories if cat not in categories]
+    for chunk in chunks:
+        chunk['membership'] = chunk['membership'].cat.set_categories(categories)
+
+    return pd.concat(chunks)
+
+@profiled
+def load_bcycle_data(directory, station_filename, trips_filename, verbose=False, use_cache=True,
+                     chunksize=None):  
     '''Loads cleaned station and trips files
     INPUT: directory - string containing directory with files
-           station_filename - stations table CSV file
-           trips_filename - trips table CSV file
+           station_filename - stations table CSV file (or its .zip)
+           trips_filename - trips table CSV file (or its .zip)
            verbose - print out extra information after loading
+           use_cache - read and write the typed dataframes in the columnar cache
+           chunksize - if given, parse the trips in chunks of this many rows (see `load_trips_chunked`)
     RETURNS: Tuple with (stations, trips) dataframes
     '''
-    
-    stations_df = pd.read_csv(directory + '/' + station_filename)
-    trips_df = pd.read_csv(directory + '/' + trips_filename)
-
-    stations_df, trips_df = clean_bcycle_types(stations_df, trips_df, verbose)
+    def parse(station_path, trips_path):
+        stations_df = read_csv_source(station_path)
+        if chunksize is None:
+            trips_df = read_csv_source(trips_path)
+            return clean_bcycle_types(stations_df, trips_df, verbose)
+
+        stations_df = clean_station_types(stations_df, verbose)
+        return stations_df, load_trips_chunked(trips_path, chunksize, verbose)
+
+    stations_df, trips_df = cached_frames('bcycle', LOADER_VERSION,
+                                          [directory + '/' + station_filename,
+                                           directory + '/' + trips_filename],
+                                          parse, use_cache)
     
     if verbose:
         print('\nStations shape:\n{}'.format(stations_df.shape))
@@ -87,316 +165,379 @@ def load_bcycle_data(directory, station_filename, trips_filename, verbose=False)
     return (stations_df, trips_df)
 
 
-def clean_weather(df):
-    '''Cleans weather dataframe'''
-
-    # Remove whitespace and keep min/max values
-    df.columns = [col.strip() for col in df.columns]
-    date_col = df.columns[0]
-    df = df[[date_col,'Max TemperatureF','Min TemperatureF', 
-             'Max Humidity', 'Min Humidity',
-             'Max Sea Level PressureIn', 'Min Sea Level PressureIn', 
-             'Max Wind SpeedMPH', 'Mean Wind SpeedMPH', 'Max Gust SpeedMPH',
-             'PrecipitationIn', 'CloudCover', 'Events']]
-    
-    # Clean up column names, drop means as they're a linear combination of max/min
-    df.columns = ['date', 'max_temp', 'min_temp', 'max_humidity', 'min_humidity',
-                 'max_pressure', 'min_pressure', 'max_wind', 'min_wind', 'max_gust',
-                 'precipitation', 'cloud_cover', 'events']
-    
-    # Convert column types appropriately
-    df.loc[:,'date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')  
-    df = df.set_index('date', drop=True)
-    
-    df[['max_temp', 'min_temp']] = df[['max_temp', 'min_temp']].astype(np.uint8)
-    df[['max_humidity', 'min_humidity']] = df[['max_humidity', 'min_humidity']].astype(np.uint8)
-    df[['max_wind', 'min_wind', 'max_gust']] = df[['max_wind', 'min_wind', 'max_gust']].astype(np.uint8)
-
-
-    # Cloud cover is a fraction of 8 - 
-    # http://help.wunderground.com/knowledgebase/articles/129043-how-can-i-translate-the-cloud-cover-data-on-your
-    df['cloud_pct'] = (df['cloud_cover'].astype(np.float32) / 8.0) * 100
-    df = df.drop('cloud_cover', axis=1)
-    
-    # Precipitation sometimes has 'T' for trace amounts of rain. Replace this with small value
-    # and convert to a float
-    # http://help.wunderground.com/knowledgebase/articles/656875-what-does-t-stand-for-on-the-rain-precipitation
-    df['precipitation'] = df['precipitation'].replace('T', 0.01)
-    df['precipitation'] = df['precipitation'].astype(np.float32)
-
-    # Events are tricky. they're separated by hypens, and can have multiple values not in the same order !
-    events = set()
-    df['events'] = df['events'].replace(np.nan, 'None')
-    for row in df['events']:
-        if row is not np.nan:
-            line = row.split('-')
-            [events.add(word.lower()) for word in line]
-    
-    for event in events:
-        df[event] = df['events'].apply(str.lower).str.contains(event).astype(np.uint8)
-    
-    df = df.drop(['events', 'none'], axis=1)
-    return df
-
+@profiled
+def load_clean_weather(file, use_cache=True):
+    '''Loads a raw weather CSV file (or its .zip) and cleans it with `clean_weather`,
+    using the columnar cache'''
+    return cached_frames('clean_weather', LOADER_VERSION, [file],
+                         lambda path: (clean_weather(read_csv_source(path)),), use_cache)[0]
 
 
+def clean_weather(df):
+    '''Cleans weather dataframe, see `weather.clean_weather`'''
+    return weather.clean_weather(df)
 
-# Plotting functions
-
-def plot_lines(df, subplots, title, xlabel, ylabel):
-    '''Generates one or more line plots from pandas dataframe'''
-    
-    fig, ax = subplots
-    ax = df.plot.line(ax=ax)
-    ax.set_xlabel(xlabel, fontdict={'size' : 14})
-    ax.set_ylabel(ylabel, fontdict={'size' : 14})
-    ax.set_title(title, fontdict={'size' : 18}) 
-    ttl = ax.title
-    ttl.set_position([.5, 1.02])
-    ax.tick_params(axis='x', labelsize=14)
-    ax.tick_params(axis='y', labelsize=14)   
 
-    
-def plot_boxplot(df, order, x, y, figsize, title, xlabel, ylabel):
-    '''Plots a boxplot using given '''
-    fig, ax = plt.subplots(1,1, figsize=figsize)  
-    ax = sns.boxplot(data=df, x=x, y=y, order=order)
-    ax.set_xlabel(xlabel, fontdict={'size' : 14})
-    ax.set_ylabel(ylabel, fontdict={'size' : 14})
-    ax.set_title(title, fontdict={'size' : 18})
-    ax.tick_params(axis='x', labelsize=14)
-    ax.tick_params(axis='y', labelsize=14)
-    ttl = ax.title
-    ttl.set_position([.5, 1.02])
-
-
-def plot_bar(df, size, title, xlabel, ylabel):
-    '''Plots a bar graph of the dataframe '''
-    
-    palette = sns.color_palette('Set2', len(df.columns)) # Don't repeat colours
-    fig, ax = plt.subplots(1, 1, figsize=size)
-    ax = df.plot.bar(ax=ax, color=palette, rot=0)
-    ax.set_xlabel(xlabel, fontdict={'size' : 14})
-    ax.set_ylabel(ylabel, fontdict={'size' : 14})
-    ax.set_title(title, fontdict={'size' : 18}) 
-    ttl = ax.title
-    ttl.set_position([.5, 1.02])
-    ax.tick_params(axis='x', labelsize=14)
-    ax.tick_params(axis='y', labelsize=14)   
-    ax.legend(fontsize = 14)
-
-
-def plot_hist(df_col, bins, size, title, xlabel, ylabel):
-    '''Plots a histogram of the dataframe column'''
-    
-    fig, ax = plt.subplots(1, 1, figsize=size)
-    ax = df_col.plot.hist(ax=ax, bins=bins)
-    ax.set_xlabel(xlabel, fontdict={'size' : 14})
-    ax.set_ylabel(ylabel, fontdict={'size' : 14})
-    ax.set_title(title, fontdict={'size' : 18}) 
-    ttl = ax.title
-    ttl.set_position([.5, 1.02])
-    ax.tick_params(axis='x', labelsize=14)
-    ax.tick_params(axis='y', labelsize=14)   
 
+# Trip analysis functions
 
-# Model evaluation plotting functions
+@profiled
+def detect_rebalances(trips_df, last_checkins=None):
+    '''Flags trips which start at a different station to where the bike was last checked in
+    INPUT: trips_df - trips dataframe indexed by datetime, from `load_bcycle_data`
+           last_checkins - optional Series of the last checkin_id of each bike_id from
+                           earlier trips (see `bike_last_checkins`). Used to check the
+                           first trip of each bike when only new trips are passed in
+    RETURNS: trips_df with rebalance (bool), rebalance_src and rebalance_dst columns added.
+             rebalance_src is the last checkin station, rebalance_dst the checkout station
+    '''
+    n_rows = trips_df.shape[0]
+    bike_ids = trips_df['bike_id'].values
+    checkouts = trips_df['checkout_id'].values
+    checkins = trips_df['checkin_id'].values
+
+    # Sort by bike, then time. The sort is stable so trips at the same time keep their order
+    order = np.lexsort((trips_df.index.values, bike_ids))
+    sorted_bikes = bike_ids[order]
+    sorted_checkouts = checkouts[order]
+
+    # The previous checkin of each trip is the row before it, if it's the same bike
+    prev_checkins = np.zeros(n_rows, dtype=checkins.dtype)
+    has_prev = np.zeros(n_rows, dtype=bool)
+    prev_checkins[1:] = checkins[order][:-1]
+    has_prev[1:] = sorted_bikes[1:] == sorted_bikes[:-1]
+
+    # The first trip of each bike is compared with its last checkin from earlier trips
+    if last_checkins is not None and n_rows > 0:
+        first = ~has_prev
+        known = last_checkins.reindex(sorted_bikes[first])
+        prev_checkins[first] = known.fillna(0).values.astype(checkins.dtype)
+        has_prev[first] = known.notnull().values
+
+    sorted_rebalances = has_prev & (prev_checkins != sorted_checkouts)
+
+    # Scatter the results back into the original row order
+    rebalances = np.zeros(n_rows, dtype=bool)
+    rebalance_src = np.zeros(n_rows, dtype=checkins.dtype)
+    rebalance_dst = np.zeros(n_rows, dtype=checkouts.dtype)
+    rebalances[order] = sorted_rebalances
+    rebalance_src[order] = np.where(sorted_rebalances, prev_checkins, 0)
+    rebalance_dst[order] = np.where(sorted_rebalances, sorted_checkouts, 0)
+
+    trips_df['rebalance'] = rebalances
+    trips_df['rebalance_src'] = rebalance_src
+    trips_df['rebalance_dst'] = rebalance_dst
+    return trips_df
+
+@profiled
+def bike_last_checkins(trips_df, last_checkins=None):
+    '''Finds the station each bike was last checked in to
+    INPUT: trips_df - trips dataframe indexed by datetime
+           last_checkins - optional Series from earlier trips, updated with trips_df
+    RETURNS: Series of checkin_id values indexed by bike_id
+    '''
+    order = np.lexsort((trips_df.index.values, trips_df['bike_id'].values))
+    sorted_bikes = trips_df['bike_id'].values[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = sorted_bikes[1:] != sorted_bikes[:-1]
 
-def df_from_results(index_train, y_train, y_train_pred, index_val, y_val, y_val_pred):
-    '''Creates dataframe from results for use in plotting functions below'''
-    train_dict = dict()
-    val_dict = dict()
+    checkins = pd.Series(trips_df['checkin_id'].values[order][last], index=sorted_bikes[last])
+    checkins.index.name = 'bike_id'
+    if last_checkins is not None:
+        checkins = checkins.combine_first(last_checkins).astype(checkins.dtype)
+    return checkins
 
-    train_dict['true'] = y_train
-    train_dict['pred'] = y_train_pred
 
-    val_dict['true'] = y_val
-    val_dict['pred'] = y_val_pred
+# Origin-destination flow functions
 
-    train_df = pd.DataFrame(train_dict)
-    val_df = pd.DataFrame(val_dict)
+HOURS_PER_WEEK = 168
 
-    train_df.index = index_train
-    val_df.index = index_val
-    
-    return train_df, val_df
-    
-   
+def hour_of_week(datetimes):
+    '''Returns the hour of the week (0 is Monday midnight) of each datetime as int64'''
+    hours = np.asarray(datetimes, dtype='datetime64[h]').view(np.int64)
+    return (hours + 72) % HOURS_PER_WEEK # The epoch was a Thursday, 72 hours into its week
 
-def plot_val(val_df, pred_col, true_col, title):
+class FlowMatrix(object):
     '''
-    Plots the validation prediction
-    INPUT: val_df - Validation dataframe
-           pred_col - string with prediction column name
-           true_col - string with actual column name
-           title - Prefix for the plot titles.
-    RETURNS: Nothing
+    Trip counts and total durations between every pair of stations, as dense
+    (slices, checkout station, checkin station) arrays indexed by station_id
+    INPUT: n_stations - size of the station axes, must be larger than every station_id
+           by_hour - if True, keep a slice for each checkout hour of the week, otherwise one slice
     '''
-    def plot_ts(df, pred, true, title, ax):
-        '''Generates one of the subplots to show time series'''
-        ax = df.plot(y=[true, pred], ax=ax) # , color='black', style=['--', '-'])
-        ax.set_xlabel('Date', fontdict={'size' : 14})
-        ax.set_ylabel('Rentals', fontdict={'size' : 14})
-        ax.set_title(title, fontdict={'size' : 16}) 
-        ttl = ax.title
-        ttl.set_position([.5, 1.02])
-        ax.legend(['Predicted rentals', 'Actual rentals'], fontsize=14, loc=2)
-        ax.tick_params(axis='x', labelsize=14)
-        ax.tick_params(axis='y', labelsize=14)
-    
-    fig, ax = plt.subplots(1,1, sharey=True, figsize=(16,8))
-    plot_ts(val_df, pred_col, true_col, title + ' (validation set)', ax)
-    
 
-def plot_prediction(train_df, val_df, pred_col, true_col, title):
-    '''
-    Plots the predicted rentals along with actual rentals for the dataframe
-    INPUT: train_df, val_df - pandas dataframe with training and validataion results
-           pred_col - string with prediction column name
-           true_col - string with actual column name
-           title - Prefix for the plot titles.
-    RETURNS: Nothing
-    '''
-    def plot_ts(df, pred, true, title, ax):
-        '''Generates one of the subplots to show time series'''
-        plot_df = df.resample('1D').sum()
-        ax = plot_df.plot(y=[pred, true], ax=ax) # , color='black', style=['--', '-'])
-        ax.set_xlabel('', fontdict={'size' : 14})
-        ax.set_ylabel('Rentals', fontdict={'size' : 14})
-        ax.set_title(title, fontdict={'size' : 16}) 
-        ttl = ax.title
-        ttl.set_position([.5, 1.02])
-        ax.legend(['Predicted rentals', 'Actual rentals'], fontsize=14)
-        ax.tick_params(axis='x', labelsize=14)
-        ax.tick_params(axis='y', labelsize=14)   
-    
-    fig, axes = plt.subplots(2,1, sharey=True, figsize=(20,12))
-    plot_ts(train_df, pred_col, true_col, title + ' (training set)', axes[0])
-    plot_ts(val_df, pred_col, true_col, title + ' (validation set)', axes[1])
-    
-def plot_residuals(train_df, val_df, pred_col, true_col, title):
-    '''
-    Plots the residual errors in histogram (between actual and prediction)
-    INPUT: train_df, val_df - pandas dataframe with training and validataion results
-           pred_col - string with prediction column name
-           true_col - string with actual column name
-           title - Prefix for the plot titles.
-    RETURNS: Nothing
+    def __init__(self, n_stations, by_hour=False):
+        self.n_stations = n_stations
+        self.n_slices = HOURS_PER_WEEK if by_hour else 1
+        shape = (self.n_slices, n_stations, n_stations)
+        self.counts = np.zeros(shape, dtype=np.uint32)
+        self.durations = np.zeros(shape, dtype=np.float64)
+
+    def add_trips(self, trips_df):
+        '''
+        Adds trips to the matrices, so they can be built up a batch at a time
+        INPUT: trips_df - trips dataframe indexed by datetime, from `load_bcycle_data`
+        RETURNS: The matrix, so calls can be chained
+        '''
+        src = trips_df['checkout_id'].values.astype(np.int64)
+        dst = trips_df['checkin_id'].values.astype(np.int64)
+        assert src.size == 0 or max(src.max(), dst.max()) < self.n_stations, \
+            'Station id too large, n_stations is {}'.format(self.n_stations)
+        slices = hour_of_week(trips_df.index.values) if self.n_slices > 1 else 0
+        keys = (slices * self.n_stations + src) * self.n_stations + dst
+
+        # Sum each distinct key once, then add into the flattened matrices
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        self.counts.reshape(-1)[unique_keys] += np.bincount(inverse).astype(np.uint32)
+        self.durations.reshape(-1)[unique_keys] += np.bincount(
+            inverse, weights=trips_df['duration'].values.astype(np.float64))
+        return self
+
+    def hours_slice(self, hours=None):
+        '''Returns the slices to sum over: all of them, or the given hours of the week'''
+        if hours is None or self.n_slices == 1:
+            return slice(None)
+        return np.asarray(hours)
+
+    def matrix(self, hours=None):
+        '''
+        Sums the trip counts into a single matrix
+        INPUT: hours - optional list of checkout hours of the week to include (needs by_hour)
+        RETURNS: uint32 array of trips, with a row per checkout station and a column per checkin station
+        '''
+        return self.counts[self.hours_slice(hours)].sum(axis=0, dtype=np.uint32)
+
+    def mean_duration(self, hours=None):
+        '''Returns the mean trip duration in minutes between each pair of stations, NaN with no trips'''
+        counts = self.matrix(hours)
+        durations = self.durations[self.hours_slice(hours)].sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (durations / counts).astype(np.float32)
+
+    def to_frame(self, hours=None):
+        '''Returns the trip counts as a dataframe with checkout_id rows and checkin_id columns'''
+        station_ids = np.arange(self.n_stations)
+        return pd.DataFrame(self.matrix(hours), index=pd.Index(station_ids, name='checkout_id'),
+                            columns=pd.Index(station_ids, name='checkin_id'))
+
+    def flows(self, hours=None, geo_index=None):
+        '''
+        Lists the station pairs with trips between them, e.g. as graph edges
+        INPUT: hours - optional list of checkout hours of the week to include (needs by_hour)
+               geo_index - optional `StationGeoIndex` to add the distance between stations
+        RETURNS: Dataframe with checkout_id, checkin_id, count and mean_duration columns (and
+                 distance), sorted by count with the largest flows first
+        '''
+        counts = self.matrix(hours)
+        src, dst = np.nonzero(counts)
+        df = pd.DataFrame({'checkout_id' : src, 'checkin_id' : dst,
+                           'count' : counts[src, dst],
+                           'mean_duration' : self.mean_duration(hours)[src, dst]},
+                          columns=['checkout_id', 'checkin_id', 'count', 'mean_duration'])
+        if geo_index is not None:
+            df['distance'] = geo_index.distance(src, dst)
+        return df.sort_values('count', ascending=False, kind='mergesort').reset_index(drop=True)
+
+    def save(self, file):
+        '''Saves the matrices to a .npz file'''
+        np.savez(file, counts=self.counts, durations=self.durations)
+
+    @classmethod
+    def load(cls, file):
+        '''Loads matrices saved with `save`'''
+        with np.load(file) as data:
+            flow = cls(data['counts'].shape[1], by_hour=data['counts'].shape[0] > 1)
+            flow.counts = data['counts']
+            flow.durations = data['durations']
+        return flow
+
+
+# Plotting functions, imported from `plotting` on first use
+
+plot_lines = lazy_function('.plotting', 'plot_lines', __package__)
+plot_boxplot = lazy_function('.plotting', 'plot_boxplot', __package__)
+plot_bar = lazy_function('.plotting', 'plot_bar', __package__)
+plot_hist = lazy_function('.plotting', 'plot_hist', __package__)
+df_from_results = lazy_function('.plotting', 'df_from_results', __package__)
+plot_val = lazy_function('.plotting', 'plot_val', __package__)
+plot_prediction = lazy_function('.plotting', 'plot_prediction', __package__)
+plot_residuals = lazy_function('.plotting', 'plot_residuals', __package__)
+plot_results = lazy_function('.plotting', 'plot_results', __package__)
+plot_scores = lazy_function('.plotting', 'plot_scores', __package__)
+render_figures = lazy_function('.plotting', 'render_figures', __package__)
 
-    '''
-    def plot_res(df, pred, true, title, ax):
-        '''Generates one of the subplots to show time series'''
-        residuals = df[pred] - df[true]
-        ax = residuals.plot.hist(ax=ax, bins=20)
-        ax.set_xlabel('Residual errors', fontdict={'size' : 14})
-        ax.set_ylabel('Count', fontdict={'size' : 14})
-        ax.set_title(title, fontdict={'size' : 16}) 
-        ttl = ax.title
-        ttl.set_position([.5, 1.02])
-        ax.tick_params(axis='x', labelsize=14)
-        ax.tick_params(axis='y', labelsize=14)   
-    
-    fig, axes = plt.subplots(1,2, sharey=True, sharex=True, figsize=(20,6))
-    plot_res(train_df, pred_col, true_col, title + ' residuals (training set)', axes[0])
-    plot_res(val_df, pred_col, true_col, title + ' residuals (validation set)', axes[1])
-    
-    
-def plot_results(train_df, val_df, pred_col, true_col, title):
-    '''Plots time-series predictions and residuals'''
-    plot_prediction(train_df, val_df, pred_col, true_col, title=title)
-    plot_residuals(train_df, val_df, pred_col, true_col, title=title)
-    
-def plot_scores(df, title, sort_col=None):
-    '''Plots model scores in a horizontal bar chart
-    INPUT: df - dataframe containing train_rmse and val_rmse columns
-           sort_col - Column to sort bars on
-    RETURNS: Nothing
-    '''
-    fig, ax = plt.subplots(1,1, figsize=(12,8)) 
-    if sort_col is not None:
-        df.sort_values(sort_col).plot.barh(ax=ax)
-    else:
-        df.sort_values(sort_col).plot.barh(ax=ax)
 
-    ax.set_xlabel('RMSE', fontdict={'size' : 14})
-    ax.set_title(title, fontdict={'size' : 18}) 
-    ttl = ax.title
-    ttl.set_position([.5, 1.02])
-    ax.legend(['Train RMSE', 'Validation RMSE'], fontsize=14, loc=4)
-    ax.tick_params(axis='x', labelsize=14)
-    ax.tick_params(axis='y', labelsize=14)
+# Model training functions
 
+class FeaturePipeline(object):
+    '''Reusable version of `reg_x_y_split`. The one-hot encodings and scalers are fitted once
+    on a training dataframe, then any dataframe with the same columns can be converted to
+    X and y without refitting.
+    INPUT: target_col = Column name of the target variable
+           target_func = Optional function applied to the target values
+           ohe_cols = Categorical columns to be converted to one-hot-encoding
+           z_norm_cols = Columns to be z-normalized
+           minmax_norm_cols = Columns to be min-max scaled
+           sparse_ohe = Return X as a scipy CSR matrix, for wide one-hot encodings
+           dtype = Type of the X values
+    '''
 
-    
-# Model training functions
+    def __init__(self, target_col, target_func=None, ohe_cols=None, z_norm_cols=None,
+                 minmax_norm_cols=None, sparse_ohe=False, dtype=np.float32):
+        self.target_col = target_col
+        self.target_func = target_func
+        self.ohe_cols = list(ohe_cols) if ohe_cols is not None else list()
+        self.z_norm_cols = list(z_norm_cols) if z_norm_cols is not None else list()
+        self.minmax_norm_cols = list(minmax_norm_cols) if minmax_norm_cols is not None else list()
+        self.sparse_ohe = sparse_ohe
+        self.dtype = dtype
+
+    @profiled
+    def fit(self, df, verbose=False):
+        '''Fits the one-hot classes and scaling parameters to the dataframe'''
+        # Classes are sorted like LabelBinarizer. One or two classes only need a single column
+        self.classes = dict()
+        for col in self.ohe_cols:
+            if verbose: print('Binarizing column {}'.format(col))
+            self.classes[col] = np.unique(df[col].values)
 
+        # Scale by (x - offset) / scale, with the same zero-range handling as sklearn
+        self.offsets = dict()
+        self.scales = dict()
+        for col in self.z_norm_cols:
+            if verbose: print('Z-Normalizing column {}'.format(col))
+            values = df[col].values.astype(np.float64)
+            self.offsets[col] = values.mean()
+            self.scales[col] = values.std() if values.std() != 0 else 1.0
+        for col in self.minmax_norm_cols:
+            if verbose: print('Min-max scaling column {}'.format(col))
+            values = df[col].values.astype(np.float64)
+            self.offsets[col] = values.min()
+            self.scales[col] = (values.max() - values.min()) if values.max() != values.min() else 1.0
+
+        encoded = set(self.ohe_cols + self.z_norm_cols + self.minmax_norm_cols + [self.target_col])
+        self.raw_cols = [col for col in df.columns if col not in encoded]
+
+        self.ohe_widths = [len(self.classes[col]) if len(self.classes[col]) > 2 else 1
+                           for col in self.ohe_cols]
+        self.n_features = (sum(self.ohe_widths) + len(self.z_norm_cols) +
+                           len(self.minmax_norm_cols) + len(self.raw_cols))
+        return self
+
+    def feature_names(self):
+        '''Returns the name of each column of X'''
+        names = list()
+        for col, width in zip(self.ohe_cols, self.ohe_widths):
+            classes = self.classes[col] if width != 1 else self.classes[col][-1:]
+            names += ['{}={}'.format(col, value) for value in classes]
+        return names + self.z_norm_cols + self.minmax_norm_cols + self.raw_cols
+
+    def ohe_codes(self, df, col, width):
+        '''Returns the one-hot column of each row, -1 for values not seen by `fit`'''
+        classes = self.classes[col]
+        values = df[col].values
+        codes = np.searchsorted(classes, values).clip(0, len(classes) - 1)
+        codes[classes[codes] != values] = -1
+        if width == 1:
+            codes = np.where(codes == 1, 0, -1)
+        return codes
+
+    @profiled
+    def transform(self, df, out=None):
+        '''Converts a dataframe to X and y using the fitted parameters
+        INPUT: df = Dataframe with the columns seen by `fit`. The target column is optional
+               out = Optional preallocated (rows, n_features) array to write X into
+        RETURNS: Tuple with X, y (None if df has no target column)
+        '''
+        n_rows = df.shape[0]
+        rows = np.arange(n_rows)
+        ohe_rows = list()
+        ohe_cols = list()
+        offset = 0
+        for col, width in zip(self.ohe_cols, self.ohe_widths):
+            codes = self.ohe_codes(df, col, width)
+            valid = codes >= 0
+            ohe_rows.append(rows[valid])
+            ohe_cols.append(codes[valid] + offset)
+            offset += width
+
+        # Scaled and raw columns follow the one-hot encodings. Non-numeric raw columns are
+        # passed through in an object array, as `reg_x_y_split` always did
+        n_dense = self.n_features - offset
+        raw_numeric = all(df[col].dtype.kind in 'biuf' for col in self.raw_cols)
+        dtype = self.dtype if raw_numeric else object
+        if self.sparse_ohe:
+            assert raw_numeric, 'Non-numeric raw columns can\'t be stored in a sparse matrix'
+            dense = np.empty((n_rows, n_dense), dtype=dtype)
+        else:
+            X = out if out is not None else np.empty((n_rows, self.n_features), dtype=dtype)
+            assert X.shape == (n_rows, self.n_features), 'Output buffer shape {}, expected {}'.\
+                format(X.shape, (n_rows, self.n_features))
+            X[:, :offset] = 0
+            if ohe_rows:
+                X[np.concatenate(ohe_rows), np.concatenate(ohe_cols)] = 1
+            dense = X[:, offset:]
+
+        for idx, col in enumerate(self.z_norm_cols + self.minmax_norm_cols):
+            dense[:, idx] = (df[col].values.astype(np.float64) - self.offsets[col]) / self.scales[col]
+        n_scaled = len(self.z_norm_cols) + len(self.minmax_norm_cols)
+        for idx, col in enumerate(self.raw_cols):
+            dense[:, n_scaled + idx] = df[col].values
+
+        if self.sparse_ohe:
+            import scipy.sparse as sp
+            ohe_rows = np.concatenate(ohe_rows) if ohe_rows else np.zeros(0, dtype=int)
+            ohe_cols = np.concatenate(ohe_cols) if ohe_cols else np.zeros(0, dtype=int)
+            ohe = sp.csr_matrix((np.ones(len(ohe_rows), dtype=self.dtype), (ohe_rows, ohe_cols)),
+                                shape=(n_rows, offset))
+            X = sp.hstack((ohe, sp.csr_matrix(dense)), format='csr')
+
+        y = None
+        if self.target_col in df.columns:
+            y = df[self.target_col].values
+            if self.target_func is not None:
+                y = self.target_func(y)
+        return X, y
+
+    def fit_transform(self, df, verbose=False):
+        '''Fits the pipeline to the dataframe, and returns its X and y'''
+        return self.fit(df, verbose).transform(df)
+
+
+@profiled
 def reg_x_y_split(df, target_col, target_func=None, ohe_cols=None, z_norm_cols=None, minmax_norm_cols=None, verbose=False):
     ''' Returns X and y to train regressor
     INPUT: df = Dataframe to be converted to numpy arrays 
            target_col = Column name of the target variable
            ohe_col = Categorical columns to be converted to one-hot-encoding
            z_norm_col = Columns to be z-normalized
-    RETURNS: Tuple with X, y, df
+    RETURNS: Tuple with X, y, df. X is a float64 array (object if any raw column isn't
+             numeric), or the raw columns as a dataframe if no columns are encoded
+    Fits a new `FeaturePipeline` on every call. To convert validation or live data with
+    the training parameters, keep the pipeline and call its `transform` instead.
     '''
-    
-    # Create a copy, remove index and date fields
+    pipeline = FeaturePipeline(target_col, target_func, ohe_cols, z_norm_cols, minmax_norm_cols,
+                               dtype=np.float64)
     df_out = df.copy()
-    df_X = df.copy()
-    df_X = df_X.reset_index(drop=True)
-    X = None
-    
-    # Convert categorical columns to one-hot encoding
-    if ohe_cols is not None:
-        for col in ohe_cols:
-            if verbose: print('Binarizing column {}'.format(col))
-            lbe = LabelBinarizer()
-            ohe_out = lbe.fit_transform(df_X[col])
-            if X is None:
-                X = ohe_out
-            else:
-                X = np.hstack((X, ohe_out))
-            df_X = df_X.drop(col, axis=1)
-            
-    # Z-normalize relevant columns
-    if z_norm_cols is not None:
-        for col in z_norm_cols:
-            if verbose: print('Z-Normalizing column {}'.format(col))
-            scaled_col = scale(df[col].astype(np.float64))
-            scaled_col = scaled_col[:,np.newaxis]
-            df_out[col] = scaled_col
-            if X is None:
-                X = scaled_col
-            if X is not None:
-                X = np.hstack((X, scaled_col))
-            df_X = df_X.drop(col, axis=1)
-
-    if minmax_norm_cols is not None:
-        for col in minmax_norm_cols:
-            if verbose: print('Min-max scaling column {}'.format(col))
-            mms = MinMaxScaler()
-            mms_col = mms.fit_transform(df_X[col])
-            mms_col = mms_col[:, np.newaxis]
-            df_out[col] = mms_col
-            if X is None:
-                X = mms_col
-            else:
-                X = np.hstack((X, mms_col))
-            df_X = df_X.drop(col, axis=1)
-
-    # Combine raw pandas Dataframe with encoded / normalized np arrays
-    if X is not None:
-        X = np.hstack((X, df_X.drop(target_col, axis=1).values))
-    else:
-        X = df_X.drop(target_col, axis=1)
-        
-    y = df[target_col].values
+    if not (pipeline.ohe_cols or pipeline.z_norm_cols or pipeline.minmax_norm_cols):
+        # Nothing to encode, so the raw columns are returned as they are
+        X = df.reset_index(drop=True).drop(target_col, axis=1)
+        y = df[target_col].values
+        if target_func is not None:
+            y = target_func(y)
+        return X, y, df_out
+
+    X, y = pipeline.fit_transform(df, verbose)
+
+    # Return the normalized columns in the dataframe too
+    n_ohe = sum(pipeline.ohe_widths)
+    for idx, col in enumerate(pipeline.z_norm_cols + pipeline.minmax_norm_cols):
+        df_out[col] = X[:, n_ohe + idx].astype(np.float64)
 
-    if target_func is not None:
-        y = target_func(y)
-    
     return X, y, df_out
 
 
+@profiled
 def add_time_features(df):
     ''' Extracts dayofweek and hour fields from index
     INPUT: Dataframe to extract fields from
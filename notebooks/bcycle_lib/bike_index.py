@@ -0,0 +1,206 @@
+# Per-bike trip chains, stored per bike, with vectorized utilization metrics
+import pandas as pd
+import numpy as np
+
+from .occupancy import datetimes_ns, segment_searchsorted
+from .profiling import profiled
+
+MINUTE_NS = 60 * 10**9
+DAY_NS = 24 * 60 * MINUTE_NS
+DAY_MINUTES = 24 * 60
+
+
+class BikeIndex(object):
+    '''
+    Trips grouped by bike. The trips of bike_ids[i] are rows offsets[i] to offsets[i + 1]
+    of the times (int64 ns checkout times, sorted), durations (minutes), checkouts and
+    checkins arrays. Each trip's idle time and relocation flag are computed once on building
+    '''
+
+    def __init__(self, bike_ids, offsets, times, durations, checkouts, checkins):
+        self.bike_ids = bike_ids
+        self.offsets = offsets
+        self.times = times
+        self.durations = durations
+        self.checkouts = checkouts
+        self.checkins = checkins
+        self.ends = times + durations.astype(np.int64) * MINUTE_NS
+
+        # The previous trip of each trip is the row before it, unless it's the bike's first
+        self.first = np.zeros(len(times), dtype=bool)
+        self.first[offsets[:-1][np.diff(offsets) > 0]] = True
+        prev_rows = np.maximum(np.arange(len(times)) - 1, 0)
+
+        # Minutes between the previous trip's checkin and this checkout, NaN for a first trip
+        self.idle = ((times - self.ends[prev_rows]) / MINUTE_NS).astype(np.float32)
+        self.idle[self.first] = np.nan
+
+        # The bike moved between trips without a rider, e.g. it was rebalanced
+        self.relocated = ~self.first & (checkouts != checkins[prev_rows])
+
+        # Segment of each trip
+        self.trip_bikes = np.repeat(np.arange(len(bike_ids)), np.diff(offsets))
+
+        # Map bike_id values to their segment, -1 for unknown ids
+        self.rows = np.full(int(bike_ids.max()) + 1 if len(bike_ids) else 0, -1, dtype=np.int32)
+        self.rows[bike_ids] = np.arange(len(bike_ids))
+
+    @classmethod
+    @profiled
+    def from_trips(cls, trips_df):
+        '''
+        Builds the index from trips
+        INPUT: trips_df - trips dataframe indexed by datetime, from `load_bcycle_data`
+        RETURNS: BikeIndex
+        '''
+        bike_ids = trips_df['bike_id'].values.astype(np.int64)
+        times = datetimes_ns(trips_df.index.values)
+        # The sort is stable so trips at the same time keep their order
+        order = np.lexsort((times, bike_ids))
+        bike_ids = bike_ids[order]
+
+        unique_ids, starts = np.unique(bike_ids, return_index=True)
+        offsets = np.append(starts, len(bike_ids)).astype(np.int64)
+        return cls(unique_ids, offsets, times[order],
+                   trips_df['duration'].values[order],
+                   trips_df['checkout_id'].values[order],
+                   trips_df['checkin_id'].values[order])
+
+    def bike_rows(self, bike_ids):
+        '''Returns the segment of each bike_id, or -1 if it isn't in the index'''
+        bike_ids = np.asarray(bike_ids, dtype=np.int64)
+        rows = np.full(bike_ids.shape, -1, dtype=np.int32)
+        valid = (bike_ids >= 0) & (bike_ids < len(self.rows))
+        rows[valid] = self.rows[bike_ids[valid]]
+        return rows
+
+    def bike_slice(self, bike_id):
+        '''Returns the slice of the arrays holding a bike's trips'''
+        row = self.bike_rows([bike_id])[0]
+        if row < 0:
+            return slice(0, 0)
+        return slice(int(self.offsets[row]), int(self.offsets[row + 1]))
+
+    def trips(self, bike_id):
+        '''
+        Returns a bike's trip chain
+        INPUT: bike_id - bike to return
+        RETURNS: Dataframe indexed by checkout datetime with checkout_id, checkin_id, duration,
+                 idle (minutes since the previous checkin) and relocated columns
+        '''
+        rows = self.bike_slice(bike_id)
+        return pd.DataFrame({'checkout_id' : self.checkouts[rows],
+                             'checkin_id' : self.checkins[rows],
+                             'duration' : self.durations[rows],
+                             'idle' : self.idle[rows],
+                             'relocated' : self.relocated[rows]},
+                            index=pd.DatetimeIndex(self.times[rows].astype('datetime64[ns]'), name='datetime'),
+                            columns=['checkout_id', 'checkin_id', 'duration', 'idle', 'relocated'])
+
+    def trip_counts(self):
+        '''Returns the number of trips of each bike, indexed by bike_id'''
+        return pd.Series(np.diff(self.offsets), index=pd.Index(self.bike_ids, name='bike_id'), name='trips')
+
+    def segment_sum(self, values):
+        '''Sums an array in trip order over each bike, ignoring NaNs'''
+        values = np.asarray(values, dtype=np.float64)
+        return np.bincount(self.trip_bikes, weights=np.where(np.isnan(values), 0, values),
+                           minlength=len(self.bike_ids))
+
+    def time_since_last_trip(self, datetime):
+        '''
+        Finds how long each bike has been parked at a time
+        INPUT: datetime - time to measure from
+        RETURNS: Series indexed by bike_id of minutes since the bike's last checkout at or before
+                 `datetime` was checked in (0 if it's still out), NaN if it has no trip by then
+        '''
+        query_time = pd.Timestamp(datetime).value
+        query_times = np.full(len(self.bike_ids), query_time, dtype=np.int64)
+        idx = segment_searchsorted(self.times, self.offsets[:-1], self.offsets[1:], query_times)
+        found = idx >= self.offsets[:-1]
+        minutes = np.maximum(query_time - self.ends[np.where(found, idx, 0)], 0) / MINUTE_NS
+        return pd.Series(np.where(found, minutes, np.nan).astype(np.float32),
+                         index=pd.Index(self.bike_ids, name='bike_id'), name='minutes_since_last')
+
+    @profiled
+    def summary(self, datetime=None):
+        '''
+        Maintenance summary of every bike
+        INPUT: datetime - time to measure the time since last trip and utilization at,
+                          defaults to the last checkin in the index
+        RETURNS: Dataframe indexed by bike_id with trips, first and last checkout, ride_minutes,
+                 mean and max idle minutes, hops (trips ending at another station), relocations
+                 (trips starting away from the previous checkin), stations (distinct stations
+                 visited), minutes_since_last and utilization (fraction of the time since the
+                 first trip spent riding)
+        '''
+        datetime = pd.Timestamp(self.ends.max() if len(self.ends) else 0) if datetime is None else datetime
+        counts = np.diff(self.offsets)
+        starts = self.offsets[:-1]
+        lasts = self.offsets[1:] - 1
+
+        # Every bike in the index has a trip, so each segment is non-empty
+        idle_counts = counts - 1
+        idle_max = np.full(len(counts), np.nan, dtype=np.float32)
+        if len(self.times):
+            idle_max = np.maximum.reduceat(np.where(self.first, -np.inf, self.idle), starts).astype(np.float32)
+            idle_max[idle_counts == 0] = np.nan
+
+        # Distinct stations from the unique (bike row, station) pairs, packed with a multiplier
+        # larger than every station_id
+        n_keys = int(max(self.checkouts.max(), self.checkins.max())) + 1 if len(self.times) else 1
+        pairs = np.unique(np.concatenate((self.trip_bikes * n_keys + self.checkouts.astype(np.int64),
+                                          self.trip_bikes * n_keys + self.checkins.astype(np.int64))))
+        stations = np.bincount(pairs // n_keys, minlength=len(counts))
+
+        ride_minutes = self.segment_sum(self.durations)
+        span_minutes = (pd.Timestamp(datetime).value - self.times[starts]) / MINUTE_NS
+        with np.errstate(divide='ignore', invalid='ignore'):
+            idle_mean = np.where(idle_counts > 0, self.segment_sum(self.idle) / np.maximum(idle_counts, 1), np.nan)
+            utilization = np.where(span_minutes > 0, ride_minutes / span_minutes, np.nan)
+
+        return pd.DataFrame({'trips' : counts,
+                             'first' : self.times[starts].astype('datetime64[ns]'),
+                             'last' : self.times[lasts].astype('datetime64[ns]'),
+                             'ride_minutes' : ride_minutes.astype(np.float32),
+                             'idle_mean' : idle_mean.astype(np.float32),
+                             'idle_max' : idle_max,
+                             'hops' : self.segment_sum(self.checkouts != self.checkins).astype(np.int64),
+                             'relocations' : self.segment_sum(self.relocated).astype(np.int64),
+                             'stations' : stations,
+                             'minutes_since_last' : self.time_since_last_trip(datetime).values,
+                             'utilization' : utilization.astype(np.float32)},
+                            index=pd.Index(self.bike_ids, name='bike_id'),
+                            columns=['trips', 'first', 'last', 'ride_minutes', 'idle_mean', 'idle_max', 'hops',
+                                     'relocations', 'stations', 'minutes_since_last', 'utilization'])
+
+    @profiled
+    def daily_utilization(self):
+        '''
+        Totals the minutes each bike was out on trips each day. Trips crossing midnight are
+        split between the days
+        RETURNS: Dataframe indexed by (date, bike_id) with trips (started that day), minutes
+                 and utilization (fraction of the day riding), for the days each bike was used
+        '''
+        first_day = self.times // DAY_NS
+        counts = np.maximum((self.ends - 1) // DAY_NS - first_day + 1, 1)
+
+        # One row per (trip, day) it overlaps
+        rows = np.repeat(np.arange(len(self.times)), counts)
+        days = first_day[rows] + np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        overlap = np.minimum(self.ends[rows], (days + 1) * DAY_NS) - np.maximum(self.times[rows], days * DAY_NS)
+        starts_day = days == first_day[rows]
+
+        # Group on (day, bike row), rows are in bike_id order
+        n_bikes = max(len(self.bike_ids), 1)
+        groups, inverse = np.unique(days * n_bikes + self.trip_bikes[rows], return_inverse=True)
+        inverse = inverse.ravel()
+        minutes = np.bincount(inverse, weights=np.maximum(overlap, 0), minlength=len(groups)) / MINUTE_NS
+
+        index = pd.MultiIndex.from_arrays([((groups // n_bikes) * DAY_NS).astype('datetime64[ns]'),
+                                           self.bike_ids[groups % n_bikes]],
+                                          names=['date', 'bike_id'])
+        return pd.DataFrame({'trips' : np.bincount(inverse, weights=starts_day, minlength=len(groups)).astype(np.int64),
+                             'minutes' : minutes.astype(np.float32),
+                             'utilization' : (minutes / DAY_MINUTES).astype(np.float32)},
+                            index=index, columns=['trips', 'minutes', 'utilization'])
@@ -0,0 +1,180 @@
+# Columnar cache for the typed dataframes returned by the BCycle loaders
+import hashlib
+import json
+import os
+import shutil
+
+import pandas as pd
+import numpy as np
+
+from .profiling import stage
+
+CACHE_SUBDIR = 'cache'
+META_FILE = 'meta.json'
+
+
+def find_source(file):
+    '''
+    Finds the file to read for a CSV, falling back to the zipped copy in git
+    INPUT: file - CSV filename
+    RETURNS: `file` if it exists, otherwise `file`.zip if that exists
+    '''
+    if not os.path.exists(file) and os.path.exists(file + '.zip'):
+        return file + '.zip'
+    if not os.path.exists(file):
+        raise OSError('Error opening {0}, and no {0}.zip found'.format(file))
+    return file
+
+
+def read_csv_source(file, **kwargs):
+    '''Reads a CSV file, or the CSV inside its .zip if the CSV hasn't been unzipped'''
+    path = find_source(file)
+    if path.endswith('.zip'):
+        kwargs['compression'] = 'zip'
+    return pd.read_csv(path, **kwargs)
+
+
+def source_key(path, version, hash_source=False):
+    '''
+    Creates the key a cache entry is valid for
+    INPUT: path - source file the frames were parsed from
+           version - loader version string
+           hash_source - if True, use a SHA1 of the file contents instead of the mtime
+    RETURNS: Dictionary which changes when the file or loader changes
+    '''
+    stat = os.stat(path)
+    key = {'path' : os.path.abspath(path),
+           'size' : stat.st_size,
+           'version' : version}
+    if hash_source:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        key['sha1'] = sha1.hexdigest()
+    else:
+        key['mtime_ns'] = stat.st_mtime_ns
+    return key
+
+
+def save_frame(df, frame_dir):
+    '''
+    Saves a dataframe as one .npy file per column, with a JSON description
+    INPUT: df - dataframe to save. Columns must be numeric, datetime, category or strings
+           frame_dir - directory to write files into
+    RETURNS: Nothing
+    '''
+    os.makedirs(frame_dir)
+    columns = list()
+    arrays = [(col, df[col]) for col in df.columns]
+    if not isinstance(df.index, pd.RangeIndex):
+        arrays.append((None, pd.Series(df.index.values, name=df.index.name)))
+
+    for idx, (col, series) in enumerate(arrays):
+        col_info = {'name' : col if col is not None else series.name,
+                    'index' : col is None,
+                    'file' : 'col_{:03d}.npy'.format(idx),
+                    'kind' : 'values'}
+        values = series.values
+        if str(series.dtype) == 'category':
+            col_info['kind'] = 'category'
+            col_info['categories'] = [str(cat) for cat in series.cat.categories]
+            values = series.cat.codes.values
+        elif series.dtype == object or not isinstance(values, np.ndarray):
+            # Store strings as fixed-width unicode so they can be memory-mapped
+            col_info['kind'] = 'str'
+            nulls = series.isnull().values
+            if nulls.any():
+                col_info['nulls'] = 'null_{:03d}.npy'.format(idx)
+                np.save(os.path.join(frame_dir, col_info['nulls']), nulls)
+            values = np.asarray(series.fillna(''), dtype=str)
+        np.save(os.path.join(frame_dir, col_info['file']), values)
+        columns.append(col_info)
+
+    with open(os.path.join(frame_dir, META_FILE), 'w') as f:
+        json.dump({'columns' : columns}, f)
+
+
+def load_frame(frame_dir, mmap_mode=None):
+    '''
+    Loads a dataframe saved with `save_frame`
+    INPUT: frame_dir - directory containing the frame
+           mmap_mode - passed to np.load, use 'r' to memory-map the column files
+    RETURNS: Pandas dataframe
+    '''
+    with open(os.path.join(frame_dir, META_FILE)) as f:
+        meta = json.load(f)
+
+    data = dict()
+    col_names = list()
+    index = None
+    for col_info in meta['columns']:
+        values = np.load(os.path.join(frame_dir, col_info['file']), mmap_mode=mmap_mode)
+        if col_info['kind'] == 'category':
+            values = pd.Categorical.from_codes(values, col_info['categories'])
+        elif col_info['kind'] == 'str':
+            values = values.astype(object)
+            if 'nulls' in col_info:
+                values[np.load(os.path.join(frame_dir, col_info['nulls']))] = np.nan
+
+        if col_info['index']:
+            index = pd.Index(values, name=col_info['name'])
+        else:
+            data[col_info['name']] = values
+            col_names.append(col_info['name'])
+
+    return pd.DataFrame(data, columns=col_names, index=index)
+
+
+def cached_frames(loader, version, sources, parse, use_cache=True, cache_dir=None,
+                  hash_source=False, mmap_mode=None):
+    '''
+    Returns the dataframes parsed from source files, using a columnar cache when valid
+    INPUT: loader - name of the loader, used to name the cache entry
+           version - loader version string. Change it when the parsed output changes
+           sources - list of CSV filenames. Missing CSVs are read from their .zip
+           parse - function called with the resolved source paths, returning a tuple of dataframes
+           use_cache - if False, always parse the sources and don't write a cache entry
+           cache_dir - directory to store entries (defaults to `cache` next to the first source)
+           hash_source - key entries on file contents rather than modification time
+           mmap_mode - passed to np.load when reading an entry
+    RETURNS: Tuple of dataframes returned by `parse`
+    '''
+    paths = [find_source(file) for file in sources]
+    if not use_cache:
+        with stage('parse') as parse_stage:
+            return parse_stage.frame(parse(*paths))
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(paths[0]), CACHE_SUBDIR)
+    entry_name = '-'.join([loader] + [os.path.basename(file) for file in sources])
+    entry_dir = os.path.join(cache_dir, entry_name)
+    key = [source_key(path, version, hash_source) for path in paths]
+
+    # Use the cache entry if it was built from the same files by the same loader version
+    key_file = os.path.join(entry_dir, 'key.json')
+    if os.path.exists(key_file):
+        with open(key_file) as f:
+            if json.load(f) == key:
+                num_frames = len([d for d in os.listdir(entry_dir) if d.startswith('frame_')])
+                with stage('cache_read') as read_stage:
+                    return read_stage.frame(tuple(load_frame(os.path.join(entry_dir, 'frame_{}'.format(idx)),
+                                                             mmap_mode)
+                                                  for idx in range(num_frames)))
+
+    with stage('parse') as parse_stage:
+        frames = parse_stage.frame(parse(*paths))
+
+    # Write to a temporary directory first so a half-written entry is never used
+    with stage('cache_write'):
+        tmp_dir = entry_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for idx, df in enumerate(frames):
+            save_frame(df, os.path.join(tmp_dir, 'frame_{}'.format(idx)))
+        with open(os.path.join(tmp_dir, 'key.json'), 'w') as f:
+            json.dump(key, f)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+
+    return frames
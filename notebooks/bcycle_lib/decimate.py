@@ -0,0 +1,84 @@
+# Shape-preserving downsampling of long series, so plots only draw the points that can be seen
+import pandas as pd
+import numpy as np
+
+# Points kept per column by default, a few per horizontal pixel of a large figure
+MAX_POINTS = 2000
+
+METHODS = ('minmax', 'lttb')
+
+
+def minmax_indices(y, n_bins):
+    '''
+    Picks the minimum and maximum of each of n_bins equal bins, which keeps every peak and trough
+    INPUT: y - float array
+           n_bins - number of bins, about half the points to keep
+    RETURNS: Sorted int64 array of the rows to keep, including the first and last
+    '''
+    n_rows = len(y)
+    if n_rows <= 2 * n_bins:
+        return np.arange(n_rows)
+    bin_size = -(-n_rows // n_bins)
+    padded = np.full(n_bins * bin_size, np.nan)
+    padded[:n_rows] = y
+    padded = padded.reshape(n_bins, bin_size)
+
+    # NaNs are never picked unless a whole bin is NaN
+    starts = np.arange(n_bins) * bin_size
+    mins = starts + np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+    maxs = starts + np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+    rows = np.unique(np.concatenate(([0, n_rows - 1], mins, maxs)))
+    return rows[rows < n_rows]
+
+
+def lttb_indices(x, y, n_out):
+    '''
+    Picks points with the Largest-Triangle-Three-Buckets algorithm. The middle points are split
+    into n_out - 2 buckets, and each bucket keeps the point making the largest triangle with the
+    point kept from the previous bucket and the mean of the next bucket
+    INPUT: x, y - float arrays, x sorted
+           n_out - number of points to keep
+    RETURNS: Sorted int64 array of the rows to keep, including the first and last
+    '''
+    n_rows = len(y)
+    if n_out >= n_rows or n_out < 3:
+        return np.arange(n_rows)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.append(np.linspace(1, n_rows - 1, n_out - 1).astype(np.int64), n_rows)
+
+    rows = np.zeros(n_out, dtype=np.int64)
+    rows[-1] = n_rows - 1
+    prev = 0
+    for bucket in range(n_out - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        next_x = np.nanmean(x[hi:edges[bucket + 2]])
+        next_y = np.nanmean(y[hi:edges[bucket + 2]])
+        areas = np.abs((x[prev] - next_x) * (y[lo:hi] - y[prev]) - (x[prev] - x[lo:hi]) * (next_y - y[prev]))
+        prev = lo + (np.nanargmax(areas) if not np.isnan(areas).all() else 0)
+        rows[bucket + 1] = prev
+    return rows
+
+
+def decimate_frame(df, max_points=MAX_POINTS, method='minmax'):
+    '''
+    Downsamples a dataframe (or series) of line plot data to the rows needed to draw it
+    INPUT: df - dataframe with a numeric or datetime index, sorted
+           max_points - about the number of points kept per column
+           method - 'minmax' to keep each bin's extremes, or 'lttb' (see `lttb_indices`)
+    RETURNS: Dataframe with the rows kept for any column, in their original order
+    '''
+    assert method in METHODS, 'method must be one of {}'.format(METHODS)
+    if len(df) <= max_points:
+        return df
+    frame = df.to_frame() if isinstance(df, pd.Series) else df
+    if method == 'lttb':
+        index = frame.index.values
+        if index.dtype.kind == 'M':
+            x = index.view(np.int64)
+        else:
+            x = index if index.dtype.kind in 'iuf' else np.arange(len(index))
+        picks = [lttb_indices(x, frame[col].values, max_points) for col in frame.columns]
+    else:
+        picks = [minmax_indices(frame[col].values.astype(np.float64), max_points // 2) for col in frame.columns]
+    return df.iloc[np.unique(np.concatenate(picks))]
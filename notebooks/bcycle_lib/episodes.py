@@ -0,0 +1,208 @@
+# Empty and full station episodes, found by run-length encoding the bike snapshots
+import pandas as pd
+import numpy as np
+
+from .occupancy import datetimes_ns
+from .profiling import profiled
+
+# Snapshot states. A station with no bikes and no docks (e.g. offline) counts as empty
+NORMAL = 0
+EMPTY = 1
+FULL = 2
+KINDS = ['normal', 'empty', 'full']
+
+MINUTE_NS = 60 * 10**9
+EPISODE_COLS = ['station_id', 'start', 'end', 'duration', 'kind', 'open']
+
+
+def snapshot_states(bikes, docks):
+    '''Returns the int8 state of each snapshot: EMPTY if bikes == 0, FULL if docks == 0, else NORMAL'''
+    bikes = np.asarray(bikes)
+    docks = np.asarray(docks)
+    return np.where(bikes <= 0, EMPTY, np.where(docks <= 0, FULL, NORMAL)).astype(np.int8)
+
+
+def encode_runs(station_ids, states):
+    '''
+    Run-length encodes the states of snapshots sorted by (station_id, time)
+    RETURNS: Tuple of (first row, row after the last) int64 arrays, one entry per run
+    '''
+    n_rows = len(states)
+    new_run = np.ones(n_rows, dtype=bool)
+    new_run[1:] = (station_ids[1:] != station_ids[:-1]) | (states[1:] != states[:-1])
+    starts = np.flatnonzero(new_run)
+    ends = np.append(starts[1:], n_rows) if n_rows else starts
+    return starts, ends
+
+
+def runs_to_episodes(station_ids, times, states, start_times=None):
+    '''
+    Finds the empty and full episodes in snapshots sorted by (station_id, time)
+    INPUT: station_ids - int64 array of station_id values
+           times - int64 ns array of snapshot times
+           states - int8 array from `snapshot_states`
+           start_times - optional int64 ns array used as the start of a run beginning at each
+                         row, instead of `times`. Used to continue episodes between batches
+    RETURNS: Dataframe with EPISODE_COLS. An episode ends at the first snapshot which isn't
+             in it, or is `open` and ends at the station's last snapshot if it hasn't finished
+    '''
+    start_times = times if start_times is None else start_times
+    starts, ends = encode_runs(station_ids, states)
+    n_rows = len(states)
+
+    next_rows = np.minimum(ends, n_rows - 1)
+    closed = (ends < n_rows) & (station_ids[next_rows] == station_ids[starts])
+    end_times = np.where(closed, times[next_rows], times[ends - 1])
+
+    episode = states[starts] != NORMAL
+    starts = starts[episode]
+    closed = closed[episode]
+    end_times = end_times[episode]
+    begin_times = start_times[starts]
+    return pd.DataFrame({'station_id' : station_ids[starts].astype(np.int64),
+                         'start' : begin_times.astype('datetime64[ns]'),
+                         'end' : end_times.astype('datetime64[ns]'),
+                         'duration' : ((end_times - begin_times) / MINUTE_NS).astype(np.float32),
+                         'kind' : pd.Categorical.from_codes(states[starts], KINDS),
+                         'open' : ~closed},
+                        columns=EPISODE_COLS)
+
+
+@profiled
+def find_episodes(bikes_df):
+    '''
+    Finds every empty and full episode in the station snapshots
+    INPUT: bikes_df - dataframe from `load_bikes` with station_id, datetime, bikes and docks
+    RETURNS: Dataframe with station_id, start, end, duration (minutes), kind (empty or full)
+             and open (the episode was still going at the station's last snapshot)
+    '''
+    station_ids = bikes_df['station_id'].values.astype(np.int64)
+    times = datetimes_ns(bikes_df['datetime'].values)
+    order = np.lexsort((times, station_ids))
+    return runs_to_episodes(station_ids[order], times[order],
+                            snapshot_states(bikes_df['bikes'].values[order], bikes_df['docks'].values[order]))
+
+
+@profiled
+def store_episodes(store):
+    '''Finds every empty and full episode in an `OccupancyStore`, see `find_episodes`'''
+    station_ids = np.repeat(store.station_ids.astype(np.int64), np.diff(store.offsets))
+    return runs_to_episodes(station_ids, np.asarray(store.times),
+                            snapshot_states(store.bikes, store.docks))
+
+
+@profiled
+def downtime(episodes_df, freq='1h'):
+    '''
+    Totals the minutes each station spent empty and full in each period. Episodes crossing
+    a period boundary are split between the periods
+    INPUT: episodes_df - dataframe from `find_episodes`
+           freq - period length, e.g. '1h' for hourly or '1D' for daily downtime
+    RETURNS: Dataframe indexed by (datetime, station_id) with empty and full minutes,
+             containing only periods with some downtime
+    '''
+    period_ns = pd.Timedelta(freq).value
+    starts = datetimes_ns(episodes_df['start'].values)
+    ends = datetimes_ns(episodes_df['end'].values)
+    first = starts // period_ns
+    counts = (ends - 1) // period_ns - first + 1
+    counts = np.maximum(counts, 0)
+
+    # One row per (episode, period) it overlaps
+    rows = np.repeat(np.arange(len(starts)), counts)
+    periods = first[rows] + np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    overlap = np.minimum(ends[rows], (periods + 1) * period_ns) - np.maximum(starts[rows], periods * period_ns)
+
+    # Group on (period, station_id), packed with a multiplier larger than every station_id
+    station_ids = episodes_df['station_id'].values.astype(np.int64)[rows]
+    n_keys = int(station_ids.max()) + 1 if len(station_ids) else 1
+    groups, inverse = np.unique(periods * n_keys + station_ids, return_inverse=True)
+    inverse = inverse.ravel()
+    kinds = episodes_df['kind'].cat.codes.values[rows]
+
+    index = pd.MultiIndex.from_arrays([((groups // n_keys) * period_ns).astype('datetime64[ns]'),
+                                       (groups % n_keys).astype(episodes_df['station_id'].dtype)],
+                                      names=['datetime', 'station_id'])
+    df = pd.DataFrame(index=index)
+    for kind in (EMPTY, FULL):
+        df[KINDS[kind]] = (np.bincount(inverse, weights=overlap * (kinds == kind), minlength=len(groups))
+                           / MINUTE_NS).astype(np.float32)
+    return df
+
+
+class EpisodeTracker(object):
+    '''
+    Streaming episode detector. Feed it batches of new snapshots with `update`, which returns
+    the episodes that finished. Episodes still going are kept between batches, see `open_episodes`
+    '''
+
+    def __init__(self):
+        self.station_ids = np.zeros(0, dtype=np.int64)
+        self.last_times = np.zeros(0, dtype=np.int64)
+        self.last_states = np.zeros(0, dtype=np.int8)
+        self.run_starts = np.zeros(0, dtype=np.int64)
+
+    def update(self, bikes_df):
+        '''
+        Adds a batch of snapshots. Snapshots not newer than a station's last one are ignored
+        INPUT: bikes_df - dataframe with station_id, datetime, bikes and docks columns
+        RETURNS: Dataframe of the episodes which finished in this batch, see `find_episodes`
+        '''
+        station_ids = bikes_df['station_id'].values.astype(np.int64)
+        times = datetimes_ns(bikes_df['datetime'].values)
+        states = snapshot_states(bikes_df['bikes'].values, bikes_df['docks'].values)
+
+        # Drop snapshots older than the station's last one
+        newer = np.ones(len(station_ids), dtype=bool)
+        if len(self.station_ids):
+            carry_rows = np.minimum(np.searchsorted(self.station_ids, station_ids), len(self.station_ids) - 1)
+            known = self.station_ids[carry_rows] == station_ids
+            newer = ~known | (times > self.last_times[carry_rows])
+        station_ids, times, states = station_ids[newer], times[newer], states[newer]
+        if not len(station_ids):
+            return runs_to_episodes(station_ids, times, states)
+
+        # Start each station in the batch with its last snapshot from the previous batch, so runs
+        # continue across batches with their original start time
+        carried = np.isin(self.station_ids, station_ids)
+        all_ids = np.concatenate((self.station_ids[carried], station_ids))
+        all_times = np.concatenate((self.last_times[carried], times))
+        all_states = np.concatenate((self.last_states[carried], states))
+        start_times = np.concatenate((self.run_starts[carried], times))
+        order = np.lexsort((all_times, all_ids))
+        all_ids, all_times = all_ids[order], all_times[order]
+        all_states, start_times = all_states[order], start_times[order]
+
+        episodes_df = runs_to_episodes(all_ids, all_times, all_states, start_times)
+
+        # Remember each station's last snapshot and the start time of its current run
+        run_firsts, _ = encode_runs(all_ids, all_states)
+        run_of_row = np.repeat(np.arange(len(run_firsts)), np.diff(np.append(run_firsts, len(all_ids))))
+        last = np.append(all_ids[1:] != all_ids[:-1], True)
+        self.merge_carry(all_ids[last], all_times[last], all_states[last],
+                         start_times[run_firsts[run_of_row[last]]])
+
+        closed_df = episodes_df[~episodes_df['open'].values]
+        return closed_df.reset_index(drop=True)
+
+    def merge_carry(self, station_ids, last_times, last_states, run_starts):
+        '''Replaces the last snapshot of the stations in a batch, keeping the others'''
+        keep = ~np.isin(self.station_ids, station_ids)
+        all_ids = np.concatenate((self.station_ids[keep], station_ids))
+        order = np.argsort(all_ids, kind='mergesort')
+        self.station_ids = all_ids[order]
+        self.last_times = np.concatenate((self.last_times[keep], last_times))[order]
+        self.last_states = np.concatenate((self.last_states[keep], last_states))[order]
+        self.run_starts = np.concatenate((self.run_starts[keep], run_starts))[order]
+
+    def open_episodes(self):
+        '''Returns the episodes still going, ending at each station's latest snapshot'''
+        episode = self.last_states != NORMAL
+        return pd.DataFrame({'station_id' : self.station_ids[episode],
+                             'start' : self.run_starts[episode].astype('datetime64[ns]'),
+                             'end' : self.last_times[episode].astype('datetime64[ns]'),
+                             'duration' : ((self.last_times[episode] - self.run_starts[episode])
+                                           / MINUTE_NS).astype(np.float32),
+                             'kind' : pd.Categorical.from_codes(self.last_states[episode], KINDS),
+                             'open' : np.ones(episode.sum(), dtype=bool)},
+                            columns=EPISODE_COLS)
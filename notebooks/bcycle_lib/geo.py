@@ -0,0 +1,99 @@
+# Station distance matrix and spatial queries for the BCycle analysis
+import pandas as pd
+import numpy as np
+
+from .utils import haversine_dist
+
+EARTH_RADIUS = 3961 # miles, same default as `haversine_dist`
+
+
+class StationGeoIndex(object):
+    '''
+    Precomputed station-to-station distances, with nearest-neighbour and radius queries
+    INPUT: stations_df - dataframe with station_id, lat and lon columns
+           R - radius of the planet, distances are returned in the same units
+    '''
+
+    def __init__(self, stations_df, R=EARTH_RADIUS):
+        self.R = R
+        self.station_ids = stations_df['station_id'].values
+        self.lat = stations_df['lat'].values.astype(np.float64)
+        self.lon = stations_df['lon'].values.astype(np.float64)
+
+        # Map station_id values to matrix rows, -1 for unknown ids
+        self.rows = np.full(int(self.station_ids.max()) + 1, -1, dtype=np.int32)
+        self.rows[self.station_ids] = np.arange(len(self.station_ids))
+
+        # All pairwise distances in one broadcast call
+        self.dist = haversine_dist(self.lat[:, np.newaxis], self.lon[:, np.newaxis],
+                                   self.lat[np.newaxis, :], self.lon[np.newaxis, :], R).astype(np.float32)
+
+        # Built by the first nearest() or within() query, so distances don't need sklearn
+        self._tree = None
+
+    @property
+    def tree(self):
+        '''BallTree of the station positions, using the haversine metric'''
+        if self._tree is None:
+            from sklearn.neighbors import BallTree
+            # The haversine BallTree works in radians, on a unit sphere
+            self._tree = BallTree(np.radians(np.column_stack((self.lat, self.lon))), metric='haversine')
+        return self._tree
+
+    def station_rows(self, station_ids):
+        '''Returns the matrix row for each station_id, or -1 if it isn't in the index'''
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        rows = np.full(station_ids.shape, -1, dtype=np.int32)
+        valid = (station_ids >= 0) & (station_ids < len(self.rows))
+        rows[valid] = self.rows[station_ids[valid]]
+        return rows
+
+    def distance(self, src_ids, dst_ids):
+        '''
+        Looks up distances between pairs of stations with a single gather
+        INPUT: src_ids, dst_ids - arrays of station_id values
+        RETURNS: float32 array of distances, NaN where either station isn't in the index
+        '''
+        src_rows = self.station_rows(src_ids)
+        dst_rows = self.station_rows(dst_ids)
+        dists = self.dist[src_rows, dst_rows]
+        dists[(src_rows < 0) | (dst_rows < 0)] = np.nan
+        return dists
+
+    def nearest(self, lat, lon, k=1):
+        '''
+        Finds the k nearest stations to each position
+        INPUT: lat, lon - scalars or arrays of positions
+               k - number of stations to return for each position
+        RETURNS: Tuple of (station_ids, distances), each with shape (positions, k)
+        '''
+        points = np.radians(np.column_stack((np.atleast_1d(lat), np.atleast_1d(lon))))
+        dists, rows = self.tree.query(points, k=k)
+        return self.station_ids[rows], (dists * self.R).astype(np.float32)
+
+    def within(self, lat, lon, radius):
+        '''
+        Finds all stations within a radius of each position
+        INPUT: lat, lon - scalars or arrays of positions
+               radius - distance in the units of R (miles by default)
+        RETURNS: List with an array of station_ids for each position, nearest first
+        '''
+        points = np.radians(np.column_stack((np.atleast_1d(lat), np.atleast_1d(lon))))
+        rows = self.tree.query_radius(points, r=radius / float(self.R),
+                                      return_distance=True, sort_results=True)[0]
+        return [self.station_ids[row] for row in rows]
+
+    def add_trip_distance(self, trips_df, col='distance'):
+        '''
+        Adds the distance between checkout and checkin stations to every trip
+        INPUT: trips_df - trips dataframe with checkout_id and checkin_id columns
+               col - name of the new column
+        RETURNS: trips_df with the distance column added
+        '''
+        trips_df[col] = self.distance(trips_df['checkout_id'].values, trips_df['checkin_id'].values)
+        return trips_df
+
+    def to_frame(self):
+        '''Returns the distance matrix as a dataframe indexed by station_id on both axes'''
+        return pd.DataFrame(self.dist, index=pd.Index(self.station_ids, name='station_id'),
+                            columns=self.station_ids)
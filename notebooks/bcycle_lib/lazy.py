@@ -0,0 +1,22 @@
+# Deferred imports, so modules with heavy dependencies are only loaded when they're used
+import importlib
+
+
+def lazy_function(module_name, func_name, package=None):
+    '''
+    Creates a stand-in for a function in another module, which imports the module on its first call
+    INPUT: module_name - module containing the function, relative names need `package`
+           func_name - name of the function in the module
+           package - package to resolve a relative module_name against
+    RETURNS: Function calling module_name.func_name with the same arguments
+    '''
+    target = list()
+
+    def wrapper(*args, **kwargs):
+        if not target:
+            target.append(getattr(importlib.import_module(module_name, package), func_name))
+        return target[0](*args, **kwargs)
+
+    wrapper.__name__ = func_name
+    wrapper.__doc__ = 'Imports {} and calls its {}()'.format(module_name.lstrip('.'), func_name)
+    return wrapper
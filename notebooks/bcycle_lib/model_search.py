@@ -0,0 +1,188 @@
+# Parallel time-series cross-validation and hyperparameter search for the rental models
+import hashlib
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import pandas as pd
+import numpy as np
+
+SEARCH_DIR = 'model_search'
+
+# Feature arrays opened read-only by each worker process, see `init_worker`
+worker_data = dict()
+
+
+def array_hash(*arrays):
+    '''Returns a SHA1 of the arrays' contents, used to tell feature matrices apart'''
+    sha1 = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        sha1.update(str((array.dtype, array.shape)).encode())
+        sha1.update(array.data)
+    return sha1.hexdigest()
+
+
+def describe(value):
+    '''
+    Describes a configuration value as JSON-able data which is the same on every run.
+    Estimators become their class name and (recursively) their get_params, arrays their
+    hash, and other objects their class name, never a repr holding a memory address
+    '''
+    if hasattr(value, 'get_params') and not isinstance(value, type):
+        return {'class' : type(value).__module__ + '.' + type(value).__qualname__,
+                'params' : describe(value.get_params(deep=False))}
+    if isinstance(value, dict):
+        return {str(key) : describe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [describe(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return {'array' : array_hash(value)}
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if callable(value) and hasattr(value, '__qualname__'):
+        return {'function' : getattr(value, '__module__', '') + '.' + value.__qualname__}
+    return {'class' : type(value).__module__ + '.' + type(value).__qualname__}
+
+
+def config_hash(config):
+    '''Returns a SHA1 of a configuration dictionary, see `describe`'''
+    return hashlib.sha1(json.dumps(describe(config), sort_keys=True).encode()).hexdigest()
+
+
+def save_array(file, array):
+    '''Saves an array with np.save under a temporary name and renames it, so a crash never
+    leaves a partial file under the final name'''
+    tmp_file = file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_file, file)
+
+
+def init_worker(X_file, y_file):
+    '''Memory-maps the feature matrix and targets in a worker, instead of pickling them per task'''
+    worker_data['X'] = np.load(X_file, mmap_mode='r')
+    worker_data['y'] = np.load(y_file, mmap_mode='r')
+
+
+def run_fold(task):
+    '''
+    Fits and scores one model configuration on one fold, in a worker process
+    INPUT: task - dictionary with the estimator, params, train and val (start, stop) rows,
+                  and the result_file to write
+    RETURNS: Result dictionary, also saved as JSON to result_file
+    '''
+    from sklearn.base import clone
+
+    X = worker_data['X']
+    y = worker_data['y']
+    train = slice(*task['train'])
+    val = slice(*task['val'])
+
+    model = clone(task['estimator']).set_params(**task['params'])
+    start = time.time()
+    model.fit(X[train], y[train])
+    fit_seconds = time.time() - start
+
+    result = {'model' : task['model'],
+              'params' : task['params'],
+              'fold' : task['fold'],
+              'train_rmse' : float(np.sqrt(np.mean((model.predict(X[train]) - y[train]) ** 2))),
+              'val_rmse' : float(np.sqrt(np.mean((model.predict(X[val]) - y[val]) ** 2))),
+              'fit_seconds' : fit_seconds,
+              'seconds' : time.time() - start}
+
+    tmp_file = task['result_file'] + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(result, f, default=repr)
+    os.replace(tmp_file, task['result_file'])
+    return result
+
+
+def search_models(X, y, models, n_splits=5, search_dir=SEARCH_DIR, processes=None, verbose=False):
+    '''
+    Runs every model and hyperparameter combination on each time-series fold in a process pool.
+    Results are saved per configuration, so a rerun only fits configurations not already done
+    INPUT: X, y - dense feature matrix and targets in time order, e.g. from a `FeaturePipeline`
+                  fitted once on the whole dataframe
+           models - dictionary of name -> (sklearn estimator, parameter grid dictionary)
+           n_splits - number of TimeSeriesSplit folds
+           search_dir - directory for the shared feature arrays and the result cache
+           processes - number of worker processes (defaults to the number of CPUs)
+           verbose - print out each result as it finishes
+    RETURNS: Tuple of (results dataframe with a row for each model, params and fold,
+             summary dataframe with the best parameters and timings of each model)
+    '''
+    from sklearn.model_selection import ParameterGrid, TimeSeriesSplit
+
+    assert isinstance(X, np.ndarray), 'X must be a dense numpy array to be memory-mapped'
+    data_hash = array_hash(X, y)
+    result_dir = os.path.join(search_dir, 'results')
+    if not os.path.exists(result_dir):
+        os.makedirs(result_dir)
+
+    # Save the arrays once, workers memory-map them read-only
+    X_file = os.path.join(search_dir, 'X_{}.npy'.format(data_hash))
+    y_file = os.path.join(search_dir, 'y_{}.npy'.format(data_hash))
+    for file, array in ((X_file, X), (y_file, y)):
+        if not os.path.exists(file):
+            save_array(file, array)
+
+    folds = [((int(train[0]), int(train[-1]) + 1), (int(val[0]), int(val[-1]) + 1))
+             for train, val in TimeSeriesSplit(n_splits=n_splits).split(X)]
+
+    results = list()
+    tasks = list()
+    for name, (estimator, param_grid) in models.items():
+        for params in ParameterGrid(param_grid):
+            for fold, (train, val) in enumerate(folds):
+                config = {'data' : data_hash,
+                          'estimator' : estimator,
+                          'params' : params,
+                          'train' : train,
+                          'val' : val}
+                result_file = os.path.join(result_dir, config_hash(config) + '.json')
+                if os.path.exists(result_file):
+                    with open(result_file) as f:
+                        result = json.load(f)
+                    result['model'] = name
+                    results.append(result)
+                else:
+                    tasks.append({'model' : name, 'estimator' : estimator, 'params' : params,
+                                  'fold' : fold, 'train' : train, 'val' : val,
+                                  'result_file' : result_file})
+
+    if verbose:
+        print('Running {} fits, {} already cached'.format(len(tasks), len(results)))
+
+    start = time.time()
+    if tasks:
+        with Pool(processes, initializer=init_worker, initargs=(X_file, y_file)) as pool:
+            for result in pool.imap_unordered(run_fold, tasks):
+                if verbose:
+                    print('{} {} fold {}: val RMSE {:.2f} ({:.1f}s)'.format(
+                        result['model'], result['params'], result['fold'],
+                        result['val_rmse'], result['seconds']))
+                results.append(result)
+    if verbose:
+        print('Search took {:.1f}s'.format(time.time() - start))
+
+    results_df = pd.DataFrame(results)
+    results_df['params'] = results_df['params'].apply(lambda params: json.dumps(params, sort_keys=True))
+    return results_df, summarize_search(results_df)
+
+
+def summarize_search(results_df):
+    '''
+    Summarizes search results by model
+    INPUT: results_df - results dataframe from `search_models`
+    RETURNS: Dataframe indexed by model with the best params, their mean train and val
+             RMSE across folds, and the total seconds spent on all of the model's fits
+    '''
+    by_params = results_df.groupby(['model', 'params'])[['train_rmse', 'val_rmse']].mean().reset_index()
+    best = by_params.loc[by_params.groupby('model')['val_rmse'].idxmin()].set_index('model')
+    best['seconds'] = results_df.groupby('model')['seconds'].sum()
+    return best.sort_values('val_rmse')
@@ -0,0 +1,187 @@
+# Per-station bike and dock occupancy store, with point-in-time and range queries
+import json
+import os
+import shutil
+
+import pandas as pd
+import numpy as np
+
+META_FILE = 'occupancy.json'
+ARRAYS = ('station_ids', 'offsets', 'times', 'bikes', 'docks')
+
+# Value returned for bikes and docks before a station's first snapshot
+MISSING = -1
+
+
+def datetimes_ns(datetimes):
+    '''Converts datetimes to int64 nanoseconds since the epoch'''
+    return np.asarray(datetimes, dtype='datetime64[ns]').view(np.int64)
+
+
+def segment_searchsorted(times, lo, hi, query_times):
+    '''
+    Binary searches many sorted segments of one array at once
+    INPUT: times - int64 array, sorted within each segment
+           lo, hi - int64 arrays of segment start and end rows, one per query
+           query_times - int64 array of times to search for
+    RETURNS: int64 array with the row of the last time <= each query time, or lo - 1 if
+             the query is before the segment's first time
+    '''
+    lo = np.array(lo, dtype=np.int64)
+    hi = np.array(hi, dtype=np.int64)
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        right = np.zeros(len(lo), dtype=bool)
+        right[active] = times[mid[active]] <= query_times[active]
+        lo = np.where(active & right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+        active = lo < hi
+    return lo - 1
+
+
+class OccupancyStore(object):
+    '''
+    Bike and dock counts from the station snapshots, stored per station. The snapshots of
+    station_ids[i] are rows offsets[i] to offsets[i + 1] of the times (int64 ns, sorted),
+    bikes and docks (signed integer, int8 unless wider counts need more) arrays. Use `save` and `load` with mmap_mode='r' to share one
+    copy of the arrays between processes
+    '''
+
+    def __init__(self, station_ids, offsets, times, bikes, docks):
+        self.station_ids = station_ids
+        self.offsets = offsets
+        self.times = times
+        self.bikes = bikes
+        self.docks = docks
+
+        # Map station_id values to their segment, -1 for unknown ids
+        self.rows = np.full(int(station_ids.max()) + 1 if len(station_ids) else 0, -1, dtype=np.int32)
+        self.rows[station_ids] = np.arange(len(station_ids))
+
+    @classmethod
+    def from_bikes(cls, bikes_df):
+        '''
+        Builds the store from snapshots
+        INPUT: bikes_df - dataframe from `load_bikes` with station_id, datetime, bikes and docks
+        RETURNS: OccupancyStore
+        '''
+        station_ids = bikes_df['station_id'].values.astype(np.int64)
+        times = datetimes_ns(bikes_df['datetime'].values)
+        order = np.lexsort((times, station_ids))
+        station_ids = station_ids[order]
+
+        unique_ids, starts = np.unique(station_ids, return_index=True)
+        offsets = np.append(starts, len(station_ids)).astype(np.int64)
+        # Signed, so lookups can return MISSING in the same type
+        bikes = bikes_df['bikes'].values[order]
+        docks = bikes_df['docks'].values[order]
+        count_type = np.result_type(bikes.dtype, docks.dtype, np.int8)
+        return cls(unique_ids, offsets, times[order], bikes.astype(count_type), docks.astype(count_type))
+
+    def station_rows(self, station_ids):
+        '''Returns the segment of each station_id, or -1 if it isn't in the store'''
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        rows = np.full(station_ids.shape, -1, dtype=np.int32)
+        valid = (station_ids >= 0) & (station_ids < len(self.rows))
+        rows[valid] = self.rows[station_ids[valid]]
+        return rows
+
+    def station_slice(self, station_id):
+        '''Returns the slice of the arrays holding a station's snapshots'''
+        row = self.station_rows([station_id])[0]
+        if row < 0:
+            return slice(0, 0)
+        return slice(int(self.offsets[row]), int(self.offsets[row + 1]))
+
+    def lookup(self, station_ids, datetimes):
+        '''
+        Finds the bikes and docks at each station at each time, from the latest snapshot
+        at or before the time
+        INPUT: station_ids - array of station_id values
+               datetimes - array of times, the same length as station_ids
+        RETURNS: Tuple of (bikes, docks) arrays of the store's count type, MISSING where the station is unknown
+                 or the time is before its first snapshot
+        '''
+        rows = self.station_rows(station_ids)
+        known = rows >= 0
+        lo = np.where(known, self.offsets[rows], 0)
+        hi = np.where(known, self.offsets[rows + 1], 0)
+        query_times = np.broadcast_to(datetimes_ns(datetimes), rows.shape)
+        idx = segment_searchsorted(self.times, lo, hi, query_times)
+
+        found = idx >= lo
+        idx = np.where(found, idx, 0)
+        bikes = np.where(found, self.bikes[idx], MISSING).astype(self.bikes.dtype)
+        docks = np.where(found, self.docks[idx], MISSING).astype(self.docks.dtype)
+        return bikes, docks
+
+    def at(self, station_id, datetime):
+        '''Returns (bikes, docks) at a station at a time, or None before its first snapshot'''
+        rows = self.station_slice(station_id)
+        idx = np.searchsorted(self.times[rows], pd.Timestamp(datetime).value, side='right') - 1
+        if idx < 0:
+            return None
+        return int(self.bikes[rows][idx]), int(self.docks[rows][idx])
+
+    def range(self, station_id, start=None, end=None):
+        '''
+        Returns a station's snapshots between two times
+        INPUT: station_id - station to return
+               start, end - optional first and last times to include (inclusive)
+        RETURNS: Dataframe indexed by datetime with bikes and docks columns
+        '''
+        rows = self.station_slice(station_id)
+        times = self.times[rows]
+        lo = 0 if start is None else np.searchsorted(times, pd.Timestamp(start).value, side='left')
+        hi = len(times) if end is None else np.searchsorted(times, pd.Timestamp(end).value, side='right')
+        rows = slice(rows.start + lo, rows.start + hi)
+        return pd.DataFrame({'bikes' : self.bikes[rows], 'docks' : self.docks[rows]},
+                            index=pd.DatetimeIndex(self.times[rows].astype('datetime64[ns]'), name='datetime'),
+                            columns=['bikes', 'docks'])
+
+    def snapshot(self, datetime, max_age=None):
+        '''
+        Returns the bikes and docks at every station at a time
+        INPUT: datetime - time of the snapshot
+               max_age - optional Timedelta. Stations whose latest snapshot is older are left out
+        RETURNS: Dataframe indexed by station_id with bikes, docks and the datetime of each
+                 station's snapshot. Stations without a snapshot by `datetime` are left out
+        '''
+        query_time = pd.Timestamp(datetime).value
+        query_times = np.full(len(self.station_ids), query_time, dtype=np.int64)
+        idx = segment_searchsorted(self.times, self.offsets[:-1], self.offsets[1:], query_times)
+
+        found = idx >= self.offsets[:-1]
+        if max_age is not None:
+            found &= self.times[np.where(found, idx, 0)] >= query_time - pd.Timedelta(max_age).value
+        idx = idx[found]
+        return pd.DataFrame({'bikes' : self.bikes[idx],
+                             'docks' : self.docks[idx],
+                             'datetime' : self.times[idx].astype('datetime64[ns]')},
+                            index=pd.Index(self.station_ids[found], name='station_id'),
+                            columns=['bikes', 'docks', 'datetime'])
+
+    def save(self, store_dir):
+        '''Saves the arrays as .npy files in a directory, replacing any previous store'''
+        tmp_dir = store_dir.rstrip('/') + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp_dir, name + '.npy'), getattr(self, name))
+        with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+            json.dump({'stations' : len(self.station_ids), 'snapshots' : len(self.times)}, f)
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.rename(tmp_dir, store_dir)
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode='r'):
+        '''
+        Loads a store saved with `save`
+        INPUT: store_dir - directory the store was saved to
+               mmap_mode - passed to np.load. The default 'r' memory-maps the arrays read-only,
+                           so processes loading the same store share its pages
+        RETURNS: OccupancyStore
+        '''
+        arrays = [np.load(os.path.join(store_dir, name + '.npy'), mmap_mode=mmap_mode) for name in ARRAYS]
+        return cls(*arrays)
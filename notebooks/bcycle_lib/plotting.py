@@ -0,0 +1,258 @@
+# Plotting functions for the BCycle analysis. Imported on first use by `all_utils`,
+# so the loaders don't need matplotlib or seaborn
+import os
+from multiprocessing import Pool
+
+import pandas as pd
+import numpy as np
+import matplotlib.pyplot as plt
+import seaborn as sns
+
+from .decimate import MAX_POINTS, decimate_frame
+
+
+# Plotting functions
+
+def plot_lines(df, subplots, title, xlabel, ylabel, max_points=None, method='minmax'):
+    '''Generates one or more line plots from pandas dataframe. Pass subplots=None for a new
+    (16, 8) figure, and max_points to downsample long series with `decimate_frame` first'''
+    
+    fig, ax = plt.subplots(1, 1, figsize=(16, 8)) if subplots is None else subplots
+    if max_points is not None:
+        df = decimate_frame(df, max_points, method)
+    ax = df.plot.line(ax=ax)
+    ax.set_xlabel(xlabel, fontdict={'size' : 14})
+    ax.set_ylabel(ylabel, fontdict={'size' : 14})
+    ax.set_title(title, fontdict={'size' : 18}) 
+    ttl = ax.title
+    ttl.set_position([.5, 1.02])
+    ax.tick_params(axis='x', labelsize=14)
+    ax.tick_params(axis='y', labelsize=14)   
+
+    
+def plot_boxplot(df, order, x, y, figsize, title, xlabel, ylabel):
+    '''Plots a boxplot using given '''
+    fig, ax = plt.subplots(1,1, figsize=figsize)  
+    ax = sns.boxplot(data=df, x=x, y=y, order=order)
+    ax.set_xlabel(xlabel, fontdict={'size' : 14})
+    ax.set_ylabel(ylabel, fontdict={'size' : 14})
+    ax.set_title(title, fontdict={'size' : 18})
+    ax.tick_params(axis='x', labelsize=14)
+    ax.tick_params(axis='y', labelsize=14)
+    ttl = ax.title
+    ttl.set_position([.5, 1.02])
+
+
+def plot_bar(df, size, title, xlabel, ylabel):
+    '''Plots a bar graph of the dataframe '''
+    
+    palette = sns.color_palette('Set2', len(df.columns)) # Don't repeat colours
+    fig, ax = plt.subplots(1, 1, figsize=size)
+    ax = df.plot.bar(ax=ax, color=palette, rot=0)
+    ax.set_xlabel(xlabel, fontdict={'size' : 14})
+    ax.set_ylabel(ylabel, fontdict={'size' : 14})
+    ax.set_title(title, fontdict={'size' : 18}) 
+    ttl = ax.title
+    ttl.set_position([.5, 1.02])
+    ax.tick_params(axis='x', labelsize=14)
+    ax.tick_params(axis='y', labelsize=14)   
+    ax.legend(fontsize = 14)
+
+
+def plot_hist(df_col, bins, size, title, xlabel, ylabel):
+    '''Plots a histogram of the dataframe column'''
+    
+    fig, ax = plt.subplots(1, 1, figsize=size)
+    ax = df_col.plot.hist(ax=ax, bins=bins)
+    ax.set_xlabel(xlabel, fontdict={'size' : 14})
+    ax.set_ylabel(ylabel, fontdict={'size' : 14})
+    ax.set_title(title, fontdict={'size' : 18}) 
+    ttl = ax.title
+    ttl.set_position([.5, 1.02])
+    ax.tick_params(axis='x', labelsize=14)
+    ax.tick_params(axis='y', labelsize=14)   
+
+
+# Model evaluation plotting functions
+
+def df_from_results(index_train, y_train, y_train_pred, index_val, y_val, y_val_pred):
+    '''Creates dataframe from results for use in plotting functions below'''
+    train_dict = dict()
+    val_dict = dict()
+
+    train_dict['true'] = y_train
+    train_dict['pred'] = y_train_pred
+
+    val_dict['true'] = y_val
+    val_dict['pred'] = y_val_pred
+
+    train_df = pd.DataFrame(train_dict)
+    val_df = pd.DataFrame(val_dict)
+
+    train_df.index = index_train
+    val_df.index = index_val
+    
+    return train_df, val_df
+    
+   
+
+def plot_val(val_df, pred_col, true_col, title, max_points=None, method='minmax'):
+    '''
+    Plots the validation prediction
+    INPUT: val_df - Validation dataframe
+           pred_col - string with prediction column name
+           true_col - string with actual column name
+           title - Prefix for the plot titles.
+           max_points, method - optionally downsample the series first, see `decimate_frame`
+    RETURNS: Nothing
+    '''
+    def plot_ts(df, pred, true, title, ax):
+        '''Generates one of the subplots to show time series'''
+        if max_points is not None:
+            df = decimate_frame(df[[true, pred]], max_points, method)
+        ax = df.plot(y=[true, pred], ax=ax) # , color='black', style=['--', '-'])
+        ax.set_xlabel('Date', fontdict={'size' : 14})
+        ax.set_ylabel('Rentals', fontdict={'size' : 14})
+        ax.set_title(title, fontdict={'size' : 16}) 
+        ttl = ax.title
+        ttl.set_position([.5, 1.02])
+        ax.legend(['Predicted rentals', 'Actual rentals'], fontsize=14, loc=2)
+        ax.tick_params(axis='x', labelsize=14)
+        ax.tick_params(axis='y', labelsize=14)
+    
+    fig, ax = plt.subplots(1,1, sharey=True, figsize=(16,8))
+    plot_ts(val_df, pred_col, true_col, title + ' (validation set)', ax)
+    
+
+def plot_prediction(train_df, val_df, pred_col, true_col, title, max_points=None, method='minmax'):
+    '''
+    Plots the predicted rentals along with actual rentals for the dataframe
+    INPUT: train_df, val_df - pandas dataframe with training and validataion results
+           pred_col - string with prediction column name
+           true_col - string with actual column name
+           title - Prefix for the plot titles.
+           max_points, method - optionally downsample the daily series, see `decimate_frame`
+    RETURNS: Nothing
+    '''
+    def plot_ts(df, pred, true, title, ax):
+        '''Generates one of the subplots to show time series'''
+        plot_df = df[[pred, true]].resample('1D').sum()
+        if max_points is not None:
+            plot_df = decimate_frame(plot_df, max_points, method)
+        ax = plot_df.plot(y=[pred, true], ax=ax) # , color='black', style=['--', '-'])
+        ax.set_xlabel('', fontdict={'size' : 14})
+        ax.set_ylabel('Rentals', fontdict={'size' : 14})
+        ax.set_title(title, fontdict={'size' : 16}) 
+        ttl = ax.title
+        ttl.set_position([.5, 1.02])
+        ax.legend(['Predicted rentals', 'Actual rentals'], fontsize=14)
+        ax.tick_params(axis='x', labelsize=14)
+        ax.tick_params(axis='y', labelsize=14)   
+    
+    fig, axes = plt.subplots(2,1, sharey=True, figsize=(20,12))
+    plot_ts(train_df, pred_col, true_col, title + ' (training set)', axes[0])
+    plot_ts(val_df, pred_col, true_col, title + ' (validation set)', axes[1])
+    
+def plot_residuals(train_df, val_df, pred_col, true_col, title):
+    '''
+    Plots the residual errors in histogram (between actual and prediction)
+    INPUT: train_df, val_df - pandas dataframe with training and validataion results
+           pred_col - string with prediction column name
+           true_col - string with actual column name
+           title - Prefix for the plot titles.
+    RETURNS: Nothing
+
+    '''
+    def plot_res(df, pred, true, title, ax):
+        '''Generates one of the subplots to show time series'''
+        residuals = df[pred] - df[true]
+        ax = residuals.plot.hist(ax=ax, bins=20)
+        ax.set_xlabel('Residual errors', fontdict={'size' : 14})
+        ax.set_ylabel('Count', fontdict={'size' : 14})
+        ax.set_title(title, fontdict={'size' : 16}) 
+        ttl = ax.title
+        ttl.set_position([.5, 1.02])
+        ax.tick_params(axis='x', labelsize=14)
+        ax.tick_params(axis='y', labelsize=14)   
+    
+    fig, axes = plt.subplots(1,2, sharey=True, sharex=True, figsize=(20,6))
+    plot_res(train_df, pred_col, true_col, title + ' residuals (training set)', axes[0])
+    plot_res(val_df, pred_col, true_col, title + ' residuals (validation set)', axes[1])
+    
+    
+def plot_results(train_df, val_df, pred_col, true_col, title):
+    '''Plots time-series predictions and residuals'''
+    plot_prediction(train_df, val_df, pred_col, true_col, title=title)
+    plot_residuals(train_df, val_df, pred_col, true_col, title=title)
+    
+def plot_scores(df, title, sort_col=None):
+    '''Plots model scores in a horizontal bar chart
+    INPUT: df - dataframe containing train_rmse and val_rmse columns
+           sort_col - Column to sort bars on
+    RETURNS: Nothing
+    '''
+    fig, ax = plt.subplots(1,1, figsize=(12,8)) 
+    if sort_col is not None:
+        df.sort_values(sort_col).plot.barh(ax=ax)
+    else:
+        df.sort_values(sort_col).plot.barh(ax=ax)
+
+    ax.set_xlabel('RMSE', fontdict={'size' : 14})
+    ax.set_title(title, fontdict={'size' : 18}) 
+    ttl = ax.title
+    ttl.set_position([.5, 1.02])
+    ax.legend(['Train RMSE', 'Validation RMSE'], fontsize=14, loc=4)
+    ax.tick_params(axis='x', labelsize=14)
+    ax.tick_params(axis='y', labelsize=14)
+
+
+    
+
+
+# Headless batch rendering
+
+# Functions which accept max_points, see `render_figure`
+DECIMATED_PLOTS = ('plot_lines', 'plot_val', 'plot_prediction')
+
+
+def init_render_worker():
+    '''Switches a worker to the non-interactive Agg backend, which only draws to files'''
+    plt.switch_backend('Agg')
+
+
+def render_figure(job):
+    '''
+    Draws one figure and saves it to a file
+    INPUT: job - dictionary with the plot function name ('func'), its 'args' and optional 'kwargs',
+                 the output 'file' (.png or .svg) and optional 'dpi'. A plot_lines job gets a
+                 new figure if its subplots argument is None
+    RETURNS: Output filename
+    '''
+    plt.close('all')
+    func = globals()[job['func']]
+    func(*job.get('args', ()), **job.get('kwargs', dict()))
+    fig = plt.gcf()
+    out_dir = os.path.dirname(job['file'])
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    fig.savefig(job['file'], dpi=job.get('dpi', 72), bbox_inches='tight')
+    plt.close(fig)
+    return job['file']
+
+
+def render_figures(jobs, max_points=MAX_POINTS, method='minmax', processes=None):
+    '''
+    Renders a batch of report figures to files in worker processes, without a display
+    INPUT: jobs - list of job dictionaries, see `render_figure`
+           max_points, method - downsampling passed to the DECIMATED_PLOTS functions, unless a
+                                job's kwargs set them. None draws every point
+           processes - number of worker processes (defaults to the number of CPUs)
+    RETURNS: List of the files written, in the order of the jobs
+    '''
+    jobs = [dict(job) for job in jobs]
+    for job in jobs:
+        if job['func'] in DECIMATED_PLOTS:
+            job['kwargs'] = dict({'max_points' : max_points, 'method' : method}, **job.get('kwargs', dict()))
+
+    with Pool(processes, initializer=init_render_worker) as pool:
+        return pool.map(render_figure, jobs)
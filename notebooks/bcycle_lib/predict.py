@@ -0,0 +1,177 @@
+# Hourly station demand prediction from a saved model and its fitted feature pipeline
+import argparse
+import pickle
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+import numpy as np
+
+from .all_utils import FeaturePipeline, add_time_features
+
+HOURS_AHEAD = 24
+DEFAULT_PORT = 8050
+
+
+class DemandPredictor(object):
+    '''
+    A fitted model plus the `FeaturePipeline` and weather columns it was trained with
+    INPUT: model - fitted regressor with a predict() method
+           pipeline - `FeaturePipeline` fitted on the training dataframe
+           weather_cols - weather columns (from `clean_weather`) the model uses, if any
+    '''
+
+    def __init__(self, model, pipeline, weather_cols=None):
+        self.model = model
+        self.pipeline = pipeline
+        self.weather_cols = list(weather_cols) if weather_cols is not None else list()
+
+    def features_frame(self, station_ids, start, hours=HOURS_AHEAD, weather_df=None):
+        '''
+        Builds the dataframe to predict every station for each hour from start
+        INPUT: station_ids - list of station_ids to predict (None for a single network total)
+               start - first hour to predict
+               hours - number of hours to predict
+               weather_df - daily weather dataframe from `clean_weather`. Days after the
+                            last row use the last row's weather
+        RETURNS: Dataframe indexed by datetime, in station-major order
+        '''
+        datetimes = pd.date_range(pd.Timestamp(start).floor('h'), periods=hours, freq='h')
+        if station_ids is None:
+            df = pd.DataFrame(index=datetimes)
+        else:
+            station_ids = np.asarray(station_ids)
+            df = pd.DataFrame({'station_id' : np.repeat(station_ids, hours)},
+                              index=np.tile(datetimes.values, len(station_ids)))
+        df.index.name = 'datetime'
+        df = add_time_features(df)
+
+        # Weather is daily, so line it up with each row's date
+        if self.weather_cols:
+            assert weather_df is not None, 'Model needs weather columns {}'.format(self.weather_cols)
+            days = df.index.normalize()
+            weather = weather_df[self.weather_cols].sort_index()
+            weather = weather.reindex(weather.index.union(days.unique())).ffill().loc[days]
+            for col in self.weather_cols:
+                df[col] = weather[col].values
+        return df
+
+    def predict_frame(self, df):
+        '''Predicts each row of a dataframe with the columns the pipeline was fitted on'''
+        X, _ = self.pipeline.transform(df)
+        return self.model.predict(X)
+
+    def predict(self, station_ids=None, start=None, hours=HOURS_AHEAD, weather_df=None):
+        '''
+        Predicts all stations for the next hours in one batch
+        INPUT: station_ids - list of station_ids (None for a single network total)
+               start - first hour to predict (defaults to the next hour)
+               hours - number of hours to predict
+               weather_df - daily weather dataframe, if the model uses weather
+        RETURNS: Dataframe of predictions with a row per hour and a column per station
+        '''
+        if start is None:
+            start = pd.Timestamp.now().floor('h') + pd.Timedelta(hours=1)
+        df = self.features_frame(station_ids, start, hours, weather_df)
+        preds = self.predict_frame(df)
+        if station_ids is None:
+            return pd.DataFrame({'prediction' : preds}, index=df.index)
+        return pd.DataFrame(preds.reshape(len(station_ids), hours).T,
+                            index=df.index[:hours], columns=pd.Index(station_ids, name='station_id'))
+
+    def save(self, file):
+        '''Pickles the predictor to a file'''
+        with open(file, 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(file):
+        '''Loads a predictor saved with `save`'''
+        with open(file, 'rb') as f:
+            return pickle.load(f)
+
+
+def fit_predictor(model, train_df, target_col, ohe_cols=None, z_norm_cols=None,
+                  minmax_norm_cols=None, weather_cols=None):
+    '''
+    Fits a feature pipeline and model on a training dataframe
+    INPUT: model - unfitted regressor
+           train_df - dataframe with add_time_features() columns, any weather_cols,
+                      station_id if predicting per station, and the target column
+           target_col, ohe_cols, z_norm_cols, minmax_norm_cols - see `FeaturePipeline`
+           weather_cols - weather columns to look up at prediction time
+    RETURNS: DemandPredictor
+    '''
+    pipeline = FeaturePipeline(target_col, ohe_cols=ohe_cols, z_norm_cols=z_norm_cols,
+                               minmax_norm_cols=minmax_norm_cols)
+    X, y = pipeline.fit_transform(train_df)
+    model.fit(X, y)
+    return DemandPredictor(model, pipeline, weather_cols)
+
+
+def make_handler(predictor, weather_df=None, station_ids=None):
+    '''Creates an HTTP request handler class using a loaded predictor'''
+
+    class PredictHandler(BaseHTTPRequestHandler):
+        '''Answers GET /predict?start=...&hours=...&station=1&station=2 with JSON predictions'''
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                self.send_error(404)
+                return
+            query = parse_qs(url.query)
+            try:
+                stations = [int(station) for station in query['station']] if 'station' in query else station_ids
+                preds_df = predictor.predict(stations, query.get('start', [None])[0],
+                                             int(query.get('hours', [HOURS_AHEAD])[0]), weather_df)
+            except (ValueError, KeyError, AssertionError) as e:
+                self.send_error(400, str(e))
+                return
+            body = preds_df.to_json(orient='split', date_format='iso').encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return PredictHandler
+
+
+def main(argv=None):
+    '''
+    Predicts hourly demand from the command line, or serves predictions over HTTP
+    INPUT: List of arguments from the command line
+    RETURNS: Exit code to be passed to sys.exit():
+         0: Script completed successfully
+    '''
+    parser = argparse.ArgumentParser(description='Predict hourly BCycle demand')
+    parser.add_argument('model', help='Pickled DemandPredictor file')
+    parser.add_argument('--weather', help='Cleaned daily weather CSV, indexed by date')
+    parser.add_argument('--stations', type=int, nargs='*', help='Station ids to predict')
+    parser.add_argument('--start', help='First hour to predict (defaults to the next hour)')
+    parser.add_argument('--hours', type=int, default=HOURS_AHEAD)
+    parser.add_argument('--serve', action='store_true', help='Serve predictions over HTTP')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+
+    # Load once, then answer every request with the warm model
+    predictor = DemandPredictor.load(args.model)
+    weather_df = None
+    if args.weather is not None:
+        weather_df = pd.read_csv(args.weather, index_col=0, parse_dates=True)
+
+    if args.serve:
+        server = HTTPServer(('localhost', args.port), make_handler(predictor, weather_df, args.stations))
+        print('Serving predictions on http://localhost:{}/predict'.format(args.port))
+        server.serve_forever()
+        return 0
+
+    preds_df = predictor.predict(args.stations, args.start, args.hours, weather_df)
+    preds_df.to_csv(sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
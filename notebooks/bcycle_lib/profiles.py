@@ -0,0 +1,153 @@
+# Station hour-of-week demand profiles, built with one bincount pass, and incremental clustering
+import pandas as pd
+import numpy as np
+
+from .all_utils import HOURS_PER_WEEK, LOADER_VERSION, hour_of_week, load_bcycle_data
+from .cache import cached_frames
+from .profiling import profiled
+
+
+class StationProfiles(object):
+    '''
+    Demand of each station in each hour of the week, as a dense (stations, 168) array of
+    counts indexed by station_id, and the number of times each hour of the week was seen.
+    Add batches of trips (or snapshot diffs) in time order
+    INPUT: n_stations - size of the station axis, must be larger than every station_id
+    '''
+
+    def __init__(self, n_stations):
+        self.n_stations = n_stations
+        self.counts = np.zeros((n_stations, HOURS_PER_WEEK), dtype=np.float64)
+        self.hours = np.zeros(HOURS_PER_WEEK, dtype=np.int64)
+        self.last_hour = np.datetime64('NaT', 'h')
+
+    def add_counts(self, station_ids, datetimes, weights=None):
+        '''
+        Adds demand to the profiles
+        INPUT: station_ids - int array of the station of each event
+               datetimes - array of the time of each event
+               weights - optional array of the count of each event (e.g. checkouts in a snapshot)
+        RETURNS: The profiles, so calls can be chained
+        '''
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        if not len(station_ids):
+            return self
+        assert station_ids.max() < self.n_stations, 'Station id too large, n_stations is {}'.format(self.n_stations)
+        self.counts += np.bincount(station_ids * HOURS_PER_WEEK + hour_of_week(datetimes), weights=weights,
+                                   minlength=self.counts.size).reshape(self.counts.shape)
+
+        # Count each hour of the time span once, so quiet hours still count towards the mean.
+        # An hour shared with the previous batch was already counted
+        hours = np.asarray(datetimes, dtype='datetime64[h]')
+        first = hours.min() if np.isnat(self.last_hour) else max(hours.min(), self.last_hour + np.timedelta64(1, 'h'))
+        span = np.arange(first, hours.max() + np.timedelta64(1, 'h'))
+        self.hours += np.bincount(hour_of_week(span), minlength=HOURS_PER_WEEK)
+        self.last_hour = hours.max() if np.isnat(self.last_hour) else max(hours.max(), self.last_hour)
+        return self
+
+    def add_trips(self, trips_df, column='checkout_id'):
+        '''Adds trips indexed by datetime, from `load_bcycle_data`, counted at their checkout_id
+        (or checkin_id) station'''
+        return self.add_counts(trips_df[column].values, trips_df.index.values)
+
+    def add_bike_trips(self, bike_trips_df, column='checkouts'):
+        '''Adds the checkouts (or checkins) inferred from snapshots, from `load_bike_trips`'''
+        return self.add_counts(bike_trips_df['station_id'].values, bike_trips_df.index.values,
+                               bike_trips_df[column].values.astype(np.float64))
+
+    def to_frame(self, station_ids=None):
+        '''
+        Returns the mean demand in each hour of the week
+        INPUT: station_ids - optional stations to return, defaults to those with any demand
+        RETURNS: Dataframe indexed by station_id with a column per hour of the week (0 is
+                 Monday midnight)
+        '''
+        if station_ids is None:
+            station_ids = np.flatnonzero(self.counts.sum(axis=1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(self.hours > 0, self.counts[station_ids] / self.hours, 0)
+        return pd.DataFrame(means.astype(np.float32), index=pd.Index(station_ids, name='station_id'),
+                            columns=pd.Index(np.arange(HOURS_PER_WEEK), name='hour_of_week'))
+
+    def save(self, file):
+        '''Saves the profiles to a .npz file'''
+        np.savez(file, counts=self.counts, hours=self.hours, last_hour=self.last_hour)
+
+    @classmethod
+    def load(cls, file):
+        '''Loads profiles saved with `save`'''
+        with np.load(file) as data:
+            profiles = cls(data['counts'].shape[0])
+            profiles.counts = data['counts']
+            profiles.hours = data['hours']
+            profiles.last_hour = data['last_hour'][()]
+        return profiles
+
+
+@profiled
+def load_station_profiles(directory, station_filename, trips_filename, column='checkout_id', use_cache=True):
+    '''
+    Loads the trips with `load_bcycle_data` and builds the hour-of-week profile of each
+    station, using the columnar cache
+    INPUT: directory, station_filename, trips_filename - see `load_bcycle_data`
+           column - count trips at their checkout_id or checkin_id station
+           use_cache - read and write the profiles in the columnar cache
+    RETURNS: Dataframe from `StationProfiles.to_frame`
+    '''
+    def parse(station_path, trips_path):
+        _, trips_df = load_bcycle_data(directory, station_filename, trips_filename, use_cache=use_cache)
+        n_stations = int(max(trips_df['checkout_id'].max(), trips_df['checkin_id'].max())) + 1
+        profiles_df = StationProfiles(n_stations).add_trips(trips_df, column).to_frame()
+        profiles_df.columns = profiles_df.columns.astype(str) # The cache stores named columns
+        return (profiles_df,)
+
+    profiles_df = cached_frames('station_profiles_' + column, LOADER_VERSION,
+                                [directory + '/' + station_filename, directory + '/' + trips_filename],
+                                parse, use_cache)[0]
+    profiles_df.columns = pd.Index(profiles_df.columns.astype(int), name='hour_of_week')
+    return profiles_df
+
+
+def normalize_profiles(profiles_df):
+    '''Scales each station's profile to sum to 1, so stations cluster by the shape of their
+    demand rather than its size'''
+    totals = profiles_df.values.sum(axis=1, keepdims=True)
+    return pd.DataFrame(np.where(totals > 0, profiles_df.values / np.where(totals > 0, totals, 1), 0),
+                        index=profiles_df.index, columns=profiles_df.columns)
+
+
+class ProfileClusters(object):
+    '''
+    Clusters station profiles with MiniBatchKMeans. Each `partial_fit` moves the existing
+    cluster centers towards new profiles (e.g. a profile of the latest weeks), rather than
+    clustering from scratch
+    INPUT: n_clusters - number of clusters
+           normalize - cluster the shape of each profile, see `normalize_profiles`
+           random_state - passed to MiniBatchKMeans
+    '''
+
+    def __init__(self, n_clusters=4, normalize=True, random_state=None):
+        from sklearn.cluster import MiniBatchKMeans
+
+        self.normalize = normalize
+        self.model = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, n_init=3)
+
+    def features(self, profiles_df):
+        '''Returns the array clustered for each station'''
+        return (normalize_profiles(profiles_df) if self.normalize else profiles_df).values
+
+    @profiled
+    def partial_fit(self, profiles_df):
+        '''Updates the clusters with profiles from `StationProfiles.to_frame`, returning self'''
+        self.model.partial_fit(self.features(profiles_df))
+        return self
+
+    def predict(self, profiles_df):
+        '''Returns a Series of the cluster of each station'''
+        return pd.Series(self.model.predict(self.features(profiles_df)), index=profiles_df.index, name='cluster')
+
+    def centers(self):
+        '''Returns the cluster centers as a dataframe with a column per hour of the week'''
+        return pd.DataFrame(self.model.cluster_centers_, index=pd.Index(np.arange(len(self.model.cluster_centers_)),
+                                                                        name='cluster'),
+                            columns=pd.Index(np.arange(HOURS_PER_WEEK), name='hour_of_week'))
@@ -0,0 +1,170 @@
+# Opt-in timing and memory instrumentation for the bcycle_lib functions
+import functools
+import json
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+
+# Set BCYCLE_PROFILE=1 (or =memory to also trace allocations) to profile from import
+PROFILE_ENV = 'BCYCLE_PROFILE'
+
+# Profiler state. While disabled, `profiled` functions and `stage` blocks only check `enabled`
+enabled = False
+trace_memory = False
+records = list()
+stack = list()
+
+
+def enable(memory=False):
+    '''
+    Starts recording stages
+    INPUT: memory - also record the bytes allocated in each stage with tracemalloc. This
+                    slows allocation-heavy code down, so it's off by default
+    RETURNS: Nothing
+    '''
+    global enabled, trace_memory
+    enabled = True
+    trace_memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    '''Stops recording stages, keeping the records made so far'''
+    global enabled, trace_memory
+    if trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    enabled = False
+    trace_memory = False
+
+
+def reset():
+    '''Clears the records'''
+    del records[:]
+
+
+def frame_info(result):
+    '''Returns the rows and memory usage of a dataframe, or of the dataframes in a tuple'''
+    items = result if isinstance(result, tuple) else (result,)
+    frames = [item for item in items if isinstance(item, (pd.DataFrame, pd.Series))]
+    if not frames:
+        return dict()
+    # Shallow memory usage, deep=True would scan every string
+    return {'rows' : sum(frame.shape[0] for frame in frames),
+            'frame_bytes' : int(sum(pd.Series(frame.memory_usage(index=True)).sum() for frame in frames))}
+
+
+class Stage(object):
+    '''One timed block, see `stage`. Call `frame` to record the dataframe it produced'''
+
+    def __init__(self, name):
+        self.record = {'name' : name, 'path' : ';'.join(stack + [name]), 'depth' : len(stack)}
+
+    def __enter__(self):
+        stack.append(self.record['name'])
+        if trace_memory:
+            self.start_bytes = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.record['seconds'] = time.perf_counter() - self.start
+        if trace_memory:
+            self.record['alloc_bytes'] = tracemalloc.get_traced_memory()[0] - self.start_bytes
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        stack.pop()
+        records.append(self.record)
+        return False
+
+    def frame(self, result):
+        '''Records the rows and memory of a dataframe (or tuple of them), and returns it'''
+        self.record.update(frame_info(result))
+        return result
+
+
+class NullStage(object):
+    '''Stage used while the profiler is disabled, which does nothing'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def frame(self, result):
+        return result
+
+NULL_STAGE = NullStage()
+
+
+def stage(name):
+    '''
+    Times a block of code as a stage, nested inside any stage it runs in
+    INPUT: name - name of the stage
+    RETURNS: Context manager, usable as `with stage('sort') as s: ... s.frame(df)`
+    '''
+    return Stage(name) if enabled else NULL_STAGE
+
+
+def profiled(func):
+    '''Decorator recording each call of a function as a stage, with the rows and memory of
+    any dataframes it returns'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        with Stage(func.__qualname__) as func_stage:
+            return func_stage.frame(func(*args, **kwargs))
+    return wrapper
+
+
+def to_frame():
+    '''Returns the records as a dataframe, one row per stage in the order they finished'''
+    return pd.DataFrame(records, columns=['path', 'name', 'depth', 'seconds', 'rows',
+                                          'frame_bytes', 'alloc_bytes', 'error'])
+
+
+def save_json(file):
+    '''Saves the records to a JSON log file'''
+    with open(file, 'w') as f:
+        json.dump(records, f, indent=1)
+
+
+def summary():
+    '''
+    Totals the records by stage path, as a flame-style tree
+    RETURNS: Dataframe indexed by indented stage name, in call tree order, with calls, total
+             seconds, percentage of the total time and (when recorded) rows and bytes
+    '''
+    df = to_frame()
+    if df.empty:
+        return df
+    totals = df.groupby('path', sort=False).agg({'name' : 'first', 'depth' : 'first', 'seconds' : ['count', 'sum'],
+                                                 'rows' : 'sum', 'frame_bytes' : 'sum', 'alloc_bytes' : 'sum'})
+    totals.columns = ['name', 'depth', 'calls', 'seconds', 'rows', 'frame_bytes', 'alloc_bytes']
+    # Sorting the split paths puts each stage after its parent
+    totals = totals.loc[sorted(totals.index, key=lambda path: path.split(';'))]
+    root_seconds = totals.loc[totals['depth'] == 0, 'seconds'].sum()
+    totals['percent'] = 100.0 * totals['seconds'] / root_seconds
+    totals.index = ['  ' * depth + name for depth, name in zip(totals['depth'], totals['name'])]
+    return totals[['calls', 'seconds', 'percent', 'rows', 'frame_bytes', 'alloc_bytes']]
+
+
+def save_collapsed(file):
+    '''Saves the self time of each stage path in microseconds, in the collapsed stack
+    format read by flamegraph.pl and speedscope'''
+    self_seconds = to_frame().groupby('path')['seconds'].sum()
+    for path, seconds in self_seconds.copy().items():
+        parent = path.rsplit(';', 1)[0] if ';' in path else None
+        if parent is not None:
+            self_seconds[parent] -= seconds
+    with open(file, 'w') as f:
+        for path, seconds in self_seconds.items():
+            f.write('{} {}\n'.format(path, max(int(seconds * 1e6), 0)))
+
+
+if os.environ.get(PROFILE_ENV):
+    enable(memory=os.environ[PROFILE_ENV] == 'memory')
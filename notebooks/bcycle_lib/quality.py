@@ -0,0 +1,264 @@
+# Vectorized data-quality checks for the station snapshots and trips, usable batch by batch
+import pandas as pd
+import numpy as np
+
+from .occupancy import datetimes_ns
+from .profiling import profiled
+
+MINUTE_NS = 60 * 10**9
+
+# Snapshots are scraped every 5 minutes, longer gaps mean missed scrapes
+MAX_GAP = '15min'
+
+# Bikes + docks may move by a bike in transit or a broken dock, larger changes are flagged
+CAPACITY_TOLERANCE = 1
+
+# Longest plausible trip in minutes, the longest rental BCycle allows is a day
+MAX_DURATION = 24 * 60
+
+CHECKS = ['gap', 'outage', 'duplicate', 'capacity_change', 'negative_count', 'unknown_station',
+          'bad_duration', 'bike_overlap']
+ISSUE_COLS = ['check', 'row', 'station_id', 'bike_id', 'start', 'end', 'value']
+
+# Value used for the station_id and bike_id of issues which don't have one, and the row
+# of issues without a row of their own, e.g. network outages
+NO_ID = -1
+
+
+def make_issues(check, rows, station_ids=None, bike_ids=None, starts=None, ends=None, values=None):
+    '''
+    Builds the issues dataframe of one check
+    INPUT: check - name of the check, one of CHECKS
+           rows - int array of the batch row of each issue
+           station_ids, bike_ids - optional int arrays, NO_ID if not given
+           starts, ends - optional int64 ns arrays of the time of each issue, ends default to starts
+           values - optional float array, e.g. the gap minutes or the capacity change
+    RETURNS: Dataframe with ISSUE_COLS
+    '''
+    n_issues = len(rows)
+    missing = np.full(n_issues, NO_ID, dtype=np.int64)
+    starts = np.full(n_issues, np.iinfo(np.int64).min, dtype=np.int64) if starts is None else starts
+    ends = starts if ends is None else ends
+    return pd.DataFrame({'check' : pd.Categorical.from_codes(np.full(n_issues, CHECKS.index(check)), CHECKS),
+                         'row' : np.asarray(rows, dtype=np.int64),
+                         'station_id' : missing if station_ids is None else np.asarray(station_ids, dtype=np.int64),
+                         'bike_id' : missing if bike_ids is None else np.asarray(bike_ids, dtype=np.int64),
+                         'start' : np.asarray(starts, dtype=np.int64).astype('datetime64[ns]'),
+                         'end' : np.asarray(ends, dtype=np.int64).astype('datetime64[ns]'),
+                         'value' : np.full(n_issues, np.nan, dtype=np.float32) if values is None
+                                   else np.asarray(values, dtype=np.float32)},
+                        columns=ISSUE_COLS)
+
+
+def concat_issues(issues):
+    '''Combines the issues of several checks, sorted by start time'''
+    issues_df = pd.concat(issues, ignore_index=True)
+    return issues_df.sort_values(['start', 'check'], kind='mergesort').reset_index(drop=True)
+
+
+def offset_rows(issues_df, rows_seen):
+    '''Makes the batch rows of issues count from the start of the stream, by adding the
+    number of rows in earlier batches'''
+    rows = issues_df['row'].values
+    issues_df['row'] = np.where(rows == NO_ID, NO_ID, rows + rows_seen)
+    return issues_df
+
+
+def unknown_ids(values, known_ids):
+    '''Returns a mask of the values not in known_ids (all known if known_ids is None)'''
+    if known_ids is None:
+        return np.zeros(len(values), dtype=bool)
+    return ~np.isin(values, known_ids)
+
+
+class SnapshotScanner(object):
+    '''
+    Checks station snapshots for scraper gaps and outages, duplicate timestamps, capacity
+    (bikes + docks) changes, negative counts and unknown station ids. Call `update` with each
+    batch of snapshots as it's loaded, the last snapshot of each station is kept so gaps and
+    changes across batches are found too. Issue rows count from the first row of the first
+    batch, so streamed issues match those of a single pass
+    INPUT: station_ids - optional array of known station_id values, e.g. from `load_stations`
+           max_gap - longest expected time between a station's snapshots
+           capacity_tolerance - largest change in bikes + docks which isn't flagged
+    '''
+
+    def __init__(self, station_ids=None, max_gap=MAX_GAP, capacity_tolerance=CAPACITY_TOLERANCE):
+        self.known_ids = None if station_ids is None else np.unique(np.asarray(station_ids, dtype=np.int64))
+        self.max_gap = pd.Timedelta(max_gap).value
+        self.capacity_tolerance = capacity_tolerance
+
+        # Last snapshot of each station, sorted by station_id, and the last snapshot time of any station
+        self.station_ids = np.zeros(0, dtype=np.int64)
+        self.last_times = np.zeros(0, dtype=np.int64)
+        self.last_totals = np.zeros(0, dtype=np.int64)
+        self.last_time = None
+        self.rows_seen = 0
+
+    @profiled
+    def update(self, bikes_df):
+        '''
+        Checks a batch of snapshots
+        INPUT: bikes_df - dataframe with station_id, datetime, bikes and docks, e.g. from `load_bikes`
+        RETURNS: Dataframe of issues with ISSUE_COLS, see `make_issues`. Gap and outage values
+                 are minutes, capacity changes are the change in bikes + docks
+        '''
+        station_ids = bikes_df['station_id'].values.astype(np.int64)
+        times = datetimes_ns(bikes_df['datetime'].values)
+        bikes = bikes_df['bikes'].values.astype(np.int64)
+        docks = bikes_df['docks'].values.astype(np.int64)
+        issues = list()
+
+        negative = np.flatnonzero((bikes < 0) | (docks < 0))
+        issues.append(make_issues('negative_count', negative, station_ids[negative], starts=times[negative],
+                                  values=np.minimum(bikes, docks)[negative]))
+        unknown = np.flatnonzero(unknown_ids(station_ids, self.known_ids))
+        issues.append(make_issues('unknown_station', unknown, station_ids[unknown], starts=times[unknown]))
+
+        # Network outages are gaps between any snapshots, carried across batches
+        all_times = np.unique(times)
+        if self.last_time is not None:
+            all_times = np.append(self.last_time, all_times[all_times > self.last_time])
+        outage = np.flatnonzero(np.diff(all_times) > self.max_gap)
+        outage_starts, outage_ends = all_times[outage], all_times[outage + 1]
+        issues.append(make_issues('outage', np.full(len(outage), NO_ID), starts=outage_starts, ends=outage_ends,
+                                  values=(outage_ends - outage_starts) / MINUTE_NS))
+        if len(all_times):
+            self.last_time = all_times[-1]
+
+        # Put each station's last snapshot from earlier batches in front of its new ones, with row NO_ID
+        carried = np.isin(self.station_ids, station_ids)
+        all_ids = np.concatenate((self.station_ids[carried], station_ids))
+        all_times = np.concatenate((self.last_times[carried], times))
+        totals = np.concatenate((self.last_totals[carried], bikes + docks))
+        rows = np.concatenate((np.full(carried.sum(), NO_ID), np.arange(len(station_ids))))
+        order = np.lexsort((rows, all_times, all_ids))
+        all_ids, all_times, totals, rows = all_ids[order], all_times[order], totals[order], rows[order]
+
+        # Compare each snapshot with the previous one of the same station
+        same = np.flatnonzero(all_ids[1:] == all_ids[:-1]) + 1
+        prev = same - 1
+        deltas = all_times[same] - all_times[prev]
+
+        dup = same[deltas == 0]
+        issues.append(make_issues('duplicate', rows[dup], all_ids[dup], starts=all_times[dup]))
+        gap = deltas > self.max_gap
+
+        # Station gaps covering an outage, and not much more, are reported only as the outage
+        first_outage = np.minimum(np.searchsorted(outage_starts, all_times[prev]), max(len(outage) - 1, 0))
+        if len(outage):
+            outage_len = outage_ends[first_outage] - outage_starts[first_outage]
+            gap &= ~((outage_starts[first_outage] >= all_times[prev]) & (outage_ends[first_outage] <= all_times[same]) &
+                     (deltas - outage_len <= self.max_gap))
+        issues.append(make_issues('gap', rows[same[gap]], all_ids[same[gap]], starts=all_times[prev[gap]],
+                                  ends=all_times[same[gap]], values=deltas[gap] / MINUTE_NS))
+        changes = totals[same] - totals[prev]
+        jump = np.abs(changes) > self.capacity_tolerance
+        issues.append(make_issues('capacity_change', rows[same[jump]], all_ids[same[jump]],
+                                  starts=all_times[prev[jump]], ends=all_times[same[jump]], values=changes[jump]))
+
+        # Remember each station's latest snapshot
+        last = np.append(all_ids[1:] != all_ids[:-1], True) if len(all_ids) else np.zeros(0, dtype=bool)
+        self.merge_carry(all_ids[last], all_times[last], totals[last])
+        issues_df = offset_rows(concat_issues(issues), self.rows_seen)
+        self.rows_seen += len(station_ids)
+        return issues_df
+
+    def merge_carry(self, station_ids, last_times, last_totals):
+        '''Replaces the last snapshot of the stations in a batch, keeping the others'''
+        keep = ~np.isin(self.station_ids, station_ids)
+        all_ids = np.concatenate((self.station_ids[keep], station_ids))
+        order = np.argsort(all_ids, kind='mergesort')
+        self.station_ids = all_ids[order]
+        self.last_times = np.concatenate((self.last_times[keep], last_times))[order]
+        self.last_totals = np.concatenate((self.last_totals[keep], last_totals))[order]
+
+
+class TripScanner(object):
+    '''
+    Checks trips for impossible durations, unknown station ids, duplicate trips and bikes
+    starting a trip before their previous one ended. Call `update` with each batch of trips,
+    the last trip of each bike is kept so overlaps across batches are found too. Issue rows
+    count from the first row of the first batch
+    INPUT: station_ids - optional array of known station_id values
+           max_duration - longest plausible trip in minutes
+    '''
+
+    def __init__(self, station_ids=None, max_duration=MAX_DURATION):
+        self.known_ids = None if station_ids is None else np.unique(np.asarray(station_ids, dtype=np.int64))
+        self.max_duration = max_duration
+
+        # Checkout and checkin time of each bike's latest trip, sorted by bike_id
+        self.bike_ids = np.zeros(0, dtype=np.int64)
+        self.last_starts = np.zeros(0, dtype=np.int64)
+        self.last_ends = np.zeros(0, dtype=np.int64)
+        self.rows_seen = 0
+
+    @profiled
+    def update(self, trips_df):
+        '''
+        Checks a batch of trips
+        INPUT: trips_df - trips dataframe indexed by datetime, from `load_bcycle_data`
+        RETURNS: Dataframe of issues with ISSUE_COLS, see `make_issues`. Duration values are the
+                 trip minutes, overlap values the minutes the bike was still out on its previous trip
+        '''
+        bike_ids = trips_df['bike_id'].values.astype(np.int64)
+        times = datetimes_ns(trips_df.index.values)
+        durations = trips_df['duration'].values.astype(np.int64)
+        ends = times + durations * MINUTE_NS
+        issues = list()
+
+        bad = np.flatnonzero((durations <= 0) | (durations > self.max_duration))
+        issues.append(make_issues('bad_duration', bad, trips_df['checkout_id'].values[bad], bike_ids[bad],
+                                  times[bad], ends[bad], durations[bad]))
+        for col in ('checkout_id', 'checkin_id'):
+            station_ids = trips_df[col].values.astype(np.int64)
+            unknown = np.flatnonzero(unknown_ids(station_ids, self.known_ids))
+            issues.append(make_issues('unknown_station', unknown, station_ids[unknown], bike_ids[unknown],
+                                      times[unknown]))
+
+        # Put each bike's last trip from earlier batches in front of its new ones, with row NO_ID
+        carried = np.isin(self.bike_ids, bike_ids)
+        all_ids = np.concatenate((self.bike_ids[carried], bike_ids))
+        all_starts = np.concatenate((self.last_starts[carried], times))
+        all_ends = np.concatenate((self.last_ends[carried], ends))
+        rows = np.concatenate((np.full(carried.sum(), NO_ID), np.arange(len(bike_ids))))
+        order = np.lexsort((rows, all_starts, all_ids))
+        all_ids, all_starts, all_ends, rows = all_ids[order], all_starts[order], all_ends[order], rows[order]
+
+        # Compare each trip with the bike's previous trip
+        same = np.flatnonzero(all_ids[1:] == all_ids[:-1]) + 1
+        prev = same - 1
+        dup = same[all_starts[same] == all_starts[prev]]
+        issues.append(make_issues('duplicate', rows[dup], bike_ids=all_ids[dup], starts=all_starts[dup]))
+        overlap = same[(all_starts[same] < all_ends[prev]) & (all_starts[same] > all_starts[prev])]
+        issues.append(make_issues('bike_overlap', rows[overlap], bike_ids=all_ids[overlap],
+                                  starts=all_starts[overlap], ends=all_ends[overlap - 1],
+                                  values=(all_ends[overlap - 1] - all_starts[overlap]) / MINUTE_NS))
+
+        # Remember each bike's latest trip
+        last = np.append(all_ids[1:] != all_ids[:-1], True) if len(all_ids) else np.zeros(0, dtype=bool)
+        keep = ~np.isin(self.bike_ids, all_ids[last])
+        merged_ids = np.concatenate((self.bike_ids[keep], all_ids[last]))
+        order = np.argsort(merged_ids, kind='mergesort')
+        self.bike_ids = merged_ids[order]
+        self.last_starts = np.concatenate((self.last_starts[keep], all_starts[last]))[order]
+        self.last_ends = np.concatenate((self.last_ends[keep], all_ends[last]))[order]
+        issues_df = offset_rows(concat_issues(issues), self.rows_seen)
+        self.rows_seen += len(bike_ids)
+        return issues_df
+
+
+def scan_snapshots(bikes_df, station_ids=None, max_gap=MAX_GAP, capacity_tolerance=CAPACITY_TOLERANCE):
+    '''Checks a whole table of station snapshots in one pass, see `SnapshotScanner`'''
+    return SnapshotScanner(station_ids, max_gap, capacity_tolerance).update(bikes_df)
+
+
+def scan_trips(trips_df, station_ids=None, max_duration=MAX_DURATION):
+    '''Checks a whole trips table in one pass, see `TripScanner`'''
+    return TripScanner(station_ids, max_duration).update(trips_df)
+
+
+def issue_counts(issues_df):
+    '''Returns the number of issues found by each check'''
+    return issues_df['check'].value_counts(sort=False)
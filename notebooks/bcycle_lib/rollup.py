@@ -0,0 +1,188 @@
+# Hourly rental counts by station and membership, pre-aggregated from the trips table
+import pandas as pd
+import numpy as np
+
+HOUR_NS = 3600 * 10**9
+
+# Cube keys pack (hour, station_id, membership) into one int64, hour first so
+# that keys are sorted by time. Station ids and membership codes must be < 256
+STATION_SLOTS = 256
+MEMBERSHIP_SLOTS = 256
+HOUR_STRIDE = STATION_SLOTS * MEMBERSHIP_SLOTS
+
+# Membership label used for snapshot data, which doesn't record memberships
+ALL_MEMBERSHIPS = 'all'
+
+
+def epoch_hours(datetimes):
+    '''Converts datetimes to whole hours since the epoch (int64)'''
+    return np.asarray(datetimes, dtype='datetime64[ns]').view(np.int64) // HOUR_NS
+
+
+class RentalCube(object):
+    '''
+    Checkout and checkin counts for every (hour, station, membership) bucket. Built from
+    trips with `add_trips` (or bike snapshot diffs with `add_bike_trips`), and queried by
+    summing buckets with `hourly`, `daily` and `weekly`.
+    '''
+
+    def __init__(self):
+        self.memberships = list()
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.checkouts = np.zeros(0, dtype=np.uint32)
+        self.checkins = np.zeros(0, dtype=np.uint32)
+
+    def membership_codes(self, memberships):
+        '''Converts membership labels to cube codes, registering any new ones'''
+        labels, inverse = np.unique(np.asarray(memberships, dtype=str), return_inverse=True)
+        for label in labels:
+            if label not in self.memberships:
+                assert len(self.memberships) < MEMBERSHIP_SLOTS, 'Too many memberships for the cube'
+                self.memberships.append(str(label))
+        label_codes = np.array([self.memberships.index(label) for label in labels], dtype=np.int64)
+        return label_codes[inverse.ravel()]
+
+    def add_counts(self, hours, station_ids, codes, checkouts, checkins):
+        '''
+        Adds counts into the cube buckets
+        INPUT: hours - int64 epoch hours of each count (see `epoch_hours`)
+               station_ids, codes - station_id and membership code of each count
+               checkouts, checkins - counts to add
+        RETURNS: Nothing
+        '''
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        assert station_ids.size == 0 or station_ids.max() < STATION_SLOTS, 'Station id too large for the cube'
+        new_keys = hours * HOUR_STRIDE + station_ids * MEMBERSHIP_SLOTS + codes
+
+        # Sum the batch into its own buckets, so the sort only covers the new counts
+        batch_keys, inverse = np.unique(new_keys, return_inverse=True)
+        inverse = inverse.ravel()
+        batch_checkouts = np.bincount(inverse, weights=checkouts, minlength=len(batch_keys)).astype(np.uint32)
+        batch_checkins = np.bincount(inverse, weights=checkins, minlength=len(batch_keys)).astype(np.uint32)
+
+        # Add to the buckets which already exist, and insert the new ones in key order
+        rows = np.searchsorted(self.keys, batch_keys)
+        found = rows < len(self.keys)
+        found[found] = self.keys[rows[found]] == batch_keys[found]
+        self.checkouts[rows[found]] += batch_checkouts[found]
+        self.checkins[rows[found]] += batch_checkins[found]
+
+        added = ~found
+        self.keys = np.insert(self.keys, rows[added], batch_keys[added])
+        self.checkouts = np.insert(self.checkouts, rows[added], batch_checkouts[added])
+        self.checkins = np.insert(self.checkins, rows[added], batch_checkins[added])
+
+    def add_trips(self, trips_df):
+        '''
+        Adds trips from `load_bcycle_data` to the cube. Each trip is a checkout in the hour
+        it started at checkout_id, and a checkin `duration` minutes later at checkin_id
+        INPUT: trips_df - trips dataframe indexed by datetime
+        RETURNS: The cube, so calls can be chained
+        '''
+        n_rows = trips_df.shape[0]
+        codes = self.membership_codes(trips_df['membership'].values)
+        checkout_hours = epoch_hours(trips_df.index.values)
+        checkin_times = trips_df.index + pd.to_timedelta(trips_df['duration'].values.astype(np.int64), unit='m')
+        checkin_hours = epoch_hours(checkin_times.values)
+
+        ones = np.ones(n_rows, dtype=np.uint32)
+        zeros = np.zeros(n_rows, dtype=np.uint32)
+        self.add_counts(np.concatenate((checkout_hours, checkin_hours)),
+                        np.concatenate((trips_df['checkout_id'].values, trips_df['checkin_id'].values)),
+                        np.concatenate((codes, codes)),
+                        np.concatenate((ones, zeros)),
+                        np.concatenate((zeros, ones)))
+        return self
+
+    def add_bike_trips(self, bike_trips_df):
+        '''
+        Adds the checkouts and checkins from `load_bike_trips` to the cube, under the
+        ALL_MEMBERSHIPS membership
+        INPUT: bike_trips_df - dataframe indexed by datetime with station_id, checkouts and checkins
+        RETURNS: The cube, so calls can be chained
+        '''
+        active = (bike_trips_df['checkouts'].values != 0) | (bike_trips_df['checkins'].values != 0)
+        codes = self.membership_codes(np.repeat(ALL_MEMBERSHIPS, active.sum()))
+        self.add_counts(epoch_hours(bike_trips_df.index.values[active]),
+                        bike_trips_df['station_id'].values[active],
+                        codes,
+                        bike_trips_df['checkouts'].values[active],
+                        bike_trips_df['checkins'].values[active])
+        return self
+
+    def select(self, station_ids=None, memberships=None, start=None, end=None):
+        '''Returns a boolean mask and slice of the buckets matching the query, see `hourly`'''
+        # Keys are sorted by hour first, so the time range is a binary search
+        lo = 0 if start is None else np.searchsorted(self.keys, epoch_hours([pd.Timestamp(start)])[0] * HOUR_STRIDE)
+        hi = len(self.keys) if end is None else \
+            np.searchsorted(self.keys, (epoch_hours([pd.Timestamp(end)])[0] + 1) * HOUR_STRIDE)
+        keys = self.keys[lo:hi]
+
+        mask = np.ones(len(keys), dtype=bool)
+        if station_ids is not None:
+            mask &= np.isin((keys // MEMBERSHIP_SLOTS) % STATION_SLOTS, station_ids)
+        if memberships is not None:
+            codes = [self.memberships.index(label) for label in memberships if label in self.memberships]
+            mask &= np.isin(keys % MEMBERSHIP_SLOTS, codes)
+        return slice(lo, hi), mask
+
+    def hourly(self, station_ids=None, memberships=None, start=None, end=None, by_station=False):
+        '''
+        Sums the buckets into hourly counts
+        INPUT: station_ids - optional list of station_ids to include (default all)
+               memberships - optional list of membership labels to include (default all)
+               start, end - optional first and last hour to include (inclusive)
+               by_station - if True, keep a separate row for each station in each hour
+        RETURNS: Dataframe indexed by datetime (and station_id if by_station) with
+                 checkouts, checkins and totals columns. Hours with no rentals are left out
+        '''
+        rows, mask = self.select(station_ids, memberships, start, end)
+        keys = self.keys[rows][mask]
+        group_keys = keys // MEMBERSHIP_SLOTS if by_station else keys // HOUR_STRIDE
+        groups, inverse = np.unique(group_keys, return_inverse=True)
+        inverse = inverse.ravel()
+
+        checkouts = np.bincount(inverse, weights=self.checkouts[rows][mask], minlength=len(groups))
+        checkins = np.bincount(inverse, weights=self.checkins[rows][mask], minlength=len(groups))
+        hours = groups // STATION_SLOTS if by_station else groups
+        datetimes = pd.DatetimeIndex((hours * HOUR_NS).astype('datetime64[ns]'), name='datetime')
+        if by_station:
+            index = pd.MultiIndex.from_arrays([datetimes, (groups % STATION_SLOTS).astype(np.uint8)],
+                                              names=['datetime', 'station_id'])
+        else:
+            index = datetimes
+
+        df = pd.DataFrame({'checkouts' : checkouts.astype(np.uint32),
+                           'checkins' : checkins.astype(np.uint32)},
+                          index=index, columns=['checkouts', 'checkins'])
+        df['totals'] = df['checkouts'] + df['checkins']
+        return df
+
+    def resampled(self, rule, station_ids=None, memberships=None, start=None, end=None):
+        '''Sums the hourly counts into coarser periods, using a pandas resample rule'''
+        hourly_df = self.hourly(station_ids, memberships, start, end)
+        return hourly_df.resample(rule).sum()
+
+    def daily(self, station_ids=None, memberships=None, start=None, end=None):
+        '''Daily checkouts, checkins and totals (see `hourly` for arguments)'''
+        return self.resampled('1D', station_ids, memberships, start, end)
+
+    def weekly(self, station_ids=None, memberships=None, start=None, end=None):
+        '''Weekly checkouts, checkins and totals (see `hourly` for arguments)'''
+        return self.resampled('W', station_ids, memberships, start, end)
+
+    def save(self, file):
+        '''Saves the cube to a .npz file'''
+        np.savez(file, keys=self.keys, checkouts=self.checkouts, checkins=self.checkins,
+                 memberships=np.array(self.memberships, dtype=str))
+
+    @classmethod
+    def load(cls, file):
+        '''Loads a cube saved with `save`'''
+        cube = cls()
+        with np.load(file) as data:
+            cube.keys = data['keys']
+            cube.checkouts = data['checkouts']
+            cube.checkins = data['checkins']
+            cube.memberships = [str(label) for label in data['memberships']]
+        return cube
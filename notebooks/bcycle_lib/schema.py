@@ -0,0 +1,169 @@
+# Schema-driven dtype compaction: store each column in the smallest type its values fit
+import json
+
+import pandas as pd
+import numpy as np
+
+UNSIGNED_TYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+SIGNED_TYPES = (np.int8, np.int16, np.int32, np.int64)
+
+# Object columns become categories when they have at most this fraction of distinct values
+CATEGORY_FRACTION = 0.5
+
+CATEGORY = 'category'
+
+
+def smallest_int_type(min_val, max_val):
+    '''Returns the smallest integer dtype holding min_val to max_val, unsigned if min_val >= 0'''
+    for int_type in (UNSIGNED_TYPES if min_val >= 0 else SIGNED_TYPES):
+        info = np.iinfo(int_type)
+        if info.min <= min_val and max_val <= info.max:
+            return np.dtype(int_type)
+    return np.dtype(np.float64)
+
+
+def infer_column_type(series, category_fraction=CATEGORY_FRACTION, float32_rtol=None):
+    '''
+    Finds the smallest type which holds a column's values without losing information
+    INPUT: series - column to inspect
+           category_fraction - maximum fraction of distinct strings for a category
+           float32_rtol - floats become float32 only if every value survives the round trip
+                          exactly, unless this relative tolerance is given to allow lossy
+                          downcasting (e.g. 1e-6 for measured values like coordinates)
+    RETURNS: dtype string, e.g. 'uint8', 'float32' or 'category'
+    '''
+    dtype = series.dtype
+    if str(dtype) == CATEGORY or dtype.kind in 'bmM':
+        return str(dtype)
+    if dtype.kind in 'iu':
+        if series.empty:
+            return str(dtype)
+        return str(smallest_int_type(series.min(), series.max()))
+    if dtype.kind == 'f':
+        values = series.values
+        finite = values[np.isfinite(values)]
+        # Whole numbers without NaNs can be integers
+        if len(finite) == len(values) and len(values) and np.array_equal(finite, np.round(finite)):
+            return str(smallest_int_type(finite.min(), finite.max()))
+        if len(finite) == 0:
+            return 'float32'
+        if np.abs(finite).max() <= np.finfo(np.float32).max:
+            rounded = finite.astype(np.float32).astype(np.float64)
+            if float32_rtol is None and np.array_equal(rounded, finite):
+                return 'float32'
+            if float32_rtol is not None and np.allclose(rounded, finite, rtol=float32_rtol, atol=0):
+                return 'float32'
+        return 'float64'
+    # Strings and other objects
+    if len(series) and series.nunique() <= category_fraction * len(series):
+        return CATEGORY
+    return str(dtype)
+
+
+def infer_schema(df, category_fraction=CATEGORY_FRACTION, float32_rtol=None):
+    '''Returns a dictionary of column name -> smallest dtype string, see `infer_column_type`'''
+    return {col : infer_column_type(df[col], category_fraction, float32_rtol) for col in df.columns}
+
+
+def widen_type(dtype, series):
+    '''
+    Returns a dtype holding both the schema type and the values in a column
+    INPUT: dtype - dtype string from the schema
+           series - column values which should be stored as dtype
+    RETURNS: dtype string, the same as `dtype` if the values fit
+    '''
+    if dtype == CATEGORY or series.empty:
+        return dtype
+    target = np.dtype(dtype)
+    if target.kind in 'iu':
+        values = series.values
+        if values.dtype.kind == 'f':
+            if np.isnan(values).any():
+                return 'float64' # Integers can't hold missing values
+            if not np.array_equal(values, np.round(values)):
+                return str(np.promote_types(target, values.dtype))
+        info = np.iinfo(target)
+        min_val, max_val = series.min(), series.max()
+        if min_val < info.min or max_val > info.max:
+            return str(np.promote_types(target, smallest_int_type(min_val, max_val)))
+    elif target.kind == 'f':
+        if np.nanmax(np.abs(series.values.astype(np.float64))) > np.finfo(target).max:
+            return 'float64'
+    return dtype
+
+
+def merge_schemas(schema, other):
+    '''Combines two schemas, using the type which holds both where a column is in both'''
+    merged = dict(schema)
+    for col, dtype in other.items():
+        if col not in merged or merged[col] == dtype:
+            merged[col] = dtype
+        elif CATEGORY in (merged[col], dtype):
+            merged[col] = CATEGORY if merged[col] == dtype else 'object'
+        else:
+            merged[col] = str(np.promote_types(merged[col], dtype))
+    return merged
+
+
+def apply_schema(df, schema):
+    '''
+    Converts columns to their schema types, widening a type where the data doesn't fit it
+    INPUT: df - dataframe to convert. Columns not in the schema are left alone
+           schema - dictionary of column name -> dtype string
+    RETURNS: Tuple of (converted copy of the dataframe, schema with any widened types)
+    '''
+    schema = dict(schema)
+    # Converted columns replace those of a shallow copy, so the caller's dataframe is unchanged
+    df = df.copy(deep=False)
+    for col in df.columns:
+        if col not in schema:
+            continue
+        schema[col] = widen_type(schema[col], df[col])
+        if str(df[col].dtype) != schema[col]:
+            df[col] = df[col].astype(schema[col])
+    return df, schema
+
+
+def compact(df, schema=None, category_fraction=CATEGORY_FRACTION, float32_rtol=None):
+    '''
+    Downcasts a dataframe to the smallest safe types
+    INPUT: df - dataframe to compact
+           schema - optional minimum schema. Columns in it start from its type and are widened
+                    if needed, other columns use the smallest type inferred from the data
+           category_fraction, float32_rtol - see `infer_column_type`
+    RETURNS: Tuple of (compacted copy of the dataframe, schema used)
+    '''
+    inferred = infer_schema(df, category_fraction, float32_rtol)
+    if schema is not None:
+        inferred.update({col : dtype for col, dtype in schema.items() if col in inferred})
+    return apply_schema(df, inferred)
+
+
+def memory_report(before_df, after_df):
+    '''
+    Compares the memory used by each column before and after compacting
+    INPUT: before_df, after_df - dataframes with the same columns
+    RETURNS: Dataframe indexed by column (with a total row) of before and after dtypes and bytes,
+             and the bytes and percentage saved
+    '''
+    report = pd.DataFrame({'before_type' : before_df.dtypes.astype(str),
+                           'after_type' : after_df.dtypes.astype(str),
+                           'before_bytes' : before_df.memory_usage(index=False, deep=True),
+                           'after_bytes' : after_df.memory_usage(index=False, deep=True)},
+                          columns=['before_type', 'after_type', 'before_bytes', 'after_bytes'])
+    report.loc['total'] = ['', '', report['before_bytes'].sum(), report['after_bytes'].sum()]
+    report['saved_bytes'] = report['before_bytes'] - report['after_bytes']
+    report['saved_pct'] = 100.0 * report['saved_bytes'] / report['before_bytes']
+    return report
+
+
+def save_schema(schema, file):
+    '''Saves a schema to a JSON file'''
+    with open(file, 'w') as f:
+        json.dump(schema, f, indent=1, sort_keys=True)
+
+
+def load_schema(file):
+    '''Loads a schema saved with `save_schema`'''
+    with open(file) as f:
+        return json.load(f)
@@ -0,0 +1,254 @@
+# Station inventory simulator for rebalancing what-if runs, stepping every station at once
+import os
+import tempfile
+from multiprocessing import Pool
+
+import pandas as pd
+import numpy as np
+
+from .occupancy import datetimes_ns
+from .profiling import profiled
+
+# Length of a simulation step
+STEP = '10min'
+
+TOTAL_COLS = ['rentals', 'returns', 'lost_rentals', 'lost_returns', 'moved', 'failed_moves']
+
+# One row per truck move, src and dst are station columns of the simulation
+MOVE_DTYPE = np.dtype([('scenario', np.int32), ('step', np.int32), ('src', np.int32), ('dst', np.int32),
+                       ('bikes', np.int32)])
+
+# Demand arrays opened read-only by each worker process, see `init_worker`
+worker_data = dict()
+
+
+def station_capacity(bikes_df, station_ids):
+    '''
+    Finds the dock capacity of each station as its largest bikes + docks snapshot
+    INPUT: bikes_df - dataframe from `load_bikes`
+           station_ids - sorted array of station_id values to return
+    RETURNS: int16 array of capacities, 0 for stations without snapshots
+    '''
+    totals = bikes_df['bikes'].values.astype(np.int64) + bikes_df['docks'].values
+    capacity = np.zeros(int(max(bikes_df['station_id'].max(), station_ids.max())) + 1, dtype=np.int64)
+    np.maximum.at(capacity, bikes_df['station_id'].values.astype(np.int64), totals)
+    return capacity[station_ids].astype(np.int16)
+
+
+def initial_bikes(store, station_ids, datetime):
+    '''Returns the bikes at each station at a time from an `OccupancyStore`, 0 where unknown'''
+    bikes, _ = store.lookup(station_ids, np.full(len(station_ids), np.datetime64(pd.Timestamp(datetime), 'ns')))
+    return np.maximum(bikes, 0).astype(np.int16)
+
+
+@profiled
+def recorded_demand(bike_trips_df, freq=STEP, station_ids=None):
+    '''
+    Totals the recorded checkouts and checkins of each station in each simulation step
+    INPUT: bike_trips_df - dataframe from `load_bike_trips`
+           freq - simulation step length
+           station_ids - optional sorted array of stations to keep, defaults to all of them
+    RETURNS: Tuple of (DatetimeIndex of step start times, station_ids, checkouts, checkins)
+             where checkouts and checkins are int16 arrays of shape (steps, stations)
+    '''
+    step_ns = pd.Timedelta(freq).value
+    all_ids = bike_trips_df['station_id'].values.astype(np.int64)
+    if station_ids is None:
+        station_ids = np.unique(all_ids)
+    station_ids = np.asarray(station_ids, dtype=np.int64)
+
+    cols = np.searchsorted(station_ids, all_ids)
+    keep = (cols < len(station_ids)) & (station_ids[np.minimum(cols, len(station_ids) - 1)] == all_ids)
+    steps = datetimes_ns(bike_trips_df.index.values) // step_ns
+    first = steps[keep].min() if keep.any() else 0
+    n_steps = int(steps[keep].max() - first + 1) if keep.any() else 0
+
+    flat = ((steps - first) * len(station_ids) + cols)[keep]
+    shape = (n_steps, len(station_ids))
+    demand = [np.bincount(flat, weights=bike_trips_df[col].values[keep], minlength=n_steps * len(station_ids))
+              .reshape(shape).astype(np.int16) for col in ('checkouts', 'checkins')]
+    times = pd.DatetimeIndex(((first + np.arange(n_steps)) * step_ns).astype('datetime64[ns]'), name='datetime')
+    return times, station_ids, demand[0], demand[1]
+
+
+def sample_demand(rates, n_scenarios, seed=None):
+    '''
+    Samples Poisson checkouts or checkins from forecast rates, one draw per scenario
+    INPUT: rates - float array of shape (steps, stations) of expected counts per step
+           n_scenarios - number of draws
+           seed - optional random seed
+    RETURNS: int16 array of shape (scenarios, steps, stations)
+    '''
+    rng = np.random.RandomState(seed)
+    return rng.poisson(rates, size=(n_scenarios,) + np.shape(rates)).astype(np.int16)
+
+
+def schedule_moves(schedule_df, times, station_ids, freq=STEP):
+    '''
+    Converts a rebalancing schedule to the moves of each simulation step
+    INPUT: schedule_df - dataframe with datetime, src, dst (station_ids) and bikes columns,
+                         one row per truck move, and optionally the scenario it belongs to
+           times - step start times from `recorded_demand`
+           station_ids - sorted station_ids of the simulation
+           freq - simulation step length, as passed to `recorded_demand`
+    RETURNS: MOVE_DTYPE array sorted by step, moves in the same step keeping their schedule
+             order. Moves are applied at the start of the step their datetime falls in, and
+             moves before the first step or at or after the end of the last step are dropped
+    '''
+    if schedule_df.empty or not len(times):
+        return np.zeros(0, dtype=MOVE_DTYPE)
+    station_ids = np.asarray(station_ids, dtype=np.int64)
+    move_times = datetimes_ns(schedule_df['datetime'].values)
+    steps = np.searchsorted(datetimes_ns(times.values), move_times, side='right') - 1
+    end = datetimes_ns(times.values[-1:])[0] + pd.Timedelta(freq).value
+    valid = (steps >= 0) & (move_times < end)
+
+    cols = dict()
+    for col in ('src', 'dst'):
+        ids = schedule_df[col].values.astype(np.int64)
+        cols[col] = np.searchsorted(station_ids, ids)
+        # searchsorted maps an unknown id to a neighbouring station, rather than failing
+        known = (cols[col] < len(station_ids)) & (station_ids[np.minimum(cols[col], len(station_ids) - 1)] == ids)
+        if not known.all():
+            raise ValueError('Schedule {} station_ids not in the simulation: {}'.format(col, np.unique(ids[~known])))
+    if (schedule_df['bikes'].values < 0).any():
+        raise ValueError('Schedule bikes must not be negative, swap src and dst instead')
+
+    moves = np.zeros(valid.sum(), dtype=MOVE_DTYPE)
+    moves['scenario'] = schedule_df['scenario'].values[valid] if 'scenario' in schedule_df else 0
+    moves['step'] = steps[valid]
+    moves['src'] = cols['src'][valid]
+    moves['dst'] = cols['dst'][valid]
+    moves['bikes'] = schedule_df['bikes'].values[valid]
+    return moves[np.argsort(moves['step'], kind='stable')]
+
+
+def apply_moves(moves, bikes, capacity, totals):
+    '''
+    Applies one step's truck moves in order. A truck picks up at most the bikes at src, and
+    drops off at most those bikes, limited by the free docks at dst. Bikes which don't fit
+    at dst stay at src. Moves are counted at their dst
+    INPUT: moves - MOVE_DTYPE rows of one step, from `schedule_moves`
+           bikes - int array of shape (scenarios, stations), updated in place
+           capacity - int array of station dock capacities
+           totals - dictionary of `simulate` totals, moved and failed_moves are updated
+    RETURNS: Nothing
+    '''
+    # Moves sharing a station depend on each other, and schedules have few moves per step
+    for scenario, src, dst, wanted in zip(moves['scenario'].tolist(), moves['src'].tolist(),
+                                          moves['dst'].tolist(), moves['bikes'].tolist()):
+        picked = min(wanted, bikes[scenario, src])
+        dropped = min(picked, capacity[dst] - bikes[scenario, dst])
+        bikes[scenario, src] -= dropped
+        bikes[scenario, dst] += dropped
+        totals['moved'][scenario, dst] += dropped
+        totals['failed_moves'][scenario, dst] += wanted - dropped
+
+
+@profiled
+def simulate(checkouts, checkins, capacity, bikes, moves=None, keep_trace=False, n_scenarios=None):
+    '''
+    Steps the bikes at every station of every scenario through the demand. In each step the
+    rebalancing moves are applied, then rentals (up to the bikes available) and returns (up to
+    the free docks). Demand which can't be met is counted as lost
+    INPUT: checkouts, checkins - int arrays of shape (steps, stations), or (scenarios, steps,
+                                 stations) for demand which differs between scenarios
+           capacity - int array of station dock capacities
+           bikes - int array of starting bikes, of shape (stations) or (scenarios, stations)
+           moves - optional array of truck moves from `schedule_moves`, see `apply_moves`
+           keep_trace - also return the bikes at each station after every step
+           n_scenarios - number of scenarios, defaults to the most found in the other inputs
+    RETURNS: Dictionary of int64 arrays of shape (scenarios, stations) with the TOTAL_COLS,
+             the final bikes, and if keep_trace, an int16 trace of shape (scenarios, steps, stations)
+    '''
+    n_steps, n_stations = np.shape(checkouts)[-2:]
+    if n_scenarios is None:
+        n_scenarios = max(np.ndim(checkouts) == 3 and len(checkouts), np.ndim(checkins) == 3 and len(checkins),
+                          np.ndim(bikes) == 2 and len(bikes),
+                          0 if moves is None or not len(moves) else int(moves['scenario'].max()) + 1, 1)
+    capacity = np.asarray(capacity, dtype=np.int32)
+    bikes = np.clip(np.broadcast_to(bikes, (n_scenarios, n_stations)), 0, capacity).astype(np.int32)
+    checkouts = np.broadcast_to(checkouts, (n_scenarios, n_steps, n_stations))
+    checkins = np.broadcast_to(checkins, (n_scenarios, n_steps, n_stations))
+
+    totals = {col : np.zeros((n_scenarios, n_stations), dtype=np.int64) for col in TOTAL_COLS}
+    trace = np.zeros((n_scenarios, n_steps, n_stations), dtype=np.int16) if keep_trace else None
+    done = np.empty((n_scenarios, n_stations), dtype=np.int32)
+    # Rows of the moves in each step, which are sorted by step
+    move_rows = np.searchsorted(moves['step'], np.arange(n_steps + 1)) if moves is not None else None
+    for step in range(n_steps):
+        if moves is not None and move_rows[step] < move_rows[step + 1]:
+            apply_moves(moves[move_rows[step]:move_rows[step + 1]], bikes, capacity, totals)
+
+        np.minimum(checkouts[:, step], bikes, out=done)
+        bikes -= done
+        totals['rentals'] += done
+        totals['lost_rentals'] += checkouts[:, step] - done
+
+        np.minimum(checkins[:, step], capacity - bikes, out=done)
+        bikes += done
+        totals['returns'] += done
+        totals['lost_returns'] += checkins[:, step] - done
+
+        if keep_trace:
+            trace[:, step] = bikes
+
+    totals['bikes'] = bikes
+    if keep_trace:
+        totals['trace'] = trace
+    return totals
+
+
+def scenario_totals(result):
+    '''Sums a `simulate` result over the stations, returning a dataframe indexed by scenario'''
+    return pd.DataFrame({col : result[col].sum(axis=1) for col in TOTAL_COLS}, columns=TOTAL_COLS,
+                        index=pd.Index(np.arange(len(result['rentals'])), name='scenario'))
+
+
+def init_worker(demand_files, capacity, bikes):
+    '''Memory-maps the demand arrays in a worker, instead of pickling them per task'''
+    worker_data['checkouts'] = np.load(demand_files[0], mmap_mode='r')
+    worker_data['checkins'] = np.load(demand_files[1], mmap_mode='r')
+    worker_data['capacity'] = capacity
+    worker_data['bikes'] = bikes
+
+
+def run_batch(batch):
+    '''Simulates a batch of (moves, n_scenarios) rebalancing plans in a worker process, returning
+    their totals'''
+    moves, n_scenarios = batch
+    result = simulate(worker_data['checkouts'], worker_data['checkins'], worker_data['capacity'],
+                      worker_data['bikes'], moves, n_scenarios=n_scenarios)
+    return scenario_totals(result)
+
+
+@profiled
+def run_scenarios(checkouts, checkins, capacity, bikes, moves, n_scenarios=None, batch_size=16, processes=None):
+    '''
+    Simulates many rebalancing plans against the same demand in a process pool
+    INPUT: checkouts, checkins, capacity, bikes - see `simulate`. The demand must be shared by
+                                                  all scenarios, of shape (steps, stations)
+           moves - array of truck moves from `schedule_moves`, one plan per scenario
+           n_scenarios - number of plans, defaults to the largest scenario in moves + 1
+           batch_size - scenarios simulated together in each task
+           processes - number of worker processes (defaults to the number of CPUs)
+    RETURNS: Dataframe indexed by scenario with the totals of each plan, see `scenario_totals`
+    '''
+    if n_scenarios is None:
+        n_scenarios = int(moves['scenario'].max()) + 1 if len(moves) else 1
+    batches = list()
+    for start in range(0, n_scenarios, batch_size):
+        batch = moves[(moves['scenario'] >= start) & (moves['scenario'] < start + batch_size)].copy()
+        batch['scenario'] -= start
+        batches.append((batch, min(batch_size, n_scenarios - start)))
+    # Save the demand once, workers memory-map it read-only
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        demand_files = [os.path.join(tmp_dir, name + '.npy') for name in ('checkouts', 'checkins')]
+        np.save(demand_files[0], checkouts)
+        np.save(demand_files[1], checkins)
+        with Pool(processes, initializer=init_worker, initargs=(demand_files, capacity, bikes)) as pool:
+            results = pool.map(run_batch, batches)
+
+    totals_df = pd.concat(results)
+    totals_df.index = pd.Index(np.arange(len(totals_df)), name='scenario')
+    return totals_df
@@ -2,101 +2,75 @@
 import pandas as pd
 import numpy as np
 
+from .cache import cached_frames, read_csv_source
+from .profiling import profiled, stage
+from .schema import apply_schema, smallest_int_type
+from .weather import clean_weather
+
 INPUT_DIR = '../input'
 
+# Bump this when a loader's output changes, so old cache entries are rebuilt
+LOADER_VERSION = '2'
+
+# Smallest column types for the bikes and stations tables. Columns are parsed as int64 and
+# narrowed to these, widening automatically if a value doesn't fit (e.g. station_id > 127)
+BIKES_SCHEMA = {'station_id' : 'int8', 'bikes' : 'int8', 'docks' : 'int8'}
+STATIONS_SCHEMA = {'station_id' : 'int8', 'lat' : 'float32', 'lon' : 'float32'}
+
 
-def load_bikes(file=INPUT_DIR + '/bikes.csv'):
+@profiled
+def load_bikes(file=INPUT_DIR + '/bikes.csv', use_cache=True):
     '''
     Load the bikes CSV file, converting column types
-    INPUT: Filename to read (defaults to `../input/bikes.csv`
+    INPUT: Filename to read (defaults to `../input/bikes.csv`, or its .zip)
+           use_cache - read and write the typed dataframe in the columnar cache
     RETURNS: Pandas dataframe containing bikes information
     '''
-    try:
-        bikes_df = pd.read_csv(file,
-                              dtype={'station_id' : np.int8,
-                                     'bikes' : np.int8,
-                                     'docks' : np.int8}
-                               )
+    def parse(path):
+        bikes_df, _ = apply_schema(read_csv_source(path), BIKES_SCHEMA)
         bikes_df['datetime'] = pd.to_datetime(bikes_df['datetime'], format='%Y-%m-%d %H:%M:%S')
-        return bikes_df
+        return (bikes_df,)
+
+    try:
+        return cached_frames('bikes', LOADER_VERSION, [file], parse, use_cache)[0]
     except OSError as e:
-        print('Error opening {0}. Do you need to unzip {0}.zip?'.format(file))
+        print('Error loading {}: {}'.format(file, e))
         return None
 
-def load_stations(file=INPUT_DIR + '/stations.csv'):
+@profiled
+def load_stations(file=INPUT_DIR + '/stations.csv', use_cache=True):
     '''
     Load the stations CSV file, converting column types
-    INPUT: Filename to read (defaults to `../input/stations.csv`
+    INPUT: Filename to read (defaults to `../input/stations.csv`, or its .zip)
+           use_cache - read and write the typed dataframe in the columnar cache
     RETURNS: Pandas dataframe containing stations information
     '''
+    def parse(path):
+        stations_df, _ = apply_schema(read_csv_source(path), STATIONS_SCHEMA)
+        stations_df['datetime'] = pd.to_datetime(stations_df['datetime'], format='%Y-%m-%d %H:%M:%S')
+        return (stations_df,)
+
     try:
-        stations_df = pd.read_csv(file,
-                                  dtype={'station_id' : np.int8,
-                                     'lat' : np.float32,
-                                     'lon' : np.float32}
-                                  )
-        stations_df['datetime'] = pd.to_datetime(stations_df['datetime'], format='%Y-%m-%d %H:%M:%S')                           
-        return stations_df
+        return cached_frames('stations', LOADER_VERSION, [file], parse, use_cache)[0]
     except OSError as e:
-        print('Error opening {0}. Do you need to unzip {0}.zip?'.format(file))
+        print('Error loading {}: {}'.format(file, e))
         return None
 
     
-def load_weather(file=INPUT_DIR + '/weather.csv'):
-    '''Loads the weather CSV and converts types'''
+@profiled
+def load_weather(file=INPUT_DIR + '/weather.csv', use_cache=True):
+    '''Loads the weather CSV (or its .zip) and converts types, using the columnar cache'''
     try:
-        df = pd.read_csv(file)
+        return cached_frames('weather', LOADER_VERSION, [file],
+                             lambda path: (parse_weather(read_csv_source(path)),), use_cache)[0]
     except OSError as e:
-        print('Error opening {0}. Do you need to unzip {0}.zip?'.format(file))
-        return None     
-    
-    # Remove whitespace and keep min/max values
-    df.columns = [col.strip() for col in df.columns]
-    df = df[['CDT','Max TemperatureF','Min TemperatureF', 
-             'Max Humidity', 'Min Humidity',
-             'Max Sea Level PressureIn', 'Min Sea Level PressureIn', 
-             'Max Wind SpeedMPH', 'Mean Wind SpeedMPH', 'Max Gust SpeedMPH',
-             'PrecipitationIn', 'CloudCover', 'Events']]
-    
-    # Clean up column names, drop means as they're a linear combination of max/min
-    df.columns = ['date', 'max_temp', 'min_temp', 'max_humidity', 'min_humidity',
-                 'max_pressure', 'min_pressure', 'max_wind', 'min_wind', 'max_gust',
-                 'precipitation', 'cloud_cover', 'events']
-    
-    # Convert column types appropriately
-    df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')  
-    df.index = df['date']
-    df = df.drop('date', axis=1)
-    
-    df[['max_temp', 'min_temp']] = df[['max_temp', 'min_temp']].astype(np.uint8)
-    df[['max_humidity', 'min_humidity']] = df[['max_humidity', 'min_humidity']].astype(np.uint8)
-    df[['max_wind', 'min_wind', 'max_gust']] = df[['max_wind', 'min_wind', 'max_gust']].astype(np.uint8)
+        print('Error loading {}: {}'.format(file, e))
+        return None
 
 
-    # Cloud cover is a fraction of 8 - 
-    # http://help.wunderground.com/knowledgebase/articles/129043-how-can-i-translate-the-cloud-cover-data-on-your
-    df['cloud_pct'] = (df['cloud_cover'].astype(np.float32) / 8.0) * 100
-    df = df.drop('cloud_cover', axis=1)
-    
-    # Precipitation sometimes has 'T' for trace amounts of rain. Replace this with small value
-    # and convert to a float
-    # http://help.wunderground.com/knowledgebase/articles/656875-what-does-t-stand-for-on-the-rain-precipitation
-    df['precipitation'] = df['precipitation'].replace('T', 0.01)
-    df['precipitation'] = df['precipitation'].astype(np.float32)
-
-    # Events are tricky. they're separated by hypens, and can have multiple values not in the same order !
-    events = set()
-    df['events'] = df['events'].replace(np.nan, 'None')
-    for row in df['events']:
-        if row is not np.nan:
-            line = row.split('-')
-            [events.add(word.lower()) for word in line]
-    
-    for event in events:
-        df[event] = df['events'].apply(str.lower).str.contains(event).astype(np.uint8)
-    
-    df = df.drop(['events', 'none'], axis=1)
-    return df
+def parse_weather(df):
+    '''Converts the raw weather dataframe columns to their types, see `weather.clean_weather`'''
+    return clean_weather(df, date_col='CDT')
 
 
 def haversine_dist(lat1, lon1, lat2, lon2, R=3961):
@@ -117,49 +91,80 @@ def haversine_dist(lat1, lon1, lat2, lon2, R=3961):
     
     return d
 
-def load_bike_trips():
-    # Sort the bikes_df dataframe by station_id first, and then datetime so we
-    # can use a diff() and get the changes by time for each station
-    bikes_df = load_bikes()
-    bikes_df = bikes_df.sort_values(['station_id', 'datetime']).copy()
-    stations = bikes_df['station_id'].unique()
-
-    # Our dataframe is grouped by station_id first now, so grab each station in
-    # turn and do a diff() on bikes and docks for each station individually
-    diff_list = list()
-    for station in stations:
-        station_diff_df = bikes_df[bikes_df['station_id'] == station].copy()
-        station_diff_df['bikes_diff'] = station_diff_df['bikes'].diff()
-        station_diff_df['docks_diff'] = station_diff_df['docks'].diff()
-        diff_list.append(station_diff_df)
-
-    # Concatenate the station dataframes back together into a single one.
-    # Make sure we didn't lose any rows in the process (!)
-    bikes_diff_df = pd.concat(diff_list)
-
-    # The first row of each station-wise diff is filled with NaNs, store a 0 in these fields
-    # then we can convert the data type from floats to int8s 
-    bikes_diff_df.fillna(0, inplace=True)
-    bikes_diff_df[['bikes_diff', 'docks_diff']] = bikes_diff_df[['bikes_diff', 'docks_diff']].astype(np.int8)
-    bikes_diff_df.index = bikes_diff_df['datetime']
-    bikes_diff_df.drop('datetime', axis=1, inplace=True)
-    assert(bikes_df.shape[0] == bikes_diff_df.shape[0]) 
-
-    bike_trips_df = bikes_diff_df
-    bike_trips_df['checkouts'] = bike_trips_df['bikes_diff']
-    bike_trips_df.loc[bike_trips_df['checkouts'] > 0, 'checkouts'] = 0
-    bike_trips_df['checkouts'] = bike_trips_df['checkouts'].abs()
-
-    # Conversely, checkins are positive `bikes_diff` values
-    bike_trips_df['checkins'] = bike_trips_df['bikes_diff']
-    bike_trips_df.loc[bike_trips_df['checkins'] < 0, 'checkins'] = 0
-    bike_trips_df['checkins'] = bike_trips_df['checkins'].abs()
+@profiled
+def diff_bike_arrays(station_ids, bikes, docks, chunk_size=None):
+    '''
+    Computes the per-station changes in bikes and docks in a single pass
+    INPUT: station_ids, bikes, docks - arrays sorted by station_id, then datetime
+           chunk_size - optional number of rows to process at once. Bounds the
+                        temporary memory used to the size of one chunk
+    RETURNS: Dictionary of signed integer arrays with bikes_diff, docks_diff, checkouts,
+             checkins and totals values for every row. The type is int8 unless the bikes
+             or docks values need a wider one
+    '''
+    num_rows = len(station_ids)
+    # Every diff is within the range of its values, so a type holding +/- the widest range can't wrap
+    max_range = max([int(values.max()) - int(values.min()) for values in (bikes, docks) if len(values)] + [0])
+    diff_type = np.promote_types(smallest_int_type(-max_range, max_range), np.int8)
+    diffs = {col: np.zeros(num_rows, dtype=diff_type) for col in
+             ('bikes_diff', 'docks_diff', 'checkouts', 'checkins', 'totals')}
+    if chunk_size is None:
+        chunk_size = max(num_rows, 1)
+
+    # The first row of each station has no previous value, so it keeps the 0 diff.
+    # Each chunk looks back one row so diffs carry over the chunk boundaries
+    for start in range(1, num_rows, chunk_size):
+        curr = slice(start, min(start + chunk_size, num_rows))
+        prev = slice(curr.start - 1, curr.stop - 1)
+        new_station = station_ids[curr] != station_ids[prev]
+
+        for col, values in (('bikes_diff', bikes), ('docks_diff', docks)):
+            out = diffs[col][curr]
+            np.subtract(values[curr], values[prev], out=out, dtype=diff_type)
+            out[new_station] = 0
+
+    # Checkouts are negative `bikes_diff` values, checkins are positive ones
+    np.minimum(diffs['bikes_diff'], 0, out=diffs['checkouts'])
+    np.negative(diffs['checkouts'], out=diffs['checkouts'])
+    np.maximum(diffs['bikes_diff'], 0, out=diffs['checkins'])
 
     # Might want to use sum of checkouts and checkins for find "busiest" stations
-    bike_trips_df['totals'] = bike_trips_df['checkouts'] + bike_trips_df['checkins']
-    
+    np.add(diffs['checkouts'], diffs['checkins'], out=diffs['totals'])
+    return diffs
+
+@profiled
+def load_bike_trips(bikes_df=None, chunk_size=None):
+    '''
+    Converts bike snapshots into checkouts and checkins at each station
+    INPUT: bikes_df - optional dataframe from `load_bikes` (loaded if not given)
+           chunk_size - optional number of rows to diff at a time, see `diff_bike_arrays`
+    RETURNS: Pandas dataframe indexed by datetime with bikes/docks diffs,
+             checkouts, checkins and totals columns
+    '''
+    if bikes_df is None:
+        bikes_df = load_bikes()
+
+    # Sort by station_id first, and then datetime so consecutive rows of each
+    # station can be differenced without splitting the table up by station
+    with stage('sort'):
+        order = np.lexsort((bikes_df['datetime'].values, bikes_df['station_id'].values))
+        station_ids = bikes_df['station_id'].values[order]
+        bikes = bikes_df['bikes'].values[order]
+        docks = bikes_df['docks'].values[order]
+    diffs = diff_bike_arrays(station_ids, bikes, docks, chunk_size)
+
+    with stage('build_frame'):
+        bike_trips_df = pd.DataFrame({'station_id' : station_ids,
+                                      'bikes' : bikes,
+                                      'docks' : docks},
+                                     index=pd.Index(bikes_df['datetime'].values[order], name='datetime'))
+        for col in ('bikes_diff', 'docks_diff', 'checkouts', 'checkins', 'totals'):
+            bike_trips_df[col] = diffs[col]
+    assert(bikes_df.shape[0] == bike_trips_df.shape[0])
+
     return bike_trips_df
 
+@profiled
 def load_daily_rentals(all_stations=False):
 
     bike_trips_df = load_bike_trips()
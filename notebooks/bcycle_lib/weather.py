@@ -0,0 +1,165 @@
+# Typed, date-indexed weather store and index-aligned weather joins
+import pandas as pd
+import numpy as np
+
+from .cache import cached_frames, read_csv_source
+from .profiling import profiled
+
+# Bump this when the store's output changes, so old cache entries are rebuilt
+STORE_VERSION = '1'
+
+# Raw weather CSV columns kept, and their clean names. Means are dropped as they're a
+# linear combination of max/min
+RAW_COLS = ['Max TemperatureF', 'Min TemperatureF',
+            'Max Humidity', 'Min Humidity',
+            'Max Sea Level PressureIn', 'Min Sea Level PressureIn',
+            'Max Wind SpeedMPH', 'Mean Wind SpeedMPH', 'Max Gust SpeedMPH',
+            'PrecipitationIn', 'CloudCover', 'Events']
+CLEAN_COLS = ['max_temp', 'min_temp', 'max_humidity', 'min_humidity',
+              'max_pressure', 'min_pressure', 'max_wind', 'min_wind', 'max_gust',
+              'precipitation', 'cloud_cover', 'events']
+
+# Column types of the cleaned weather. Event columns are all uint8
+WEATHER_TYPES = {'max_temp' : np.uint8, 'min_temp' : np.uint8,
+                 'max_humidity' : np.uint8, 'min_humidity' : np.uint8,
+                 'max_pressure' : np.float32, 'min_pressure' : np.float32,
+                 'max_wind' : np.uint8, 'min_wind' : np.uint8, 'max_gust' : np.uint8,
+                 'precipitation' : np.float32, 'cloud_pct' : np.float32}
+
+# Hour of the day the daily values are placed at before interpolating them hourly
+DAILY_HOUR = 12
+
+
+def decode_events(events):
+    '''
+    Decodes the hyphen-separated 'Events' strings into a flag column per event. Events can
+    have multiple values in any order and case, e.g. 'Rain-Thunderstorm' or 'fog-rain'
+    INPUT: events - Series of event strings, NaN for days without events
+    RETURNS: Dataframe of uint8 flags with a lower-case column per event, sorted by name
+    '''
+    events = events.fillna('').astype(str).str.lower().str.replace(' ', '')
+    events_df = events.str.get_dummies(sep='-')
+    events_df = events_df.drop([col for col in ('', 'none') if col in events_df.columns], axis=1)
+    return events_df[sorted(events_df.columns)].astype(np.uint8)
+
+
+def type_weather(df):
+    '''Converts cleaned weather columns to their WEATHER_TYPES, and any others to uint8 event flags'''
+    return df.astype({col : WEATHER_TYPES.get(col, np.uint8) for col in df.columns})
+
+
+@profiled
+def clean_weather(df, date_col=None):
+    '''
+    Cleans a raw weather dataframe into the typed daily weather store
+    INPUT: df - raw weather dataframe, as read from the CSV
+           date_col - name of the date column (defaults to the first column)
+    RETURNS: Dataframe indexed by date with WEATHER_TYPES columns and an event flag per event
+    '''
+    # Remove whitespace and keep min/max values
+    df = df.rename(columns=lambda col: col.strip())
+    date_col = df.columns[0] if date_col is None else date_col
+    index = pd.DatetimeIndex(pd.to_datetime(df[date_col], format='%Y-%m-%d'), name='date')
+    raw_df = df[RAW_COLS]
+    raw_df.columns = CLEAN_COLS
+
+    # Cloud cover is a fraction of 8 -
+    # http://help.wunderground.com/knowledgebase/articles/129043-how-can-i-translate-the-cloud-cover-data-on-your
+    # Precipitation sometimes has 'T' for trace amounts of rain. Replace this with small value
+    # http://help.wunderground.com/knowledgebase/articles/656875-what-does-t-stand-for-on-the-rain-precipitation
+    clean_df = raw_df.drop(['cloud_cover', 'events'], axis=1)
+    clean_df['precipitation'] = raw_df['precipitation'].replace('T', 0.01)
+    clean_df['cloud_pct'] = (raw_df['cloud_cover'].astype(np.float32) / 8.0) * 100
+
+    clean_df = pd.concat((clean_df, decode_events(raw_df['events'])), axis=1)
+    clean_df.index = index
+    return type_weather(clean_df)
+
+
+def parse_weather_store(path):
+    '''
+    Parses a weather CSV into the daily store. Raw weather CSVs are cleaned with `clean_weather`,
+    already-cleaned CSVs (like all_weather.csv) with a leading date column are just typed
+    RETURNS: Dataframe indexed by date
+    '''
+    df = read_csv_source(path)
+    if df.columns[0] != 'date':
+        return clean_weather(df)
+    df.index = pd.DatetimeIndex(pd.to_datetime(df['date']), name='date')
+    return type_weather(df.drop('date', axis=1))
+
+
+@profiled
+def hourly_weather(daily_df, hour=DAILY_HOUR):
+    '''
+    Interpolates the daily weather store to hourly values for the hourly models
+    INPUT: daily_df - daily weather dataframe indexed by date
+           hour - hour of the day each daily value is placed at before interpolating
+    RETURNS: Dataframe indexed by datetime with a row for every hour of every day. Temperatures,
+             humidity, pressure, wind and cloud cover are linearly interpolated (float32). Hours
+             before the first and after the last anchor keep the nearest day's value.
+             Precipitation and event flags are daily, and repeated for each hour of their day
+    '''
+    daily_df = daily_df.sort_index()
+    datetimes = pd.date_range(daily_df.index[0], daily_df.index[-1] + pd.Timedelta(hours=23),
+                              freq='h', name='datetime')
+    days = datetimes.normalize()
+
+    # Anchor the daily values at `hour` of each day and interpolate between them in time
+    interp_cols = [col for col in daily_df.columns if col in WEATHER_TYPES and col != 'precipitation']
+    anchors = daily_df.index.values.astype('datetime64[ns]').view(np.int64) + hour * 3600 * 10**9
+    hours_ns = datetimes.values.astype('datetime64[ns]').view(np.int64)
+    hourly_df = pd.DataFrame({col : np.interp(hours_ns, anchors, daily_df[col].values.astype(np.float64))
+                              .astype(np.float32) for col in interp_cols},
+                             index=datetimes, columns=interp_cols)
+
+    # Daily totals and flags are looked up by each hour's date
+    daily_cols = [col for col in daily_df.columns if col not in interp_cols]
+    day_rows = daily_df.index.get_indexer(days)
+    for col in daily_cols:
+        values = daily_df[col].values
+        hourly_df[col] = np.where(day_rows >= 0, values[day_rows], 0).astype(values.dtype)
+    return hourly_df
+
+
+@profiled
+def load_weather_store(file, use_cache=True):
+    '''
+    Loads the daily and hourly weather stores from a weather CSV (or its .zip), using the
+    columnar cache next to the trip data
+    INPUT: file - raw or cleaned weather CSV filename
+           use_cache - read and write the typed dataframes in the columnar cache
+    RETURNS: Tuple of (daily dataframe indexed by date, hourly dataframe indexed by datetime)
+    '''
+    def parse(path):
+        daily_df = parse_weather_store(path)
+        return (daily_df, hourly_weather(daily_df))
+
+    return cached_frames('weather_store', STORE_VERSION, [file], parse, use_cache)
+
+
+@profiled
+def join_weather(df, weather_df, cols=None):
+    '''
+    Joins weather onto a rentals dataframe by aligning their indexes. Hourly rentals get
+    the weather of their hour from an hourly store, or of their date from a daily store
+    INPUT: df - rentals dataframe indexed by datetime (hourly or daily)
+           weather_df - daily or hourly weather store from `load_weather_store`
+           cols - weather columns to join (default all)
+    RETURNS: Copy of df with the weather columns added, NaN where there's no weather
+    '''
+    weather_df = weather_df if cols is None else weather_df[cols]
+    index = pd.DatetimeIndex(df.index)
+    if weather_df.index.name == 'date':
+        index = index.normalize()
+    rows = weather_df.index.get_indexer(index)
+
+    joined_df = df.copy()
+    for col in weather_df.columns:
+        values = weather_df[col].values
+        if (rows < 0).any():
+            values = np.where(rows >= 0, values[rows], np.nan)
+        else:
+            values = values[rows]
+        joined_df[col] = values
+    return joined_df
@@ -0,0 +1,302 @@
+# Benchmark the bcycle_lib loaders and transforms, and the ingest scripts, on synthetic data
+
+
+from multiprocessing import get_context
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LIB_DIR = os.path.join(SCRIPTS_DIR, '..', 'notebooks')
+RESULTS_FILE = 'benchmark_results.json'
+SCALES = (1, 10, 100)
+
+# Script cases need these dataset files, which are only generated when the case is run
+SCRIPT_INPUTS = {'clean_html_data' : 'html', 'clean_xls_data' : 'xls'}
+
+# A benchmark regresses if it takes this fraction longer (or more memory) than the baseline
+THRESHOLD = 0.2
+
+# Memory growth below this many MB is noise, e.g. a case that fits in the memory used by setup
+RSS_NOISE_MB = 1.0
+
+# Run times below this many seconds are noise, e.g. scheduling jitter on a short case
+SECONDS_NOISE = 0.05
+
+# Timed runs per case by default, so short cases aren't judged on one sample
+REPEAT = 3
+
+
+def lib():
+    '''Imports bcycle_lib from the notebooks directory'''
+    if LIB_DIR not in sys.path:
+        sys.path.insert(0, LIB_DIR)
+    from bcycle_lib import utils, all_utils
+    return utils, all_utils
+
+
+# Each case does its setup and returns the function to time. Cases run with the dataset's
+# directory layout, from a `notebooks` working directory next to its `input` directory
+
+def case_load_bikes(files):
+    '''utils.load_bikes, parsing the CSV'''
+    utils, all_utils = lib()
+    return lambda: utils.load_bikes(files['bikes'], use_cache=False)
+
+def case_load_bikes_cached(files):
+    '''utils.load_bikes, from a warm columnar cache'''
+    utils, all_utils = lib()
+    utils.load_bikes(files['bikes'])
+    return lambda: utils.load_bikes(files['bikes'])
+
+def case_load_bike_trips(files):
+    '''utils.load_bike_trips on loaded bikes'''
+    utils, all_utils = lib()
+    bikes_df = utils.load_bikes(files['bikes'], use_cache=False)
+    return lambda: utils.load_bike_trips(bikes_df)
+
+def case_load_daily_rentals(files):
+    '''utils.load_daily_rentals from ../input, with a cold cache'''
+    utils, all_utils = lib()
+    return lambda: utils.load_daily_rentals(all_stations=True)
+
+def case_load_bcycle_data(files):
+    '''all_utils.load_bcycle_data, parsing the CSVs'''
+    utils, all_utils = lib()
+    return lambda: all_utils.load_bcycle_data(os.path.dirname(files['trips']), 'stations.csv', 'trips.csv',
+                                              use_cache=False)
+
+def case_clean_weather(files):
+    '''all_utils.clean_weather on the raw weather dataframe'''
+    utils, all_utils = lib()
+    weather_df = pd.read_csv(files['weather'])
+    return lambda: all_utils.clean_weather(weather_df.copy())
+
+def case_reg_x_y_split(files):
+    '''all_utils.reg_x_y_split on hourly checkouts with one-hot day-hours'''
+    utils, all_utils = lib()
+    stations_df, trips_df = all_utils.load_bcycle_data(os.path.dirname(files['trips']), 'stations.csv',
+                                                       'trips.csv', use_cache=False)
+    hourly_df = pd.DataFrame(trips_df.resample('1h').size(), columns=['checkouts'])
+    hourly_df = all_utils.add_time_features(hourly_df)
+    return lambda: all_utils.reg_x_y_split(hourly_df, target_col='checkouts', ohe_cols=['day-hour'])
+
+def case_clean_html_data(files):
+    '''clean_html_data.py parsing the HTML snapshots'''
+    import clean_html_data
+    out_dir = tempfile.mkdtemp(prefix='html_out_')
+    return lambda: clean_html_data.clean_html_files(files['html'], out_dir)
+
+def case_clean_xls_data(files):
+    '''clean_xls_data.py sorting and merging the Excel trip reports'''
+    import clean_xls_data
+    out_dir = tempfile.mkdtemp(prefix='xls_out_')
+    def run():
+        run_dir = tempfile.mkdtemp(dir=out_dir)
+        results = clean_xls_data.sort_excel_files(files['xls'], run_dir)
+        return clean_xls_data.merge_runs([result['run_file'] for result in results],
+                                         os.path.join(out_dir, 'all_trips.csv'))
+    return run
+
+CASES = (('load_bikes', case_load_bikes),
+         ('load_bikes_cached', case_load_bikes_cached),
+         ('load_bike_trips', case_load_bike_trips),
+         ('load_daily_rentals', case_load_daily_rentals),
+         ('load_bcycle_data', case_load_bcycle_data),
+         ('clean_weather', case_clean_weather),
+         ('reg_x_y_split', case_reg_x_y_split),
+         ('clean_html_data', case_clean_html_data),
+         ('clean_xls_data', case_clean_xls_data))
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    '''Returns the peak resident set size of this process (or its children) in MB'''
+    return resource.getrusage(who).ru_maxrss / 1024.0 # ru_maxrss is in KB on Linux
+
+
+def run_case(name, files, data_dir, repeat, conn):
+    '''
+    Runs one benchmark case in a fresh process, so its peak RSS isn't mixed up with other cases
+    INPUT: name - name of the case in CASES
+           files - dictionary of dataset files from `synthetic_data.make_dataset`
+           data_dir - dataset directory, containing the input directory
+           repeat - number of times to time the function. The fastest is reported
+           conn - pipe to send the result dictionary back on
+    RETURNS: Nothing
+    '''
+    # Keep the progress output of the functions out of the report
+    sys.stdout = open(os.devnull, 'w')
+    sys.stderr = sys.stdout
+    shutil.rmtree(os.path.join(data_dir, 'input', 'cache'), ignore_errors=True)
+    work_dir = os.path.join(data_dir, 'notebooks')
+    os.makedirs(work_dir, exist_ok=True)
+    sys.path.insert(0, SCRIPTS_DIR)
+    os.chdir(work_dir)
+
+    try:
+        func = dict(CASES)[name](files)
+        setup_rss = peak_rss_mb()
+        times = list()
+        for _ in range(repeat):
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        result = {'seconds' : min(times),
+                  'peak_rss_mb' : peak_rss_mb(),
+                  'setup_rss_mb' : setup_rss,
+                  'children_peak_rss_mb' : peak_rss_mb(resource.RUSAGE_CHILDREN)}
+    except Exception as e:
+        result = {'error' : '{}: {}'.format(type(e).__name__, e)}
+    conn.send(result)
+    conn.close()
+
+
+def run_benchmarks(data_dirs, cases, repeat=REPEAT, verbose=True):
+    '''
+    Runs each case on each dataset, one process per case
+    INPUT: data_dirs - dictionary of scale -> (dataset directory, files dictionary)
+           cases - list of case names to run
+           repeat - number of timed runs per case
+           verbose - print out each result
+    RETURNS: List of result dictionaries with name, scale, seconds and peak RSS values
+    '''
+    context = get_context('spawn')
+    results = list()
+    for scale, (data_dir, files) in sorted(data_dirs.items()):
+        for name in cases:
+            if name in SCRIPT_INPUTS and SCRIPT_INPUTS[name] not in files:
+                print('{:20s} {:4d}x  skipped (no {} files in {})'.format(name, scale, SCRIPT_INPUTS[name], data_dir))
+                continue
+            parent_conn, child_conn = context.Pipe(duplex=False)
+            process = context.Process(target=run_case, args=(name, files, data_dir, repeat, child_conn))
+            process.start()
+            child_conn.close()
+            try:
+                result = parent_conn.recv()
+            except EOFError:
+                result = {'error' : 'exit code {}'.format(process.exitcode)}
+            process.join()
+            result.update({'name' : name, 'scale' : scale})
+            results.append(result)
+            if verbose:
+                if 'error' in result:
+                    print('{:20s} {:4d}x  failed ({})'.format(name, scale, result['error']))
+                else:
+                    print('{:20s} {:4d}x {:9.3f}s {:9.1f} MB peak RSS {:9.1f} MB over setup'.format(
+                        name, scale, result['seconds'], result['peak_rss_mb'],
+                        result['peak_rss_mb'] - result['setup_rss_mb']))
+    return results
+
+
+def results_frame(results):
+    '''Returns a dataframe of result dictionaries with name, scale, seconds, case_rss_mb (peak
+    RSS growth over setup), children_peak_rss_mb and error columns'''
+    rows = [dict(result, case_rss_mb=result['peak_rss_mb'] - result['setup_rss_mb'])
+            if 'error' not in result else result for result in results]
+    return pd.DataFrame(rows).reindex(columns=['name', 'scale', 'seconds', 'case_rss_mb', 'children_peak_rss_mb',
+                                               'error'])
+
+
+def compare_results(results, baseline, threshold=THRESHOLD):
+    '''
+    Compares results with a baseline run. Memory is compared as the peak RSS growth of each
+    case over its setup, since the process peak includes importing the libraries and the data,
+    and as the peak RSS of its worker processes. Values below SECONDS_NOISE or RSS_NOISE_MB
+    are compared as if they were those floors
+    INPUT: results, baseline - lists of result dictionaries from `run_benchmarks`
+           threshold - allowed fractional increase in seconds or memory
+    RETURNS: Dataframe with the baseline and new values of each case found in both, and
+             a regression column set where a value grew by more than the threshold, or
+             the case failed but passed in the baseline
+    '''
+    df = pd.merge(results_frame(baseline), results_frame(results), on=['name', 'scale'], suffixes=('_base', '_new'))
+    df['seconds_ratio'] = df['seconds_new'].clip(lower=SECONDS_NOISE) / df['seconds_base'].clip(lower=SECONDS_NOISE)
+    df['rss_ratio'] = (df['case_rss_mb_new'].clip(lower=RSS_NOISE_MB) /
+                       df['case_rss_mb_base'].clip(lower=RSS_NOISE_MB))
+    df['children_rss_ratio'] = (df['children_peak_rss_mb_new'].clip(lower=RSS_NOISE_MB) /
+                                df['children_peak_rss_mb_base'].clip(lower=RSS_NOISE_MB))
+    failed = df['error_new'].notnull() & df['error_base'].isnull()
+    df['regression'] = failed | (df[['seconds_ratio', 'rss_ratio', 'children_rss_ratio']] > 1 + threshold).any(axis=1)
+    return df
+
+
+def main(argv=None):
+    '''
+    Generates the synthetic datasets, runs the benchmarks and compares them with a baseline
+    INPUT: List of arguments from the command line
+    RETURNS: Exit code to be passed to sys.exit():
+         0: Script completed successfully, with no regressions
+         1: A benchmark regressed against the baseline
+    '''
+    parser = argparse.ArgumentParser(description='Benchmark the BCycle loaders, transforms and scripts')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1], choices=SCALES,
+                        help='Multiples of the checked-in input sizes to run')
+    parser.add_argument('--cases', nargs='+', default=[name for name, case in CASES],
+                        choices=[name for name, case in CASES])
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='Timed runs per case, the fastest is kept')
+    parser.add_argument('--data-dir', help='Directory to keep the generated datasets in, to reuse them')
+    parser.add_argument('--out', default=RESULTS_FILE, help='JSON file to save the results to')
+    parser.add_argument('--baseline', help='JSON results file to compare against')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Fractional slowdown or memory growth counted as a regression')
+    args = parser.parse_args(argv)
+
+    import synthetic_data
+    root_dir = args.data_dir if args.data_dir is not None else tempfile.mkdtemp(prefix='bcycle_bench_')
+    data_dirs = dict()
+    try:
+        for scale in args.scales:
+            data_dir = os.path.join(root_dir, 'scale_{}'.format(scale))
+            files_json = os.path.join(data_dir, 'files.json')
+            files = dict()
+            if os.path.exists(files_json):
+                with open(files_json) as f:
+                    files = json.load(f)
+            # Regenerate a reused dataset which is missing the inputs of a script case
+            needed = set(SCRIPT_INPUTS[name] for name in args.cases if name in SCRIPT_INPUTS)
+            if not files or not needed.issubset(files):
+                print('Generating {}x dataset in {}'.format(scale, data_dir))
+                files = synthetic_data.make_dataset(data_dir, scale,
+                                                    html='html' in needed or 'html' in files,
+                                                    xls='xls' in needed or 'xls' in files)
+                with open(files_json, 'w') as f:
+                    json.dump(files, f)
+            data_dirs[scale] = (data_dir, files)
+
+        results = run_benchmarks(data_dirs, args.cases, args.repeat)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(root_dir)
+
+    with open(args.out, 'w') as f:
+        json.dump({'python' : platform.python_version(),
+                   'numpy' : np.__version__,
+                   'pandas' : pd.__version__,
+                   'machine' : platform.node(),
+                   'time' : time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'results' : results}, f, indent=1)
+    print('Saved results to {}'.format(args.out))
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    compare_df = compare_results(results, baseline, args.threshold)
+    print(compare_df.to_string(index=False))
+    if compare_df['regression'].any():
+        print('Regressions found (threshold {:.0%})'.format(args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
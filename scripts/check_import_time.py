@@ -0,0 +1,82 @@
+# Check the bcycle_lib core modules import quickly, without the plotting and model dependencies
+
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks')
+
+# Modules which should import without any of HEAVY_MODULES
+CORE_MODULES = ['bcycle_lib.utils', 'bcycle_lib.all_utils', 'bcycle_lib.cache', 'bcycle_lib.weather',
+                'bcycle_lib.rollup', 'bcycle_lib.occupancy', 'bcycle_lib.episodes', 'bcycle_lib.geo',
+                'bcycle_lib.predict', 'bcycle_lib.model_search', 'bcycle_lib.schema',
+                'bcycle_lib.bike_index', 'bcycle_lib.simulate', 'bcycle_lib.profiles',
+                'bcycle_lib.decimate', 'bcycle_lib.quality']
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'sklearn', 'scipy']
+
+# Seconds a module may take to import, on top of numpy and pandas
+BUDGET = 0.25
+
+# Run in a fresh interpreter, so nothing is imported already
+IMPORT_CODE = '''
+import json, sys, time
+start = time.perf_counter()
+import numpy, pandas
+base = time.perf_counter()
+import {module}
+end = time.perf_counter()
+print(json.dumps({{'base_seconds' : base - start, 'seconds' : end - base,
+                  'heavy' : [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+
+def time_import(module, repeat=3):
+    '''
+    Times importing a module in fresh Python processes
+    INPUT: module - module name to import
+           repeat - number of processes to run. The fastest import is reported
+    RETURNS: Dictionary with the module's import seconds (after numpy and pandas), the
+             numpy and pandas import seconds, and the HEAVY_MODULES it loaded
+    '''
+    results = list()
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_CODE.format(module=module, heavy=HEAVY_MODULES)],
+                                         cwd=LIB_DIR)
+        results.append(json.loads(output.decode().strip().splitlines()[-1]))
+    return min(results, key=lambda result: result['seconds'])
+
+
+def main(argv=None):
+    '''
+    Checks each core module against the import time budget
+    INPUT: List of arguments from the command line
+    RETURNS: Exit code to be passed to sys.exit():
+         0: All modules are within budget
+         1: A module is over budget or imports a heavy dependency
+    '''
+    parser = argparse.ArgumentParser(description='Check bcycle_lib import times')
+    parser.add_argument('--budget', type=float, default=BUDGET,
+                        help='Seconds allowed per module on top of importing numpy and pandas')
+    parser.add_argument('--repeat', type=int, default=3, help='Imports timed per module, the fastest is kept')
+    parser.add_argument('modules', nargs='*', default=CORE_MODULES)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module in args.modules:
+        result = time_import(module, args.repeat)
+        problems = list()
+        if result['seconds'] > args.budget:
+            problems.append('over {:.2f}s budget'.format(args.budget))
+        if result['heavy']:
+            problems.append('imports {}'.format(', '.join(result['heavy'])))
+        failed = failed or bool(problems)
+        print('{:26s} {:6.3f}s  {}'.format(module, result['seconds'], '; '.join(problems) or 'ok'))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,26 @@
 # Process HTML files to generate a csv of bikes at each station, and station locations
 
 
-from os import listdir
 from glob import glob
+from multiprocessing import Pool
+import argparse
+import os
 import re
-import copy
+import sys
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from manifest import new_manifest, load_manifest, save_manifest, new_files, add_files, compact_if_due, COMPACT_EVERY
+
+# The data-quality checks are in the notebooks' library
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+from bcycle_lib.quality import SnapshotScanner, concat_issues, issue_counts
+
 HTML_DIR = '../data/html'
 DATA_DIR = '../input'
+MANIFEST_FILE = 'html_manifest.json'
 
 LAT_IDX = 0
 LONG_IDX = 1
@@ -20,9 +30,11 @@ STAT_ADDRESS = 1
 STAT_BIKES = 2
 STAT_DOCKS = 3
 
-files = glob(HTML_DIR + '/*.html')
-# num_files = len(files)
-# print('Found {} files'.format(len(files)))
+BIKES_COLS = ['station_id', 'datetime', 'bikes', 'docks']
+STATIONS_COLS = ['station_id', 'name', 'address', 'lat', 'lon', 'datetime']
+
+# Number of bike rows to collect from the workers before appending them to the CSV
+WRITE_ROWS = 100000
 
 date_re = re.compile('.*stations_(\d{4}-\d{2}-\d{2}).*\.html')
 time_re = re.compile('.*stations_\d{4}-\d{2}-\d{2}_(\d{2}:\d{2}:)\d{2}.*\.html')
@@ -33,86 +45,221 @@ station_re = re.compile('^var marker = new createMarker\(point, \"<div class=\'m
 <div style=\'float: left; width: 50%\'><h3>(\d+)</h3>Docks</div></div>\"')
 latlong_re = re.compile('var point = new google\.maps\.LatLng\((.+), (.+)\);')
 
-# Dictionary to store stations (fast lookup by lat/lon)
-stations = dict()
-station_id = 1
-# List to store the bike values for each station in a series
-bike_list = list()
-
+# Cheap checks done before running the regexes on a line
+STATION_PREFIX = 'var marker = new createMarker('
+LATLONG_PREFIX = 'var point = new google.maps.LatLng('
 
-file_counter = 0
-verbose = False
-short_run = False
-
-for bike_idx, bike_filename in tqdm(enumerate(files),  total=len(files)):
-    file_counter += 1
-    if short_run and (file_counter == 10):
-        break
 
+def file_datetime(bike_filename):
+    '''Returns the datetime string encoded in an HTML snapshot filename'''
     date = str(date_re.match(bike_filename).groups(0)[0])
     time = str(time_re.match(bike_filename).groups(0)[0])
     time += '00'
-    datetime_string = date + ' ' + time
+    return date + ' ' + time
+
+
+def parse_html_file(bike_filename):
+    '''
+    Parses one HTML snapshot into a compact columnar chunk
+    INPUT: bike_filename - HTML file to parse
+    RETURNS: Dictionary with the snapshot `datetime` string, a list of `stations`
+             (latlon, name, address) in the order they appear, and `station_idx`,
+             `bikes` and `docks` arrays with one value per station marker.
+             `station_idx` indexes into the file's `stations` list
+    '''
+    stations = list()
+    latlon_idx = dict()
+    station_idx = list()
+    bikes = list()
+    docks = list()
+    latlon = None
 
     with open(bike_filename, 'r') as bike_file:
         for line in bike_file:
-            # print line
             # Check for latitude and longitude
-            match = latlong_re.match(line)
-            if (match != None):
-                latitude = float(latlong_re.match(line).groups()[LAT_IDX])
-                longitude = float(latlong_re.match(line).groups()[LONG_IDX])
-                latlon = (latitude, longitude)
-                if verbose:
-                    print('Found lat {}, lon {}'.format(latitude, longitude))
-
-            match = station_re.match(line)
-            if (match != None):
-
-                name = str(station_re.match(line).groups()[STAT_NAME])
-                address = str(station_re.match(line).groups()[STAT_ADDRESS].replace('<br />', ', '))
-                # address.replace('<br />', ', ')
-                bikes = int(station_re.match(line).groups()[STAT_BIKES])
-                docks = int(station_re.match(line).groups()[STAT_DOCKS])
-
-                if (latlon not in stations):
-                    new_station = dict()
-                    new_station['station_id'] = station_id
-                    new_station['name'] = name
-                    new_station['address'] = address
-                    new_station['lat'] = latitude
-                    new_station['lon'] = longitude
-                    new_station['datetime'] = datetime_string
-                    stations[latlon] = new_station
-
-                    station_id += 1
-                    if verbose:
-                        print('Adding new station: {}'.format(new_station))
-
-                new_bike = dict()
-                new_bike['station_id'] = stations[latlon]['station_id']
-                new_bike['latlon'] = latlon
-                new_bike['datetime'] = datetime_string
-                new_bike['bikes'] = bikes
-                new_bike['docks'] = docks
-                bike_list.append(new_bike)
+            if line.startswith(LATLONG_PREFIX):
+                match = latlong_re.match(line)
+                if match is not None:
+                    groups = match.groups()
+                    latlon = (float(groups[LAT_IDX]), float(groups[LONG_IDX]))
+
+            elif line.startswith(STATION_PREFIX):
+                match = station_re.match(line)
+                if match is not None:
+                    groups = match.groups()
+                    if latlon not in latlon_idx:
+                        latlon_idx[latlon] = len(stations)
+                        stations.append((latlon,
+                                         str(groups[STAT_NAME]),
+                                         str(groups[STAT_ADDRESS].replace('<br />', ', '))))
+                    station_idx.append(latlon_idx[latlon])
+                    bikes.append(int(groups[STAT_BIKES]))
+                    docks.append(int(groups[STAT_DOCKS]))
+
+    return {'datetime' : file_datetime(bike_filename),
+            'stations' : stations,
+            'station_idx' : np.array(station_idx, dtype=np.int32),
+            'bikes' : np.array(bikes, dtype=np.int16),
+            'docks' : np.array(docks, dtype=np.int16)}
+
+
+def add_stations(chunk, stations):
+    '''
+    Registers any new stations in a parsed chunk, assigning them the next station_id
+    INPUT: chunk - dictionary returned by `parse_html_file`
+           stations - dictionary of station records keyed by (lat, lon), updated in place
+    RETURNS: Array of station_ids for each row in the chunk
+    '''
+    local_ids = np.zeros(len(chunk['stations']), dtype=np.int32)
+    for idx, (latlon, name, address) in enumerate(chunk['stations']):
+        if latlon not in stations:
+            new_station = dict()
+            new_station['station_id'] = len(stations) + 1
+            new_station['name'] = name
+            new_station['address'] = address
+            new_station['lat'] = latlon[LAT_IDX]
+            new_station['lon'] = latlon[LONG_IDX]
+            new_station['datetime'] = chunk['datetime']
+            stations[latlon] = new_station
+        local_ids[idx] = stations[latlon]['station_id']
+    return local_ids[chunk['station_idx']]
+
+
+def write_bikes(chunks, bikes_file, header):
+    '''Appends a list of (station_ids, chunk) tuples to the open bikes CSV file, returning
+    the rows written as a dataframe'''
+    bikes_df = pd.DataFrame({'station_id' : np.concatenate([ids for ids, chunk in chunks]),
+                             'datetime' : np.concatenate([np.repeat(chunk['datetime'], len(ids))
+                                                          for ids, chunk in chunks]),
+                             'bikes' : np.concatenate([chunk['bikes'] for ids, chunk in chunks]),
+                             'docks' : np.concatenate([chunk['docks'] for ids, chunk in chunks])})
+    bikes_df = bikes_df[BIKES_COLS]
+    bikes_df.to_csv(bikes_file, index=False, header=header)
+    return bikes_df
+
+
+def scan_bikes(scanner, bikes_df):
+    '''Checks a batch of rows from `write_bikes` with a `SnapshotScanner`, returning the issues'''
+    return scanner.update(bikes_df.assign(datetime=pd.to_datetime(bikes_df['datetime'])))
+
+
+def clean_html_files(files, out_dir, processes=None, verbose=False, stations=None, append=False):
+    '''
+    Parses HTML snapshots in parallel, writing bikes.csv and stations.csv. Each batch of bikes
+    is checked as it's written, and the data-quality issues are saved to bikes_issues.csv,
+    with rows counted from the first row written in this run
+    INPUT: files - list of HTML files, in the order station_ids should be assigned
+           out_dir - directory to write the CSV files into
+           processes - number of worker processes (defaults to the number of CPUs)
+           verbose - print out each batch as it's written
+           stations - station registry from a previous run, keyed by (lat, lon).
+                      New stations are added to it, existing ones keep their station_id
+           append - append to an existing bikes.csv instead of overwriting it
+    RETURNS: Dictionary of station records keyed by (lat, lon)
+    '''
+    if stations is None:
+        stations = dict()
+    bikes_filename = out_dir + '/bikes.csv'
+    append = append and os.path.exists(bikes_filename) and os.path.getsize(bikes_filename) > 0
+    pending = list()
+    pending_rows = 0
+    num_rows = 0
+    header = not append
+    first_datetime = None
+    last_datetime = None
+    scanner = SnapshotScanner()
+    issues = list()
+
+    with Pool(processes) as pool, open(bikes_filename, 'a' if append else 'w') as bikes_file:
+        # imap returns the chunks in file order, so station_ids match a serial run
+        for chunk in tqdm(pool.imap(parse_html_file, files, chunksize=16), total=len(files)):
+            station_ids = add_stations(chunk, stations)
+            if len(station_ids) == 0:
+                continue
+            if first_datetime is None:
+                first_datetime = chunk['datetime']
+            last_datetime = chunk['datetime']
+
+            pending.append((station_ids, chunk))
+            pending_rows += len(station_ids)
+            if pending_rows >= WRITE_ROWS:
                 if verbose:
-                    print('Lat = {}, lon = {}, bikes = {}, docks = {}'.format(latitude, longitude, bikes, docks))
-                # print 'Found {} stations'.format(len(station_list))
+                    print('Writing {} rows up to {}'.format(pending_rows, last_datetime))
+                issues.append(scan_bikes(scanner, write_bikes(pending, bikes_file, header)))
+                header = False
+                num_rows += pending_rows
+                pending = list()
+                pending_rows = 0
+
+        if pending:
+            issues.append(scan_bikes(scanner, write_bikes(pending, bikes_file, header)))
+            num_rows += pending_rows
+        elif header and num_rows == 0:
+            bikes_file.write(','.join(BIKES_COLS) + '\n')
+
+    print('Found {} stations'.format(len(stations)))
+    print('Found {} records from {} to {}'.format(num_rows, first_datetime, last_datetime))
+    if issues:
+        issues_df = concat_issues(issues)
+        issues_df.to_csv(out_dir + '/bikes_issues.csv', index=False)
+        print('Found {} data-quality issues:\n{}'.format(len(issues_df), issue_counts(issues_df)))
+
+    stations_df = pd.DataFrame.from_dict(stations, orient='index')
+    stations_df = stations_df.reindex(columns=STATIONS_COLS)
+    stations_df.sort_values('station_id', ascending=True, inplace=True)
+    stations_df.to_csv(out_dir + '/stations.csv', index=False)
+    return stations
+
+
+def registry_from_manifest(manifest):
+    '''Rebuilds the station registry keyed by (lat, lon) from the manifest'''
+    return {(station['lat'], station['lon']) : station for station in manifest.get('stations', list())}
+
+
+def main(argv=None):
+    '''
+    Function called to run main script
+    INPUT: List of arguments from the command line
+    RETURNS: Exit code to be passed to sys.exit():
+         0: Script completed successfully
+    '''
+    parser = argparse.ArgumentParser(description='Convert station HTML snapshots to CSV files')
+    parser.add_argument('--html-dir', default=HTML_DIR, help='Directory with stations_*.html files')
+    parser.add_argument('--out-dir', default=DATA_DIR, help='Directory to write CSV files into')
+    parser.add_argument('--processes', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--short-run', action='store_true', help='Only process the first 10 files')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process files not in the manifest, appending to bikes.csv')
+    parser.add_argument('--compact-every', type=int, default=COMPACT_EVERY,
+                        help='Sort and de-duplicate the rows appended to bikes.csv after this many '
+                             'incremental runs. Rows older than the last compaction rewrite the whole file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    # The manifest holds the processed files and the station registry, so
+    # station_ids stay the same from one incremental run to the next
+    manifest_filename = args.out_dir + '/' + MANIFEST_FILE
+    manifest = load_manifest(manifest_filename) if args.incremental else new_manifest()
+
+    files = glob(args.html_dir + '/*.html')
+    if args.incremental:
+        files = new_files(files, manifest)
+        print('Found {} new files'.format(len(files)))
+    if args.short_run:
+        files = files[:10]
 
+    stations = clean_html_files(files, args.out_dir, args.processes, args.verbose,
+                                stations=registry_from_manifest(manifest),
+                                append=args.incremental)
 
-print('Found {} stations'.format(len(stations)))
-print('Found records from {} to {}'.format(bike_list[0]['datetime'], bike_list[-1]['datetime']))
+    add_files(manifest, files)
+    manifest['stations'] = sorted(stations.values(), key=lambda station: station['station_id'])
+    if args.incremental and files:
+        compact_if_due(manifest, args.out_dir + '/bikes.csv', sort_cols=['datetime', 'station_id'],
+                       dedupe_cols=['station_id', 'datetime'], compact_every=args.compact_every)
+    save_manifest(manifest, manifest_filename)
+    return 0
 
-# print('Converting station and bike data to csv file')
-#
-# # Convert to pandas dataframes
-# # stations_inv_dict = {v: k for k, v in stations_dict.items()}
-stations_df = pd.DataFrame.from_dict(stations, orient='index')
-stations_df = stations_df[['station_id', 'name', 'address', 'lat', 'lon', 'datetime']]
-stations_df.sort_values('station_id', ascending=True, inplace=True)
-stations_df.to_csv(DATA_DIR + '/stations.csv', index=False)
 
-bikes_df = pd.DataFrame(bike_list)
-bikes_df = bikes_df[['station_id', 'datetime', 'bikes', 'docks']]
-bikes_df.to_csv(DATA_DIR + '/bikes.csv', index=False)
+if __name__ == '__main__':
+    sys.exit(main())
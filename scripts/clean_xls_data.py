@@ -1,23 +1,37 @@
-# Process HTML files to generate a csv of bikes at each station, and station locations
+# Sort the Excel trip reports and merge them into one csv of trips, ordered by checkout date
 
 
-from os import listdir
-from glob import glob
-import re
-import copy
-
-import pandas as pd
-from tqdm import tqdm
-import os
+import argparse
+import csv
 import fnmatch
+import heapq
+import os
+import shutil
 import sys
+import tempfile
+from functools import partial
+from multiprocessing import Pool
 
 import numpy as np
-import scipy as sp
 import pandas as pd
+from tqdm import tqdm
+
+from manifest import new_manifest, load_manifest, save_manifest, new_files, add_files, compact_if_due, COMPACT_EVERY
+
+# The data-quality checks are in the notebooks' library
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'notebooks'))
+from bcycle_lib.quality import TripScanner, NO_ID, concat_issues, issue_counts
 
 XLS_DIR = '../data/AustinBcycleTripData'
 OUT_FILE = '../input/all_trips.csv'
+MANIFEST_FILE = '../input/all_trips_manifest.json'
+ISSUES_FILE = '../input/all_trips_issues.csv'
+SORT_COL = 'Checkout Date'
+
+# Trip report columns checked by the TripScanner
+TIME_COL = 'Checkout Time'
+BIKE_COL = 'Bike'
+DURATION_COL = 'Duration (Minutes)'
 
 def find_excel_files(dir, filematch):
     '''Finds all Excel files under the given directory matching filename
@@ -38,31 +52,111 @@ def find_excel_files(dir, filematch):
             xls_files.append(xls_file)
     return xls_files
 
-def read_excel_files(xls_files):
-    '''Reads in all the excel files a single pandas dataframe
-    INPUT: List of filenames of Excel files
-    RETURNS: Pandas dataframe with concatenated result
+def scan_frame(xls_df):
     '''
-
-    xls_dfs = list()
-    col_names = None
-
-    for file in tqdm(xls_files, desc='Reading Excel files'):
-        xls_df = pd.read_excel(file)
-        xls_df.columns = xls_df.columns.str.strip()
-        if col_names is None:
-            col_names = xls_df.columns
-        else:
-            # Need to strip leading and trailing whitespace from column names for exact match
-            assert col_names.equals(xls_df.columns), 'Error - column name mismatch in {}. \nExpected {}, \nActual {}'.\
-                format(file, col_names, xls_df.columns)
-        xls_dfs.append(xls_df)
-
-    xls_df = pd.concat(xls_dfs, ignore_index=True)
-    return xls_df
-
-
-
+    Types the trips of a trip report for a `TripScanner`
+    INPUT: xls_df - trip report dataframe
+    RETURNS: Dataframe indexed by checkout datetime with bike_id, duration, checkout_id and
+             checkin_id columns, without the trips missing any of them. The report's kiosks
+             are names, so the station ids are NO_ID. None if the report lacks the columns
+    '''
+    if not set([SORT_COL, TIME_COL, BIKE_COL, DURATION_COL]).issubset(xls_df.columns):
+        return None
+    datetimes = pd.to_datetime(xls_df[SORT_COL].astype(str) + ' ' + xls_df[TIME_COL].astype(str), errors='coerce')
+    trips_df = pd.DataFrame({'bike_id' : pd.to_numeric(xls_df[BIKE_COL], errors='coerce').values,
+                             'duration' : pd.to_numeric(xls_df[DURATION_COL], errors='coerce').values},
+                            index=pd.DatetimeIndex(datetimes, name='datetime'))
+    trips_df = trips_df[trips_df.index.notnull() & trips_df.notnull().all(axis=1).values]
+    trips_df = trips_df.astype(np.int64)
+    trips_df['checkout_id'] = NO_ID
+    trips_df['checkin_id'] = NO_ID
+    return trips_df
+
+
+def sort_excel_file(file, run_dir):
+    '''Reads one Excel file in a worker process, and writes it as a sorted CSV run
+    INPUT: file - Excel filename
+           run_dir - directory to write the sorted run into
+    RETURNS: Dictionary with the file, its column names, run filename, row count, null counts
+             and the trips to check from `scan_frame`
+    '''
+    xls_df = pd.read_excel(file)
+    # Need to strip leading and trailing whitespace from column names for exact match
+    xls_df.columns = xls_df.columns.str.strip()
+    # Missing dates go last in each run, as `merge_runs` compares them
+    xls_df = xls_df.sort_values(SORT_COL, kind='mergesort')
+    # Files in different directories can share a name, so let tempfile pick the run's name
+    run_fd, run_file = tempfile.mkstemp(suffix='.csv', dir=run_dir)
+    os.close(run_fd)
+    xls_df.to_csv(run_file, index=False)
+    return {'file' : file,
+            'columns' : list(xls_df.columns),
+            'run_file' : run_file,
+            'rows' : xls_df.shape[0],
+            'nulls' : xls_df.isnull().sum(axis=0),
+            'trips' : scan_frame(xls_df)}
+
+
+def sort_excel_files(xls_files, run_dir, col_names=None, processes=None):
+    '''Reads the excel files in a process pool, writing each one as a sorted CSV run. The
+    trips of each file are checked by a `TripScanner` as they arrive
+    INPUT: xls_files - list of filenames of Excel files
+           run_dir - directory to write the sorted runs into
+           col_names - expected column names (defaults to the first file read)
+           processes - number of worker processes (defaults to the number of CPUs)
+    RETURNS: List of result dictionaries from `sort_excel_file`, in file order, with the
+             trips replaced by their data-quality `issues` and a file column. Issue rows count
+             the checked trips of all the files
+    '''
+    results = list()
+    scanner = TripScanner()
+    with Pool(processes) as pool:
+        # Check each file's columns as soon as it has been read. The files are scanned in
+        # order, so bike overlaps between consecutive reports are found
+        for result in tqdm(pool.imap(partial(sort_excel_file, run_dir=run_dir), xls_files),
+                           total=len(xls_files), desc='Reading Excel files'):
+            if col_names is None:
+                col_names = result['columns']
+            else:
+                assert col_names == result['columns'], \
+                    'Error - column name mismatch in {}. \nExpected {}, \nActual {}'.\
+                    format(result['file'], col_names, result['columns'])
+            trips_df = result.pop('trips')
+            if trips_df is not None:
+                result['issues'] = scanner.update(trips_df).assign(file=result['file'])
+            results.append(result)
+    return results
+
+
+def merge_runs(run_files, out_file, append=False):
+    '''K-way merges sorted CSV runs into a single sorted CSV file, one row at a time
+    INPUT: run_files - list of CSV files, each sorted by SORT_COL
+           out_file - CSV file to write
+           append - append rows to an existing out_file without writing the header
+    RETURNS: Number of rows written
+    '''
+    if not run_files:
+        return 0
+
+    run_handles = [open(run_file, newline='') for run_file in run_files]
+    try:
+        readers = [csv.reader(handle) for handle in run_handles]
+        headers = [next(reader) for reader in readers]
+        sort_idx = headers[0].index(SORT_COL)
+        num_rows = 0
+        with open(out_file, 'a' if append else 'w', newline='') as out_handle:
+            writer = csv.writer(out_handle)
+            if not append:
+                writer.writerow(headers[0])
+            # Dates are written in ISO format, so comparing the strings sorts them by time.
+            # Missing dates ('') go last, like the pandas sort of each run
+            for row in heapq.merge(*readers, key=lambda row: (row[sort_idx] == '', row[sort_idx])):
+                writer.writerow(row)
+                num_rows += 1
+    finally:
+        for handle in run_handles:
+            handle.close()
+    return num_rows
 
 
 def main(argv=None):
@@ -75,24 +169,55 @@ def main(argv=None):
     '''
 
 
-    if argv is None:
-        arg = sys.argv
+    parser = argparse.ArgumentParser(description='Combine Excel trip reports into a CSV file')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only read files not in the manifest, appending to the CSV file')
+    parser.add_argument('--compact-every', type=int, default=COMPACT_EVERY,
+                        help='Sort the rows appended to the CSV file by checkout date after this many '
+                             'incremental runs. Rows older than the last compaction rewrite the whole file')
+    parser.add_argument('--processes', type=int, default=None, help='Number of worker processes')
+    args = parser.parse_args(argv)
 
     # Find all Excel files stored in directories under XLS_DIR
     # print('Finding Excel files...')
-    excel_files = find_excel_files(XLS_DIR, 'TripReport-*.xlsx')
+    excel_files = sorted(find_excel_files(XLS_DIR, 'TripReport-*.xlsx'))
     # print('Found {} Excel files'.format(len(excel_files)))
 
-    xls_df = read_excel_files(excel_files)
-    xls_df = xls_df.sort_values('Checkout Date')
-    print('Dataframe head():\n{}\n'.format(xls_df.head()))
-    print('Dataframe null values:\n{}\n'.format(xls_df.isnull().sum(axis=0)))
-    print('Dataframe info:\n{}'.format(xls_df.info()))
-
-    xls_df.to_csv(OUT_FILE, index=False)
-
-    # For each of the files, read in and create pandas dataframe
-    # Combine all the pandas in together
+    manifest = load_manifest(MANIFEST_FILE) if args.incremental else new_manifest()
+    append = args.incremental and os.path.exists(OUT_FILE)
+    if args.incremental:
+        excel_files = new_files(excel_files, manifest)
+        print('Found {} new Excel files'.format(len(excel_files)))
+        if not excel_files:
+            return 0
+
+    # Each file is sorted into its own run on disk, then the runs are merged, so
+    # only one file per worker is held in memory at a time
+    run_dir = tempfile.mkdtemp(prefix='trip_runs_', dir=os.path.dirname(OUT_FILE))
+    try:
+        results = sort_excel_files(excel_files, run_dir, manifest.get('columns'), args.processes)
+        # Appended files are sorted among themselves, compacting sorts the whole CSV
+        num_rows = merge_runs([result['run_file'] for result in results], OUT_FILE, append)
+    finally:
+        shutil.rmtree(run_dir)
+
+    print('Wrote {} rows from {} files to {}\n'.format(num_rows, len(results), OUT_FILE))
+    if results:
+        print('Dataframe null values:\n{}\n'.format(sum(result['nulls'] for result in results)))
+        manifest['columns'] = results[0]['columns']
+    issues = [result['issues'] for result in results if 'issues' in result]
+    if issues:
+        issues_df = concat_issues(issues)
+        issues_df.to_csv(ISSUES_FILE, index=False)
+        print('Found {} data-quality issues, saved to {}:\n{}\n'.format(len(issues_df), ISSUES_FILE,
+                                                                        issue_counts(issues_df)))
+
+    add_files(manifest, excel_files)
+    if append:
+        compact_if_due(manifest, OUT_FILE, sort_cols=[SORT_COL],
+                       compact_every=args.compact_every)
+    save_manifest(manifest, MANIFEST_FILE)
+    return 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,186 @@
+# Manifest of processed source files, used by the scripts' incremental mode
+
+
+from collections import deque
+from itertools import groupby, islice
+import csv
+import heapq
+import json
+import os
+import shutil
+import tempfile
+
+# Compact the output CSV after this many incremental appends
+COMPACT_EVERY = 50
+
+# Appended rows sorted in memory at once when compacting, larger appends are merged from runs
+RUN_ROWS = 1000000
+
+# Bytes read back from the end of the compacted rows to find the last one
+TAIL_BYTES = 65536
+
+
+def new_manifest():
+    '''Returns an empty manifest, for a run which starts from scratch'''
+    return {'files' : dict(), 'appends' : 0}
+
+
+def load_manifest(path):
+    '''
+    Loads the manifest written by a previous run
+    INPUT: path - JSON manifest filename
+    RETURNS: Dictionary with `files` (processed source files), `appends` (count of
+             appends since the output was last compacted) and any script-specific state.
+             An empty manifest is returned if the file doesn't exist
+    '''
+    if not os.path.exists(path):
+        return new_manifest()
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path):
+    '''Writes the manifest to a temporary file first, so a failed write keeps the old one'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def new_files(files, manifest):
+    '''Returns the files which aren't in the manifest yet, sorted by filename'''
+    return sorted(file for file in files if os.path.basename(file) not in manifest['files'])
+
+
+def add_files(manifest, files):
+    '''Records files as processed in the manifest'''
+    for file in files:
+        stat = os.stat(file)
+        manifest['files'][os.path.basename(file)] = {'size' : stat.st_size,
+                                                     'mtime_ns' : stat.st_mtime_ns}
+
+
+def sort_value(value):
+    '''Returns a CSV field as a sort key: numbers in numeric order, then other strings, then
+    missing values, like pandas sorts a column of one type'''
+    if value == '':
+        return (2, '')
+    try:
+        return (0, float(value))
+    except ValueError:
+        return (1, value)
+
+
+def csv_rows(handle, stop=None):
+    '''Yields the CSV rows of a binary file handle from its position, up to the byte offset stop'''
+    def lines():
+        for line in iter(handle.readline, b''):
+            yield line.decode()
+            if stop is not None and handle.tell() >= stop:
+                return
+    # Blank lines are skipped, as pandas does
+    return (row for row in csv.reader(lines()) if row)
+
+
+def last_rows(rows, key):
+    '''Keeps the last of each group of rows with the same key, from sorted rows'''
+    for _, group in groupby(rows, key=key):
+        yield deque(group, maxlen=1)[0]
+
+
+def write_runs(rows, key, run_dir, run_rows=RUN_ROWS):
+    '''
+    Sorts rows into CSV runs of up to run_rows rows each
+    RETURNS: Tuple of (list of run filenames, list of the key of each run's first row)
+    '''
+    run_files = list()
+    first_keys = list()
+    for chunk in iter(lambda: list(islice(rows, run_rows)), []):
+        chunk.sort(key=key)
+        run_files.append(os.path.join(run_dir, 'run_{}.csv'.format(len(run_files))))
+        first_keys.append(key(chunk[0]))
+        with open(run_files[-1], 'w', newline='') as f:
+            csv.writer(f, lineterminator='\n').writerows(chunk)
+    return run_files, first_keys
+
+
+def compact_csv(path, sort_cols, dedupe_cols=None, sorted_bytes=0):
+    '''
+    Sorts the rows appended to a CSV file since it was last compacted, dropping duplicated rows.
+    The appended rows are sorted in runs of RUN_ROWS and merged, like `merge_runs` in
+    clean_xls_data.py. If they all sort after the compacted rows, only the end of the file is
+    rewritten, so the cost is proportional to the new rows. Otherwise (e.g. late data) the
+    compacted rows are merged with them into a new file, streaming the whole history once
+    INPUT: path - CSV filename to compact in place
+           sort_cols - columns to sort by. The sort is stable so equal rows keep their order
+           dedupe_cols - columns identifying a row, the same as sort_cols in any order.
+                         Only the last appended copy is kept
+           sorted_bytes - size of the file when it was last compacted, 0 to sort all of it
+    RETURNS: Number of rows written, the new rows or every row if they had to be merged
+    '''
+    assert dedupe_cols is None or set(dedupe_cols) == set(sort_cols), 'dedupe_cols must match sort_cols'
+    with open(path, 'rb') as f:
+        header_line = f.readline()
+        header = next(csv.reader([header_line.decode()]))
+        sort_idxs = [header.index(col) for col in sort_cols]
+        key = lambda row: tuple(sort_value(row[idx]) for idx in sort_idxs)
+
+        # Key of the last compacted row, read back from the end of the compacted part
+        sorted_bytes = max(sorted_bytes, len(header_line))
+        last_key = None
+        if sorted_bytes > len(header_line):
+            f.seek(max(sorted_bytes - TAIL_BYTES, len(header_line)))
+            last_line = f.read(sorted_bytes - f.tell()).decode().splitlines()[-1]
+            last_key = key(next(csv.reader([last_line])))
+
+    run_dir = tempfile.mkdtemp(prefix='compact_', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with open(path, 'rb') as f:
+            f.seek(sorted_bytes)
+            run_files, first_keys = write_runs(csv_rows(f), key, run_dir)
+        in_order = last_key is None or not first_keys or min(first_keys) > last_key
+
+        # In order, the sorted new rows go to a temporary file which replaces the end of the
+        # CSV. Otherwise they're merged with the compacted rows into a new CSV
+        tmp_path = os.path.join(run_dir, 'tail.csv') if in_order else path + '.tmp'
+        handles = [open(run_file, newline='') for run_file in run_files]
+        try:
+            inputs = [csv.reader(handle) for handle in handles]
+            if not in_order:
+                handles.append(open(path, 'rb'))
+                handles[-1].seek(len(header_line))
+                inputs.insert(0, csv_rows(handles[-1], sorted_bytes))
+            num_rows = 0
+            with open(tmp_path, 'w', newline='') as out_handle:
+                writer = csv.writer(out_handle, lineterminator='\n')
+                if not in_order:
+                    writer.writerow(header)
+                rows = heapq.merge(*inputs, key=key)
+                for row in (last_rows(rows, key) if dedupe_cols is not None else rows):
+                    writer.writerow(row)
+                    num_rows += 1
+        finally:
+            for handle in handles:
+                handle.close()
+
+        if in_order:
+            with open(path, 'r+b') as out_handle, open(tmp_path, 'rb') as tail_handle:
+                out_handle.truncate(sorted_bytes)
+                out_handle.seek(sorted_bytes)
+                shutil.copyfileobj(tail_handle, out_handle)
+        else:
+            os.replace(tmp_path, path)
+    finally:
+        shutil.rmtree(run_dir)
+    return num_rows
+
+
+def compact_if_due(manifest, path, sort_cols, dedupe_cols=None, compact_every=COMPACT_EVERY):
+    '''Counts an append in the manifest, and compacts the CSV file every `compact_every` appends,
+    recording the compacted size so the next compaction only sorts the rows appended after it'''
+    manifest['appends'] += 1
+    if manifest['appends'] >= compact_every:
+        num_rows = compact_csv(path, sort_cols, dedupe_cols, manifest.get('sorted_bytes', 0))
+        print('Compacted {}, writing {} rows'.format(path, num_rows))
+        manifest['appends'] = 0
+        manifest['sorted_bytes'] = os.path.getsize(path)
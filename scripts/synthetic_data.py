@@ -0,0 +1,264 @@
+# Generate synthetic BCycle input files for benchmarking, scaled from the checked-in inputs
+
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Scale 1 matches the checked-in inputs: 50 stations with 5 minute snapshots from
+# 2016-04-01 to 2016-05-31. Larger scales add more days
+BASE_STATIONS = 50
+BASE_DAYS = 61
+START_DATE = '2016-04-01'
+SNAPSHOT_MINUTES = 5
+MIN_DOCKS = 8
+MAX_DOCKS = 19
+
+# About 1000 trips a day, in monthly Excel trip reports
+BASE_TRIPS = 61000
+XLS_ROWS = 30000
+
+# HTML snapshots are one file per station scrape, so scale 1 is a day of files
+BASE_HTML_FILES = 288
+
+MEMBERSHIPS = ['Walk Up', 'Local365', 'Local30', 'Weekender', '24-Hour Kiosk (Austin B-cycle)']
+EVENTS = ['', 'Rain', 'Rain-Thunderstorm', 'Fog', 'Fog-Rain', 'Thunderstorm']
+XLS_COLS = ['Trip ID', 'Membership Type', 'Bike', 'Checkout Date', 'Checkout Time',
+            'Checkout Kiosk', 'Return Kiosk', 'Duration (Minutes)']
+
+HTML_LATLONG = 'var point = new google.maps.LatLng({}, {});\n'
+HTML_MARKER = ('var marker = new createMarker(point, "<div class=\'markerTitle\'><h3>{}</h3></div>'
+               '<div class=\'markerPublicText\'><h5></h5></div>'
+               '<div class=\'markerAddress\'>{}<br />Austin, TX 78701</div><div class=\'markerAvail\'>'
+               '<div style=\'float: left; width: 50%\'><h3>{}</h3>Bikes</div>'
+               '<div style=\'float: left; width: 50%\'><h3>{}</h3>Docks</div></div>", icon, back, false);\n')
+
+
+def make_stations(n_stations=BASE_STATIONS, seed=0):
+    '''
+    Creates stations scattered around downtown Austin
+    INPUT: n_stations - number of stations, with station_id 1 to n_stations
+           seed - random seed
+    RETURNS: Dataframe with the stations.csv columns, plus each station's dock capacity
+    '''
+    rng = np.random.RandomState(seed)
+    station_ids = np.arange(1, n_stations + 1)
+    return pd.DataFrame({'station_id' : station_ids,
+                         'name' : ['Station {}'.format(idx) for idx in station_ids],
+                         'address' : ['{} Congress Ave'.format(idx * 100) for idx in station_ids],
+                         'lat' : np.round(30.2672 + rng.normal(0, 0.01, n_stations), 5),
+                         'lon' : np.round(-97.7431 + rng.normal(0, 0.01, n_stations), 5),
+                         'datetime' : START_DATE + ' 00:00:00',
+                         'capacity' : rng.randint(MIN_DOCKS, MAX_DOCKS + 1, n_stations)},
+                        columns=['station_id', 'name', 'address', 'lat', 'lon', 'datetime', 'capacity'])
+
+
+def make_bikes(stations_df, days, seed=0):
+    '''
+    Creates bike snapshots of every station, with bikes following a random walk between
+    empty and full
+    INPUT: stations_df - dataframe from `make_stations`
+           days - number of days of snapshots
+           seed - random seed
+    RETURNS: Dataframe with the bikes.csv columns, sorted by datetime then station_id
+    '''
+    rng = np.random.RandomState(seed)
+    datetimes = pd.date_range(START_DATE, periods=days * 24 * 60 // SNAPSHOT_MINUTES,
+                              freq='{}min'.format(SNAPSHOT_MINUTES))
+    n_stations = stations_df.shape[0]
+    capacity = stations_df['capacity'].values
+
+    # Fold a random walk back into [0, capacity] so stations sometimes empty or fill
+    steps = rng.randint(-1, 2, size=(len(datetimes), n_stations)).astype(np.int32)
+    walk = np.cumsum(steps, axis=0) + capacity // 2
+    folded = np.mod(walk, 2 * capacity)
+    bikes = np.where(folded > capacity, 2 * capacity - folded, folded)
+
+    return pd.DataFrame({'station_id' : np.tile(stations_df['station_id'].values, len(datetimes)),
+                         'datetime' : np.repeat(datetimes.strftime('%Y-%m-%d %H:%M:%S'), n_stations),
+                         'bikes' : bikes.ravel(),
+                         'docks' : (capacity - bikes).ravel()},
+                        columns=['station_id', 'datetime', 'bikes', 'docks'])
+
+
+def make_trips(stations_df, n_trips, days, seed=0):
+    '''
+    Creates trips between random stations, busier in the day than at night
+    INPUT: stations_df - dataframe from `make_stations`
+           n_trips - number of trips
+           days - number of days the trips are spread over
+           seed - random seed
+    RETURNS: Dataframe with the cleaned trips CSV columns read by `load_bcycle_data`
+    '''
+    rng = np.random.RandomState(seed)
+    hour_weights = np.array([1, 1, 1, 1, 1, 2, 4, 8, 10, 8, 6, 8, 10, 10, 8, 8, 10, 12, 12, 10, 8, 6, 4, 2],
+                            dtype=np.float64)
+    hours = rng.choice(24, n_trips, p=hour_weights / hour_weights.sum())
+    seconds = (rng.randint(0, days, n_trips) * 24 + hours) * 3600 + rng.randint(0, 3600, n_trips)
+    datetimes = pd.Timestamp(START_DATE) + pd.to_timedelta(np.sort(seconds), unit='s')
+    station_ids = stations_df['station_id'].values
+
+    return pd.DataFrame({'datetime' : datetimes.strftime('%Y-%m-%d %H:%M:%S'),
+                         'membership' : rng.choice(MEMBERSHIPS, n_trips),
+                         'bike_id' : rng.randint(1, 600, n_trips),
+                         'checkout_id' : rng.choice(station_ids, n_trips),
+                         'checkin_id' : rng.choice(station_ids, n_trips),
+                         'duration' : np.minimum(rng.exponential(20, n_trips).astype(np.int32) + 1, 1440)},
+                        columns=['datetime', 'membership', 'bike_id', 'checkout_id', 'checkin_id', 'duration'])
+
+
+def make_weather(days, seed=0):
+    '''
+    Creates daily weather in the raw weather.csv format read by `clean_weather`
+    INPUT: days - number of days
+           seed - random seed
+    RETURNS: Dataframe with the raw weather CSV columns
+    '''
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range(START_DATE, periods=days, freq='D')
+    max_temp = rng.randint(60, 100, days)
+    max_humidity = rng.randint(60, 100, days)
+    max_pressure = np.round(rng.uniform(29.9, 30.3, days), 2)
+    max_wind = rng.randint(5, 30, days)
+    precipitation = np.round(rng.exponential(0.1, days), 2).astype(str)
+    precipitation[rng.rand(days) < 0.05] = 'T'
+
+    return pd.DataFrame({'CDT' : ['{}-{}-{}'.format(date.year, date.month, date.day) for date in dates],
+                         'Max TemperatureF' : max_temp,
+                         'Mean TemperatureF' : max_temp - 10,
+                         'Min TemperatureF' : max_temp - 20,
+                         'Max Humidity' : max_humidity,
+                         ' Mean Humidity' : max_humidity - 15,
+                         ' Min Humidity' : max_humidity - 30,
+                         ' Max Sea Level PressureIn' : max_pressure,
+                         ' Mean Sea Level PressureIn' : max_pressure - 0.1,
+                         ' Min Sea Level PressureIn' : max_pressure - 0.2,
+                         ' Max Wind SpeedMPH' : max_wind,
+                         ' Mean Wind SpeedMPH' : max_wind // 2,
+                         ' Max Gust SpeedMPH' : max_wind + 10,
+                         'PrecipitationIn' : precipitation,
+                         ' CloudCover' : rng.randint(0, 9, days),
+                         ' Events' : rng.choice(EVENTS, days)},
+                        columns=['CDT', 'Max TemperatureF', 'Mean TemperatureF', 'Min TemperatureF',
+                                 'Max Humidity', ' Mean Humidity', ' Min Humidity',
+                                 ' Max Sea Level PressureIn', ' Mean Sea Level PressureIn',
+                                 ' Min Sea Level PressureIn', ' Max Wind SpeedMPH',
+                                 ' Mean Wind SpeedMPH', ' Max Gust SpeedMPH', 'PrecipitationIn',
+                                 ' CloudCover', ' Events'])
+
+
+def write_html_files(stations_df, n_files, out_dir, seed=0):
+    '''
+    Writes HTML station snapshots in the format parsed by clean_html_data.py
+    INPUT: stations_df - dataframe from `make_stations`
+           n_files - number of 5 minute snapshot files to write
+           out_dir - directory to write into
+           seed - random seed
+    RETURNS: List of HTML filenames, in time order
+    '''
+    days = n_files * SNAPSHOT_MINUTES // (24 * 60) + 1
+    bikes_df = make_bikes(stations_df, days, seed)
+    n_stations = stations_df.shape[0]
+    files = list()
+    for idx in range(n_files):
+        snapshot_df = bikes_df.iloc[idx * n_stations:(idx + 1) * n_stations]
+        file = os.path.join(out_dir, 'stations_{}.html'.format(snapshot_df['datetime'].iloc[0].replace(' ', '_')))
+        with open(file, 'w') as html_file:
+            html_file.write('<html><script>\n')
+            for station, bikes, docks in zip(stations_df.itertuples(), snapshot_df['bikes'].values,
+                                             snapshot_df['docks'].values):
+                html_file.write(HTML_LATLONG.format(station.lat, station.lon))
+                html_file.write(HTML_MARKER.format(station.name, station.address, bikes, docks))
+            html_file.write('</script></html>\n')
+        files.append(file)
+    return files
+
+
+def write_xls_files(trips_df, out_dir, rows=XLS_ROWS):
+    '''
+    Writes trips as Excel trip reports in the format read by clean_xls_data.py
+    INPUT: trips_df - dataframe from `make_trips`
+           out_dir - directory to write into
+           rows - number of trips in each report
+    RETURNS: List of Excel filenames
+    '''
+    datetimes = pd.to_datetime(trips_df['datetime'])
+    xls_df = pd.DataFrame({'Trip ID' : np.arange(trips_df.shape[0]) + 1,
+                           'Membership Type' : trips_df['membership'].values,
+                           'Bike' : trips_df['bike_id'].values,
+                           'Checkout Date' : datetimes.dt.strftime('%Y-%m-%d').values,
+                           'Checkout Time' : datetimes.dt.strftime('%H:%M:%S').values,
+                           'Checkout Kiosk' : trips_df['checkout_id'].values,
+                           'Return Kiosk' : trips_df['checkin_id'].values,
+                           'Duration (Minutes)' : trips_df['duration'].values},
+                          columns=XLS_COLS)
+    files = list()
+    for idx, start in enumerate(range(0, xls_df.shape[0], rows)):
+        file = os.path.join(out_dir, 'TripReport-{:04d}.xlsx'.format(idx))
+        xls_df.iloc[start:start + rows].to_excel(file, index=False)
+        files.append(file)
+    return files
+
+
+def make_dataset(out_dir, scale=1, html=True, xls=True, seed=0):
+    '''
+    Writes a synthetic copy of the input files, scaled from the checked-in inputs
+    INPUT: out_dir - directory to write into. CSV files go in out_dir/input, HTML snapshots
+                     in out_dir/html and Excel trip reports in out_dir/xls
+           scale - multiple of the checked-in input sizes
+           html, xls - whether to write the (slower to generate) script inputs
+           seed - random seed
+    RETURNS: Dictionary of the files written
+    '''
+    input_dir = os.path.join(out_dir, 'input')
+    os.makedirs(input_dir, exist_ok=True)
+    days = BASE_DAYS * scale
+
+    stations_df = make_stations(seed=seed)
+    trips_df = make_trips(stations_df, BASE_TRIPS * scale, days, seed)
+    files = {'stations' : os.path.join(input_dir, 'stations.csv'),
+             'bikes' : os.path.join(input_dir, 'bikes.csv'),
+             'trips' : os.path.join(input_dir, 'trips.csv'),
+             'weather' : os.path.join(input_dir, 'weather.csv')}
+    stations_df.drop('capacity', axis=1).to_csv(files['stations'], index=False)
+    make_bikes(stations_df, days, seed).to_csv(files['bikes'], index=False)
+    trips_df.to_csv(files['trips'], index=False)
+    make_weather(days, seed).to_csv(files['weather'], index=False)
+
+    if html:
+        html_dir = os.path.join(out_dir, 'html')
+        os.makedirs(html_dir, exist_ok=True)
+        files['html'] = write_html_files(stations_df, BASE_HTML_FILES * scale, html_dir, seed)
+    if xls:
+        xls_dir = os.path.join(out_dir, 'xls')
+        os.makedirs(xls_dir, exist_ok=True)
+        files['xls'] = write_xls_files(trips_df, xls_dir)
+    return files
+
+
+def main(argv=None):
+    '''
+    Writes a synthetic dataset from the command line
+    INPUT: List of arguments from the command line
+    RETURNS: Exit code to be passed to sys.exit():
+         0: Script completed successfully
+    '''
+    parser = argparse.ArgumentParser(description='Generate synthetic BCycle input files')
+    parser.add_argument('out_dir', help='Directory to write the dataset into')
+    parser.add_argument('--scale', type=int, default=1, help='Multiple of the checked-in input sizes')
+    parser.add_argument('--no-html', action='store_true', help="Don't write HTML snapshots")
+    parser.add_argument('--no-xls', action='store_true', help="Don't write Excel trip reports")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    files = make_dataset(args.out_dir, args.scale, not args.no_html, not args.no_xls, args.seed)
+    for name, file in sorted(files.items()):
+        print('{}: {}'.format(name, file if isinstance(file, str) else '{} files'.format(len(file))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())